@@ -1,7 +1,6 @@
-from typing import Generator
+from typing import AsyncGenerator, Callable, Generator, Optional
 from .ernie import get_ernie_response, get_erine_models, chat_ernie
 from .glm import get_zhipu_models, invoke_glm
-import openai
 from flask import Flask
 from langfuse.client import StatefulSpanClient
 from langfuse.model import ModelUsage
@@ -11,26 +10,43 @@ from openai.types.shared_params import ResponseFormatJSONObject
 from flask import current_app
 from .dify import DifyChunkChatCompletionResponse, dify_chat_message
 from flaskr.common.config import get_config
-from flaskr.service.common.models import raise_error_with_args
 from ..ark.sign import request
 from datetime import datetime
+from flaskr.util.async_bridge import aiter_sync_generator
+from .client import (
+    create_openai_client,
+    get_async_openai_client,
+    get_openai_provider,
+)
+from .discovery import (
+    get_discovered_models,
+    register_model_discovery,
+    start_model_discovery,
+)
+from .registry import (
+    API_DIFY,
+    API_ERNIE,
+    API_GLM,
+    API_OPENAI,
+    ModelRoute,
+    get_model_route,
+    get_registered_models,
+    register_model_provider,
+)
+from .response_cache import (
+    get_cached_response,
+    get_response_cache_key,
+    set_cached_response,
+)
 
 openai_enabled = False
-
-OPENAI_MODELS = []
 if get_config("OPENAI_API_KEY"):
     openai_enabled = True
-    openai_client = openai.Client(
+    openai_client = create_openai_client(
+        "openai",
         api_key=get_config("OPENAI_API_KEY"),
         base_url=get_config("OPENAI_BASE_URL"),
     )
-    try:
-        OPENAI_MODELS = [
-            i.id for i in openai_client.models.list().data if i.id.startswith("gpt")
-        ]
-    except Exception as e:
-        current_app.logger.warning(f"get openai models error: {e}")
-        OPENAI_MODELS = []
 else:
     current_app.logger.warning("OPENAI_API_KEY not configured")
     openai_client = None
@@ -38,7 +54,8 @@ else:
 deepseek_enabled = False
 if get_config("DEEPSEEK_API_KEY"):
     deepseek_enabled = True
-    deepseek_client = openai.Client(
+    deepseek_client = create_openai_client(
+        "deepseek",
         api_key=get_config("DEEPSEEK_API_KEY"),
         base_url=get_config("DEEPSEEK_API_URL"),
     )
@@ -49,22 +66,16 @@ else:
 
 # qwen
 qwen_enabled = False
-QWEN_MODELS = []
 QWEN_PREFIX = "qwen/"
 if get_config("QWEN_API_KEY"):
     qwen_enabled = True
-    qwen_client = openai.Client(
+    qwen_client = create_openai_client(
+        "qwen",
         api_key=get_config("QWEN_API_KEY"),
         base_url="https://dashscope.aliyuncs.com/compatible-mode/v1",
     )
     # get_config("QWEN_API_URL")
     # )
-    QWEN_MODELS = [QWEN_PREFIX + i.id for i in qwen_client.models.list().data]
-    QWEN_MODELS = QWEN_MODELS + [
-        QWEN_PREFIX + "deepseek-r1",
-        QWEN_PREFIX + "deepseek-v3",
-    ]
-    current_app.logger.info(f"qwen models: {QWEN_MODELS}")
 else:
     current_app.logger.warning("QWEN_API_KEY not configured")
     qwen_client = None
@@ -97,64 +108,38 @@ ERNIE_V2_MODELS = [
 ]
 if get_config("ERNIE_API_KEY"):
     ernie_v2_enabled = True
-    ernie_v2_client = openai.Client(
-        api_key=get_config("ERNIE_API_KEY"), base_url="https://qianfan.baidubce.com/v2"
+    ernie_v2_client = create_openai_client(
+        "ernie_v2",
+        api_key=get_config("ERNIE_API_KEY"),
+        base_url="https://qianfan.baidubce.com/v2",
     )
     ERNIE_V2_MODELS = [ERNIE_V2_PREFIX + i for i in ERNIE_V2_MODELS]
     current_app.logger.info(f"ernie v2 models: {ERNIE_V2_MODELS}")
 else:
     current_app.logger.warning("ERNIE_API_TOKEN not configured")
+    ernie_v2_client = None
 
 # ernie
 ernie_enabled = False
-ERNIE_MODELS = []
-
 if get_config("ERNIE_API_ID") and get_config("ERNIE_API_SECRET"):
     ernie_enabled = True
-    ERNIE_MODELS = get_erine_models(current_app)
 else:
     current_app.logger.warning("ERNIE_API_ID and ERNIE_API_SECRET not configured")
 
-current_app.logger.info(f"ernie models: {ERNIE_MODELS}")
-
 # ark
 ark_enabled = False
-ARK_MODELS = []
 ARK_PREFIX = "ark/"
-ARK_MODELS_MAP = {}
 if get_config("ARK_ACCESS_KEY_ID") and get_config("ARK_SECRET_ACCESS_KEY"):
-    ark_list_endpoints = request(
-        "POST",
-        datetime.now(),
-        {},
-        {},
-        get_config("ARK_ACCESS_KEY_ID"),
-        get_config("ARK_SECRET_ACCESS_KEY"),
-        "ListEndpoints",
-        None,
-    )
-    current_app.logger.info(ark_list_endpoints)
     ark_enabled = True
     current_app.logger.info("ARK CONFIGURED")
-    ark_endpoints = ark_list_endpoints.get("Result", {}).get("Items", [])
-    if ark_endpoints and len(ark_endpoints) > 0:
-        for endpoint in ark_endpoints:
-            endpoint_id = endpoint.get("Id")
-            model_name = (
-                endpoint.get("ModelReference", {})
-                .get("FoundationModel", {})
-                .get("Name", "")
-            )
-            current_app.logger.info(f"ark endpoint: {endpoint_id}, model: {model_name}")
-            ARK_MODELS.append(ARK_PREFIX + model_name)
-            ARK_MODELS_MAP[ARK_PREFIX + model_name] = endpoint_id
-    ark_client = openai.Client(
+    ark_client = create_openai_client(
+        "ark",
         api_key=get_config("ARK_API_KEY"),
         base_url="https://ark.cn-beijing.volces.com/api/v3",
     )
-    current_app.logger.info(f"ark models: {ARK_MODELS}")
 else:
     current_app.logger.warning("ARK_API_KEY not configured")
+    ark_client = None
 
 
 # special model glm
@@ -178,23 +163,21 @@ else:
 
 # silicon
 silicon_enabled = False
-SILICON_MODELS = []
 SILICON_PREFIX = "silicon/"
 if get_config("SILICON_API_KEY"):
     silicon_enabled = True
     current_app.logger.info("SILICON CONFIGURED")
-    silicon_client = openai.Client(
-        api_key=get_config("SILICON_API_KEY"), base_url="https://api.siliconflow.cn/v1"
+    silicon_client = create_openai_client(
+        "silicon",
+        api_key=get_config("SILICON_API_KEY"),
+        base_url="https://api.siliconflow.cn/v1",
     )
-
-    SILICON_MODELS = [SILICON_PREFIX + i.id for i in silicon_client.models.list().data]
-    current_app.logger.info(f"SILICON_MODELS: {SILICON_MODELS}")
 else:
     current_app.logger.warning("SILICON_API_KEY not configured")
     silicon_client = None
 
-ERNIE_MODELS = get_erine_models(Flask(__name__))
-GLM_MODELS = get_zhipu_models(Flask(__name__))
+ERNIE_MODELS = get_erine_models(current_app)
+GLM_MODELS = get_zhipu_models(current_app)
 DEEP_SEEK_MODELS = ["deepseek-chat"]
 
 DIFY_MODELS = []
@@ -205,6 +188,148 @@ else:
     current_app.logger.warning("DIFY_API_KEY and DIFY_URL not configured")
 
 
+def _discover_openai_models() -> dict[str, str]:
+    return {
+        i.id: i.id for i in openai_client.models.list().data if i.id.startswith("gpt")
+    }
+
+
+def _discover_qwen_models() -> dict[str, str]:
+    models = {QWEN_PREFIX + i.id: i.id for i in qwen_client.models.list().data}
+    for model in ("deepseek-r1", "deepseek-v3"):
+        models[QWEN_PREFIX + model] = model
+    return models
+
+
+def _discover_silicon_models() -> dict[str, str]:
+    return {SILICON_PREFIX + i.id: i.id for i in silicon_client.models.list().data}
+
+
+def _discover_ark_models() -> dict[str, str]:
+    ark_list_endpoints = request(
+        "POST",
+        datetime.now(),
+        {},
+        {},
+        get_config("ARK_ACCESS_KEY_ID"),
+        get_config("ARK_SECRET_ACCESS_KEY"),
+        "ListEndpoints",
+        None,
+    )
+    models = {}
+    for endpoint in ark_list_endpoints.get("Result", {}).get("Items", None) or []:
+        model_name = (
+            endpoint.get("ModelReference", {})
+            .get("FoundationModel", {})
+            .get("Name", "")
+        )
+        models[ARK_PREFIX + model_name] = endpoint.get("Id")
+    return models
+
+
+# the models of these providers are listed in the background, not at boot
+if openai_enabled:
+    register_model_discovery("openai", _discover_openai_models)
+if qwen_enabled:
+    register_model_discovery("qwen", _discover_qwen_models)
+if silicon_enabled:
+    register_model_discovery("silicon", _discover_silicon_models)
+if ark_enabled:
+    register_model_discovery("ark", _discover_ark_models)
+start_model_discovery(current_app._get_current_object())
+
+
+def _static_models(models: list[str]) -> Callable[[bool], dict[str, str]]:
+    routes = {model: model for model in models}
+    return lambda wait: routes
+
+
+def _discovered_models(name: str) -> Callable[[bool], dict[str, str]]:
+    return lambda wait: get_discovered_models(name, wait=wait)
+
+
+# the first registered provider of a model name routes it
+register_model_provider(
+    "openai",
+    API_OPENAI,
+    _discovered_models("openai"),
+    client=openai_client,
+    enabled=openai_enabled,
+    config_var="OPENAI_API_KEY,OPENAI_BASE_URL",
+    match=lambda model: model if model.startswith("gpt") else None,
+)
+register_model_provider(
+    "qwen",
+    API_OPENAI,
+    _discovered_models("qwen"),
+    client=qwen_client,
+    enabled=qwen_enabled,
+    config_var="QWEN_API_KEY,QWEN_API_URL",
+    prefix=QWEN_PREFIX,
+)
+register_model_provider(
+    "deepseek",
+    API_OPENAI,
+    _static_models(DEEP_SEEK_MODELS),
+    client=deepseek_client,
+    enabled=deepseek_enabled,
+    config_var="DEEPSEEK_API_KEY,DEEPSEEK_API_URL",
+)
+register_model_provider(
+    "silicon",
+    API_OPENAI,
+    _discovered_models("silicon"),
+    client=silicon_client,
+    enabled=silicon_enabled,
+    config_var="SILICON_API_KEY,SILICON_API_URL",
+    prefix=SILICON_PREFIX,
+)
+_ernie_v2_models = {
+    model: model.replace(ERNIE_V2_PREFIX, "") for model in ERNIE_V2_MODELS
+}
+register_model_provider(
+    "ernie_v2",
+    API_OPENAI,
+    lambda wait: _ernie_v2_models,
+    client=ernie_v2_client,
+    enabled=ernie_v2_enabled,
+    config_var="ERNIE_API_KEY",
+)
+register_model_provider(
+    "ark",
+    API_OPENAI,
+    _discovered_models("ark"),
+    client=ark_client,
+    enabled=ark_enabled,
+    config_var="ARK_ACCESS_KEY_ID,ARK_SECRET_ACCESS_KEY",
+    prefix=ARK_PREFIX,
+)
+register_model_provider(
+    "ernie",
+    API_ERNIE,
+    _static_models(ERNIE_MODELS),
+    enabled=ernie_enabled,
+    config_var="ERNIE_API_ID,ERNIE_API_SECRET",
+)
+_glm_models = set(GLM_MODELS)
+register_model_provider(
+    "glm",
+    API_GLM,
+    _static_models(GLM_MODELS),
+    enabled=glm_enabled,
+    config_var="GLM_API_KEY",
+    supports_json=False,
+    match=lambda model: model.lower() if model.lower() in _glm_models else None,
+)
+register_model_provider(
+    "dify",
+    API_DIFY,
+    _static_models(DIFY_MODELS),
+    config_var="DIFY_API_KEY,DIFY_URL",
+    supports_json=False,
+)
+
+
 class LLMStreamaUsage:
     def __init__(self, prompt_tokens, completion_tokens, total_tokens):
         self.prompt_tokens = prompt_tokens
@@ -223,70 +348,213 @@ class LLMStreamResponse:
         self.usage = LLMStreamaUsage(**usage) if usage else None
 
 
-def get_openai_client_and_model(model: str):
-    client = None
-    if (
-        model in OPENAI_MODELS
-        or model.startswith("gpt")
-        or model in QWEN_MODELS
-        or model in DEEP_SEEK_MODELS
-        or model in SILICON_MODELS
-        or model in ERNIE_V2_MODELS
-        or model in ARK_MODELS
+def _get_cache_key(
+    model: str, messages: list, json: bool, kwargs: dict
+) -> Optional[str]:
+    options = {
+        key: value
+        for key, value in kwargs.items()
+        if key not in ("stream", "temperature")
+    }
+    return get_response_cache_key(
+        model, messages, kwargs.get("temperature"), json, options
+    )
+
+
+def _to_cache_chunk(res: LLMStreamResponse) -> dict:
+    return {
+        "id": res.id,
+        "is_end": res.is_end,
+        "is_truncated": res.is_truncated,
+        "result": res.result,
+        "finish_reason": res.finish_reason,
+        "usage": res.usage.__dict__ if res.usage else None,
+    }
+
+
+def _replay_cached_response(
+    app: Flask,
+    span: StatefulSpanClient,
+    model: str,
+    messages: list,
+    generation_name: str,
+    chunks: list[dict],
+    update_span: bool,
+    kwargs: dict,
+) -> Generator[LLMStreamResponse, None, None]:
+    """
+    Replay a cached response
+    the replay is traced as a generation without usage, no tokens are spent.
+    """
+    metadata = {**kwargs, "cache_hit": True}
+    generation = _LLMGeneration(span, model.strip(), messages, generation_name)
+    for chunk in chunks:
+        generation.add_text(chunk["result"] or "")
+        yield LLMStreamResponse(**chunk)
+    generation.end(app, "llm response cache hit", metadata, update_span)
+
+
+def _cached_llm_response(
+    app: Flask,
+    span: StatefulSpanClient,
+    model: str,
+    messages: list,
+    json: bool,
+    generation_name: str,
+    update_span: bool,
+    kwargs: dict,
+    invoke: Callable[[], Generator[LLMStreamResponse, None, None]],
+) -> Generator[LLMStreamResponse, None, None]:
+    """
+    Serve a llm call from the response cache
+    a miss is invoked and cached once the response is complete.
+    """
+    cache_key = _get_cache_key(model, messages, json, kwargs)
+    chunks = get_cached_response(app, cache_key) if cache_key else None
+    if chunks is not None:
+        yield from _replay_cached_response(
+            app, span, model, messages, generation_name, chunks, update_span, kwargs
+        )
+        return
+    chunks = []
+    for res in invoke():
+        chunks.append(_to_cache_chunk(res))
+        yield res
+    if cache_key and any(chunk["result"] for chunk in chunks):
+        set_cached_response(app, cache_key, chunks)
+
+
+async def _acached_llm_response(
+    app: Flask,
+    span: StatefulSpanClient,
+    model: str,
+    messages: list,
+    json: bool,
+    generation_name: str,
+    kwargs: dict,
+    invoke: Callable[[], AsyncGenerator[LLMStreamResponse, None]],
+) -> AsyncGenerator[LLMStreamResponse, None]:
+    """
+    Async version of _cached_llm_response
+    """
+    cache_key = _get_cache_key(model, messages, json, kwargs)
+    chunks = get_cached_response(app, cache_key) if cache_key else None
+    if chunks is not None:
+        for res in _replay_cached_response(
+            app, span, model, messages, generation_name, chunks, True, kwargs
+        ):
+            yield res
+        return
+    chunks = []
+    response = invoke()
+    try:
+        async for res in response:
+            chunks.append(_to_cache_chunk(res))
+            yield res
+    finally:
+        await response.aclose()
+    if cache_key and any(chunk["result"] for chunk in chunks):
+        set_cached_response(app, cache_key, chunks)
+
+
+def _get_messages(message: str, system: str = None) -> list:
+    messages = []
+    if system:
+        messages.append({"role": "system", "content": system})
+    messages.append({"role": "user", "content": message})
+    return messages
+
+
+class _LLMGeneration:
+    """
+    Langfuse generation of a llm call
+    collects the response text, the usage and the completion start time of
+    the chunks, whatever the provider and the transport.
+    """
+
+    def __init__(
+        self,
+        span: StatefulSpanClient,
+        model: str,
+        generation_input: list,
+        generation_name: str,
     ):
-        if model in OPENAI_MODELS or model.startswith("gpt"):
-            client = openai_client
-            if not client:
-                raise_error_with_args(
-                    "LLM.SPECIFIED_LLM_NOT_CONFIGURED",
-                    model=model,
-                    config_var="OPENAI_API_KEY,OPENAI_BASE_URL",
-                )
-        elif model in QWEN_MODELS:
-            client = qwen_client
-            model = model.replace(QWEN_PREFIX, "")
-            if not client:
-                raise_error_with_args(
-                    "LLM.SPECIFIED_LLM_NOT_CONFIGURED",
-                    model=model,
-                    config_var="QWEN_API_KEY,QWEN_API_URL",
-                )
-        elif model in DEEP_SEEK_MODELS:
-            client = deepseek_client
-            if not client:
-                raise_error_with_args(
-                    "LLM.SPECIFIED_LLM_NOT_CONFIGURED",
-                    model=model,
-                    config_var="DEEPSEEK_API_KEY,DEEPSEEK_API_URL",
-                )
-        elif model in SILICON_MODELS:
-            client = silicon_client
-            model = model.replace(SILICON_PREFIX, "")
-            if not client:
-                raise_error_with_args(
-                    "LLM.SPECIFIED_LLM_NOT_CONFIGURED",
-                    model=model,
-                    config_var="SILICON_API_KEY,SILICON_API_URL",
-                )
-        elif model in ERNIE_V2_MODELS:
-            client = ernie_v2_client
-            model = model.replace(ERNIE_V2_PREFIX, "")
-            if not client:
-                raise_error_with_args(
-                    "LLM.SPECIFIED_LLM_NOT_CONFIGURED",
-                    model=model,
-                    config_var="ERNIE_API_KEY",
-                )
-        elif model in ARK_MODELS:
-            client = ark_client
-            model = ARK_MODELS_MAP[model]
-            if not client:
-                raise_error_with_args(
-                    "LLM.SPECIFIED_LLM_NOT_CONFIGURED",
-                    model=model,
-                    config_var="ARK_ACCESS_KEY_ID,ARK_SECRET_ACCESS_KEY",
-                )
-    return client, model
+        self.span = span
+        self.generation_input = generation_input
+        self.generation = span.generation(
+            model=model, input=generation_input, name=generation_name
+        )
+        self.response_text = ""
+        self.usage = None
+        self.start_completion_time = None
+
+    def on_chunk(self):
+        if self.start_completion_time is None:
+            self.start_completion_time = datetime.now()
+
+    def add_text(self, text: str):
+        self.on_chunk()
+        self.response_text += text
+
+    def set_usage(self, usage):
+        if usage:
+            self.usage = ModelUsage(
+                unit="TOKENS",
+                input=usage.prompt_tokens,
+                output=usage.completion_tokens,
+                total=usage.total_tokens,
+            )
+
+    def add_openai_chunk(self, res) -> Optional[LLMStreamResponse]:
+        """
+        Collect an openai compatible chunk
+        Returns:
+            Optional[LLMStreamResponse]: Response chunk, None without content
+        """
+        self.on_chunk()
+        self.set_usage(res.usage)
+        if not len(res.choices) or not res.choices[0].delta.content:
+            return None
+        self.add_text(res.choices[0].delta.content)
+        return LLMStreamResponse(
+            res.id,
+            True if res.choices[0].finish_reason else False,
+            False,
+            res.choices[0].delta.content,
+            res.choices[0].finish_reason,
+            None,
+        )
+
+    def end(self, app: Flask, name: str, metadata: dict, update_span: bool = True):
+        app.logger.info(f"{name} response: {self.response_text} ")
+        app.logger.info(f"{name} usage: {self.usage.__str__()}")
+        self.generation.end(
+            input=self.generation_input,
+            output=self.response_text,
+            usage=self.usage,
+            metadata=metadata,
+            completion_start_time=self.start_completion_time,
+        )
+        if update_span:
+            self.span.update(output=self.response_text)
+
+
+def _build_openai_request(
+    route: ModelRoute, messages: list, json: bool, kwargs: dict
+) -> Callable:
+    """
+    Build the chat completion request of an openai compatible route
+    the kwargs are completed in place, they are the traced metadata.
+    Returns:
+        Callable: Function creating the completion with a sync or async client
+    """
+    if json and route.supports_json:
+        kwargs["response_format"] = ResponseFormatJSONObject(type="json_object")
+    kwargs["temperature"] = float(kwargs.get("temperature", 0.8))
+    kwargs["stream_options"] = ChatCompletionStreamOptionsParam(include_usage=True)
+    return lambda client: client.chat.completions.create(
+        model=route.model, messages=messages, **kwargs
+    )
 
 
 def invoke_llm(
@@ -298,82 +566,60 @@ def invoke_llm(
     system: str = None,
     json: bool = False,
     generation_name: str = "invoke_llm",
+    cache: bool = False,
     **kwargs,
 ) -> Generator[LLMStreamResponse, None, None]:
+    if cache:
+        yield from _cached_llm_response(
+            app,
+            span,
+            model,
+            _get_messages(message, system),
+            json,
+            generation_name,
+            True,
+            kwargs,
+            lambda: invoke_llm(
+                app,
+                user_id,
+                span,
+                model,
+                message,
+                system=system,
+                json=json,
+                generation_name=generation_name,
+                **kwargs,
+            ),
+        )
+        return
     app.logger.info(
         f"invoke_llm [{model}] {message} ,system:{system} ,json:{json} ,kwargs:{kwargs}"
     )
     kwargs.update({"stream": True})
     model = model.strip()
-    generation_input = []
-    if system:
-        generation_input.append({"role": "system", "content": system})
-    generation_input.append({"role": "user", "content": message})
-    generation = span.generation(
-        model=model, input=generation_input, name=generation_name
-    )
-    response_text = ""
-    usage = None
-    client, invoke_model = get_openai_client_and_model(model)
-    start_completion_time = None
-    if client:
-        messages = []
-        if system:
-            messages.append({"content": system, "role": "system"})
-        messages.append({"content": message, "role": "user"})
-        if json:
-            kwargs["response_format"] = ResponseFormatJSONObject(type="json_object")
-        kwargs["temperature"] = float(kwargs.get("temperature", 0.8))
-        kwargs["stream_options"] = ChatCompletionStreamOptionsParam(include_usage=True)
-        response = client.chat.completions.create(
-            model=invoke_model, messages=messages, **kwargs
+    messages = _get_messages(message, system)
+    generation = _LLMGeneration(span, model, messages, generation_name)
+    route = get_model_route(model)
+    if route.api == API_OPENAI:
+        create = _build_openai_request(route, messages, json, kwargs)
+        response = get_openai_provider(route.client).stream(
+            model, lambda: create(route.client)
         )
-
         for res in response:
-            if start_completion_time is None:
-                start_completion_time = datetime.now()
-            if len(res.choices) and res.choices[0].delta.content:
-                response_text += res.choices[0].delta.content
-                yield LLMStreamResponse(
-                    res.id,
-                    True if res.choices[0].finish_reason else False,
-                    False,
-                    res.choices[0].delta.content,
-                    res.choices[0].finish_reason,
-                    None,
-                )
-            if res.usage:
-                usage = ModelUsage(
-                    unit="TOKENS",
-                    input=res.usage.prompt_tokens,
-                    output=res.usage.completion_tokens,
-                    total=res.usage.total_tokens,
-                )
-    elif model in ERNIE_MODELS:
-        if not ernie_enabled:
-            raise_error_with_args(
-                "LLM.SPECIFIED_LLM_NOT_CONFIGURED",
-                model=model,
-                config_var="ERNIE_API_ID,ERNIE_API_SECRET",
-            )
+            chunk = generation.add_openai_chunk(res)
+            if chunk is not None:
+                yield chunk
+    elif route.api == API_ERNIE:
         if system:
             kwargs.update({"system": system})
-        if json:
+        if json and route.supports_json:
             kwargs["response_format"] = "json_object"
         if kwargs.get("temperature", None) is not None:
             kwargs["temperature"] = float(kwargs.get("temperature", 0.8))
-        response = get_ernie_response(app, model, message, **kwargs)
+        response = get_ernie_response(app, route.model, message, **kwargs)
         for res in response:
-            if start_completion_time is None:
-                start_completion_time = datetime.now()
-            response_text += res.result
-            if res.usage:
-                usage = ModelUsage(
-                    unit="TOKENS",
-                    input=res.usage.prompt_tokens,
-                    output=res.usage.completion_tokens,
-                    total=res.usage.total_tokens,
-                )
+            generation.add_text(res.result)
+            generation.set_usage(res.usage)
             yield LLMStreamResponse(
                 res.id,
                 res.is_end,
@@ -382,31 +628,13 @@ def invoke_llm(
                 res.finish_reason,
                 res.usage.__dict__,
             )
-    elif model.lower() in GLM_MODELS:
-        if not glm_enabled:
-            raise_error_with_args(
-                "LLM.SPECIFIED_LLM_NOT_CONFIGURED",
-                model=model,
-                config_var="GLM_API_KEY",
-            )
+    elif route.api == API_GLM:
         if kwargs.get("temperature", None) is not None:
             kwargs["temperature"] = str(kwargs["temperature"])
-        messages = []
-        if system:
-            messages.append({"content": system, "role": "system"})
-        messages.append({"content": message, "role": "user"})
-        response = invoke_glm(app, model.lower(), messages, **kwargs)
+        response = invoke_glm(app, route.model, messages, **kwargs)
         for res in response:
-            if start_completion_time is None:
-                start_completion_time = datetime.now()
-            response_text += res.result
-            if res.usage:
-                usage = ModelUsage(
-                    unit="TOKENS",
-                    input=res.usage.prompt_tokens,
-                    output=res.usage.completion_tokens,
-                    total=res.usage.total_tokens,
-                )
+            generation.add_text(res.result)
+            generation.set_usage(res.usage)
             yield LLMStreamResponse(
                 res.id,
                 True if res.choices[0].finish_reason else False,
@@ -415,13 +643,12 @@ def invoke_llm(
                 res.choices[0].finish_reason,
                 None,
             )
-    elif model in DIFY_MODELS:
+    elif route.api == API_DIFY:
         response = dify_chat_message(app, message, user_id)
         for res in response:
-            if start_completion_time is None:
-                start_completion_time = datetime.now()
+            generation.on_chunk()
             if res.event == "message":
-                response_text += res.answer
+                generation.add_text(res.answer)
                 yield LLMStreamResponse(
                     res.task_id,
                     True if res.event == "message" else False,
@@ -430,22 +657,91 @@ def invoke_llm(
                     None,
                     None,
                 )
-    else:
-        raise_error_with_args(
-            "LLM.MODEL_NOT_SUPPORTED",
-            model=model,
-        )
 
-    app.logger.info(f"invoke_llm response: {response_text} ")
-    app.logger.info(f"invoke_llm usage: {usage.__str__()}")
-    generation.end(
-        input=generation_input,
-        output=response_text,
-        usage=usage,
-        metadata=kwargs,
-        completion_start_time=start_completion_time,
+    generation.end(app, "invoke_llm", kwargs)
+
+
+async def ainvoke_llm(
+    app: Flask,
+    user_id: str,
+    span: StatefulSpanClient,
+    model: str,
+    message: str,
+    system: str = None,
+    json: bool = False,
+    generation_name: str = "invoke_llm",
+    cache: bool = False,
+    **kwargs,
+) -> AsyncGenerator[LLMStreamResponse, None]:
+    """
+    Async version of invoke_llm
+    openai compatible models are streamed with the non-blocking async client,
+    the other providers only have a sync http client and are iterated
+    in the default executor.
+    """
+    if cache:
+        response = _acached_llm_response(
+            app,
+            span,
+            model,
+            _get_messages(message, system),
+            json,
+            generation_name,
+            kwargs,
+            lambda: ainvoke_llm(
+                app,
+                user_id,
+                span,
+                model,
+                message,
+                system=system,
+                json=json,
+                generation_name=generation_name,
+                **kwargs,
+            ),
+        )
+        try:
+            async for res in response:
+                yield res
+        finally:
+            await response.aclose()
+        return
+    route = get_model_route(model.strip())
+    if route.api != API_OPENAI:
+        response = invoke_llm(
+            app,
+            user_id,
+            span,
+            model,
+            message,
+            system=system,
+            json=json,
+            generation_name=generation_name,
+            **kwargs,
+        )
+        async for res in aiter_sync_generator(response):
+            yield res
+        return
+    app.logger.info(
+        f"ainvoke_llm [{model}] {message} ,system:{system} ,json:{json} ,kwargs:{kwargs}"
     )
-    span.update(output=response_text)
+    kwargs.update({"stream": True})
+    model = model.strip()
+    messages = _get_messages(message, system)
+    generation = _LLMGeneration(span, model, messages, generation_name)
+    create = _build_openai_request(route, messages, json, kwargs)
+    response = get_openai_provider(route.client).astream(
+        model, lambda: create(get_async_openai_client(route.client))
+    )
+    try:
+        async for res in response:
+            chunk = generation.add_openai_chunk(res)
+            if chunk is not None:
+                yield chunk
+    finally:
+        # release the upstream connection when the consumer stops early
+        await response.aclose()
+        generation.end(app, "ainvoke_llm", kwargs)
 
 
 def chat_llm(
@@ -456,66 +752,57 @@ def chat_llm(
     messages: list,
     json: bool = False,
     generation_name: str = "user_follow_ask",
+    cache: bool = False,
     **kwargs,
 ) -> Generator[LLMStreamResponse, None, None]:
+    if cache:
+        yield from _cached_llm_response(
+            app,
+            span,
+            model,
+            messages,
+            json,
+            generation_name,
+            False,
+            kwargs,
+            lambda: chat_llm(
+                app,
+                user_id,
+                span,
+                model,
+                messages,
+                json=json,
+                generation_name=generation_name,
+                **kwargs,
+            ),
+        )
+        return
     app.logger.info(f"chat_llm [{model}] {messages} ,json:{json} ,kwargs:{kwargs}")
     kwargs.update({"stream": True})
     model = model.strip()
-    generation_input = messages
-    generation = span.generation(
-        model=model, input=generation_input, name=generation_name
-    )
-    response_text = ""
-    usage = None
-    start_completion_time = None
+    generation = _LLMGeneration(span, model, messages, generation_name)
     if kwargs.get("temperature", None) is not None:
         kwargs["temperature"] = float(kwargs.get("temperature", 0.8))
-    client, invoke_model = get_openai_client_and_model(model)
-    if client:
-        response = client.chat.completions.create(
-            model=invoke_model, messages=messages, **kwargs
+    route = get_model_route(model)
+    if route.api == API_OPENAI:
+        client, invoke_model = route.client, route.model
+        response = get_openai_provider(client).stream(
+            model,
+            lambda: client.chat.completions.create(
+                model=invoke_model, messages=messages, **kwargs
+            ),
         )
         for res in response:
-            if start_completion_time is None:
-                start_completion_time = datetime.now()
-            if len(res.choices) and res.choices[0].delta.content:
-                response_text += res.choices[0].delta.content
-                yield LLMStreamResponse(
-                    res.id,
-                    True if res.choices[0].finish_reason else False,
-                    False,
-                    res.choices[0].delta.content,
-                    res.choices[0].finish_reason,
-                    None,
-                )
-            if res.usage:
-                usage = ModelUsage(
-                    unit="TOKENS",
-                    input=res.usage.prompt_tokens,
-                    output=res.usage.completion_tokens,
-                    total=res.usage.total_tokens,
-                )
-    elif model in ERNIE_MODELS:
-        if not ernie_enabled:
-            raise_error_with_args(
-                "LLM.SPECIFIED_LLM_NOT_CONFIGURED",
-                model=model,
-                config_var="ERNIE_API_ID,ERNIE_API_SECRET",
-            )
+            chunk = generation.add_openai_chunk(res)
+            if chunk is not None:
+                yield chunk
+    elif route.api == API_ERNIE:
         if kwargs.get("temperature", None) is not None:
             kwargs["temperature"] = float(kwargs.get("temperature", 0.8))
-        response = chat_ernie(app, model, messages, **kwargs)
+        response = chat_ernie(app, route.model, messages, **kwargs)
         for res in response:
-            if start_completion_time is None:
-                start_completion_time = datetime.now()
-            response_text += res.result
-            if res.usage:
-                usage = ModelUsage(
-                    unit="TOKENS",
-                    input=res.usage.prompt_tokens,
-                    output=res.usage.completion_tokens,
-                    total=res.usage.total_tokens,
-                )
+            generation.add_text(res.result)
+            generation.set_usage(res.usage)
             yield LLMStreamResponse(
                 res.id,
                 res.is_end,
@@ -524,27 +811,13 @@ def chat_llm(
                 res.finish_reason,
                 res.usage.__dict__,
             )
-    elif model.lower() in GLM_MODELS:
-        if not glm_enabled:
-            raise_error_with_args(
-                "LLM.SPECIFIED_LLM_NOT_CONFIGURED",
-                model=model,
-                config_var="GLM_API_KEY",
-            )
+    elif route.api == API_GLM:
         if kwargs.get("temperature", None) is not None:
             kwargs["temperature"] = str(kwargs["temperature"])
-        response = invoke_glm(app, model.lower(), messages, **kwargs)
+        response = invoke_glm(app, route.model, messages, **kwargs)
         for res in response:
-            if start_completion_time is None:
-                start_completion_time = datetime.now()
-            response_text += res.choices[0].delta.content
-            if res.usage:
-                usage = ModelUsage(
-                    unit="TOKENS",
-                    input=res.usage.prompt_tokens,
-                    output=res.usage.completion_tokens,
-                    total=res.usage.total_tokens,
-                )
+            generation.add_text(res.choices[0].delta.content)
+            generation.set_usage(res.usage)
             yield LLMStreamResponse(
                 res.id,
                 True if res.choices[0].finish_reason else False,
@@ -553,15 +826,14 @@ def chat_llm(
                 res.choices[0].finish_reason,
                 None,
             )
-    elif model in DIFY_MODELS:
+    elif route.api == API_DIFY:
         response: Generator[DifyChunkChatCompletionResponse, None, None] = (
             dify_chat_message(app, messages[-1]["content"], user_id)
         )
         for res in response:
-            if start_completion_time is None:
-                start_completion_time = datetime.now()
+            generation.on_chunk()
             if res.event == "message":
-                response_text += res.answer
+                generation.add_text(res.answer)
                 yield LLMStreamResponse(
                     res.task_id,
                     True if res.event == "message" else False,
@@ -570,34 +842,9 @@ def chat_llm(
                     None,
                     None,
                 )
-    else:
-        raise_error_with_args(
-            "LLM.MODEL_NOT_SUPPORTED",
-            model=model,
-        )
 
-    app.logger.info(f"invoke_llm response: {response_text} ")
-    app.logger.info(f"invoke_llm usage: {usage.__str__()}")
-    generation.end(
-        input=generation_input,
-        output=response_text,
-        usage=usage,
-        metadata=kwargs,
-        completion_start_time=start_completion_time,
-    )
+    generation.end(app, "invoke_llm", kwargs, update_span=False)
 
 
 def get_current_models(app: Flask) -> list[str]:
-    return list(
-        dict.fromkeys(
-            OPENAI_MODELS
-            + ERNIE_MODELS
-            + GLM_MODELS
-            + QWEN_MODELS
-            + DEEP_SEEK_MODELS
-            + DIFY_MODELS
-            + SILICON_MODELS
-            + ERNIE_V2_MODELS
-            + ARK_MODELS
-        )
-    )
+    return get_registered_models()
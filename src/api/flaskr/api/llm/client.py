@@ -0,0 +1,417 @@
+"""
+LLM provider clients
+
+This module contains the http layer shared by the llm providers.
+
+Every provider owns keep-alive connection pools, a sync one and an async one,
+with explicit connect and read timeouts. Requests go through the concurrency
+limits of their provider and of their model, a request over a limit waits
+for a free slot instead of failing.
+"""
+
+import asyncio
+import collections
+import contextlib
+import os
+import threading
+from typing import AsyncGenerator, Callable, Generator, Optional
+
+import httpx
+import openai
+import requests
+from flask import Flask
+from requests.adapters import HTTPAdapter
+
+from flaskr.common.config import get_config
+
+
+class ConcurrencyLimit:
+    """
+    Semaphore shared by sync callers and coroutines of the runtime loop
+    waiters are served in arrival order, a released slot is handed over to
+    the first waiter.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._active = 0
+        self._lock = threading.Lock()
+        self._waiters: collections.deque[Callable[[], None]] = collections.deque()
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def _acquire_or_wait(self, wake: Callable[[], None]) -> bool:
+        with self._lock:
+            if self._active < self.limit and not self._waiters:
+                self._active += 1
+                return True
+            self._waiters.append(wake)
+            return False
+
+    def _cancel_wait(self, wake: Callable[[], None]) -> bool:
+        # False when the slot was already handed over to the waiter
+        with self._lock:
+            try:
+                self._waiters.remove(wake)
+                return True
+            except ValueError:
+                return False
+
+    def acquire(self):
+        """
+        Wait for a free slot
+        """
+        event = threading.Event()
+        if not self._acquire_or_wait(event.set):
+            event.wait()
+
+    async def aacquire(self):
+        """
+        Wait for a free slot without blocking the event loop
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(_resolve, future)
+
+        if self._acquire_or_wait(wake):
+            return
+        try:
+            await future
+        except asyncio.CancelledError:
+            if not self._cancel_wait(wake):
+                self.release()
+            raise
+
+    def release(self):
+        """
+        Release a slot, handing it over to the first waiter
+        """
+        with self._lock:
+            if self._waiters:
+                wake = self._waiters.popleft()
+            else:
+                self._active -= 1
+                return
+        wake()
+
+
+def _resolve(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+def _parse_limits(value: str) -> dict[str, int]:
+    # "openai=50,ernie=10" -> {"openai": 50, "ernie": 10}
+    limits = {}
+    for item in (value or "").split(","):
+        name, _, limit = item.strip().rpartition("=")
+        if name and limit.strip().isdigit() and int(limit) > 0:
+            limits[name.strip()] = int(limit)
+    return limits
+
+
+_limits_lock = threading.Lock()
+_model_limits: dict[str, Optional[ConcurrencyLimit]] = {}
+
+
+def _get_model_limit(model: str) -> Optional[ConcurrencyLimit]:
+    if model not in _model_limits:
+        with _limits_lock:
+            if model not in _model_limits:
+                limit = _parse_limits(get_config("LLM_MODEL_CONCURRENCY")).get(model)
+                _model_limits[model] = ConcurrencyLimit(limit) if limit else None
+    return _model_limits[model]
+
+
+class ProviderClient:
+    """
+    Connection pools and concurrency limits of a llm provider
+    the pools are created lazily and again after a fork, so the clients can
+    be created before gunicorn forks the workers.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        limit = _parse_limits(get_config("LLM_PROVIDER_CONCURRENCY")).get(name)
+        self._limit = ConcurrencyLimit(limit) if limit else None
+        self._lock = threading.Lock()
+        self._pid: Optional[int] = None
+        self._session: Optional[requests.Session] = None
+        self._http_client: Optional[httpx.Client] = None
+        self._async_http_client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def timeout(self) -> tuple[int, int]:
+        return get_config("LLM_CONNECT_TIMEOUT"), get_config("LLM_READ_TIMEOUT")
+
+    def _reset_after_fork(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._session = None
+                    self._http_client = None
+                    self._async_http_client = None
+                    self._pid = os.getpid()
+
+    @property
+    def session(self) -> requests.Session:
+        self._reset_after_fork()
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    pool_maxsize = get_config("LLM_POOL_MAXSIZE")
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_maxsize=pool_maxsize)
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    self._session = session
+        return self._session
+
+    def _httpx_args(self) -> dict:
+        connect, read = self.timeout
+        pool_maxsize = get_config("LLM_POOL_MAXSIZE")
+        return {
+            "timeout": httpx.Timeout(read, connect=connect),
+            "limits": httpx.Limits(
+                max_connections=pool_maxsize,
+                max_keepalive_connections=pool_maxsize,
+            ),
+        }
+
+    @property
+    def http_client(self) -> httpx.Client:
+        self._reset_after_fork()
+        if self._http_client is None:
+            with self._lock:
+                if self._http_client is None:
+                    self._http_client = httpx.Client(**self._httpx_args())
+        return self._http_client
+
+    @property
+    def async_http_client(self) -> httpx.AsyncClient:
+        self._reset_after_fork()
+        if self._async_http_client is None:
+            with self._lock:
+                if self._async_http_client is None:
+                    self._async_http_client = httpx.AsyncClient(**self._httpx_args())
+        return self._async_http_client
+
+    def _get_limits(self, model: str) -> list[ConcurrencyLimit]:
+        # always acquired in the same order, provider first
+        return [limit for limit in (self._limit, _get_model_limit(model)) if limit]
+
+    @contextlib.contextmanager
+    def limit(self, model: str):
+        """
+        Hold a slot of the provider and of the model
+        Args:
+            model: Model requested by the caller
+        """
+        acquired = []
+        try:
+            for limit in self._get_limits(model):
+                limit.acquire()
+                acquired.append(limit)
+            yield
+        finally:
+            for limit in reversed(acquired):
+                limit.release()
+
+    @contextlib.asynccontextmanager
+    async def alimit(self, model: str):
+        """
+        Async version of limit
+        Args:
+            model: Model requested by the caller
+        """
+        acquired = []
+        try:
+            for limit in self._get_limits(model):
+                await limit.aacquire()
+                acquired.append(limit)
+            yield
+        finally:
+            for limit in reversed(acquired):
+                limit.release()
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """
+        Send a request through the pooled session
+        Args:
+            method: Http method
+            url: Url
+            kwargs: Arguments of requests.Session.request
+        Returns:
+            requests.Response: Response
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def stream_lines(
+        self, app: Flask, model: str, method: str, url: str, **kwargs
+    ) -> Generator[str, None, None]:
+        """
+        Stream the lines of a response within the limits of the model
+        the slot and the connection are released when the stream ends or the
+        caller closes it.
+        Args:
+            app: Flask application instance
+            model: Model requested by the caller
+            method: Http method
+            url: Url
+            kwargs: Arguments of requests.Session.request
+        Returns:
+            Generator[str, None, None]: Decoded lines
+        """
+        with self.limit(model):
+            response = self.request(method, url, stream=True, **kwargs)
+            try:
+                if response.status_code != 200:
+                    app.logger.error(
+                        f"{self.name} response status code: {response.status_code}"
+                    )
+                for line in response.iter_lines():
+                    yield line.decode("utf-8")
+            finally:
+                response.close()
+
+    def stream(
+        self, model: str, create: Callable[[], openai.Stream]
+    ) -> Generator[object, None, None]:
+        """
+        Stream an openai compatible completion within the limits of the model
+        Args:
+            model: Model requested by the caller
+            create: Function creating the stream
+        Returns:
+            Generator[object, None, None]: Chunks of the completion
+        """
+        with self.limit(model):
+            response = create()
+            try:
+                yield from response
+            finally:
+                response.close()
+
+    async def astream(
+        self, model: str, create: Callable[[], openai.AsyncStream]
+    ) -> AsyncGenerator[object, None]:
+        """
+        Async version of stream
+        Args:
+            model: Model requested by the caller
+            create: Coroutine function creating the stream
+        Returns:
+            AsyncGenerator[object, None]: Chunks of the completion
+        """
+        async with self.alimit(model):
+            response = await create()
+            try:
+                async for chunk in response:
+                    yield chunk
+            finally:
+                # release the upstream connection when the consumer stops early
+                await response.close()
+
+
+_providers: dict[str, ProviderClient] = {}
+_openai_providers: dict[int, ProviderClient] = {}
+_async_clients: dict[int, tuple[httpx.AsyncClient, openai.AsyncClient]] = {}
+
+
+def get_provider_client(name: str) -> ProviderClient:
+    """
+    Get the client of a provider
+    Args:
+        name: Provider name, as used in LLM_PROVIDER_CONCURRENCY
+    Returns:
+        ProviderClient: Provider client
+    """
+    provider = _providers.get(name)
+    if provider is None:
+        with _limits_lock:
+            provider = _providers.setdefault(name, ProviderClient(name))
+    return provider
+
+
+def create_openai_client(name: str, api_key: str, base_url: str) -> openai.Client:
+    """
+    Create an openai compatible client on the pool of a provider
+    Args:
+        name: Provider name
+        api_key: Api key
+        base_url: Base url
+    Returns:
+        openai.Client: Client
+    """
+    provider = get_provider_client(name)
+    client = openai.Client(
+        api_key=api_key, base_url=base_url, http_client=provider.http_client
+    )
+    _openai_providers[id(client)] = provider
+    return client
+
+
+def get_openai_provider(client: openai.Client) -> ProviderClient:
+    """
+    Get the provider of an openai compatible client
+    Args:
+        client: Client created by create_openai_client
+    Returns:
+        ProviderClient: Provider client
+    """
+    return _openai_providers[id(client)]
+
+
+def get_async_openai_client(client: openai.Client) -> openai.AsyncClient:
+    """
+    Get the async client sharing the config of an openai compatible client
+    the async client is created once per sync client on the async pool of
+    its provider and reused, so the connections are kept alive between calls.
+    Args:
+        client: Client created by create_openai_client
+    Returns:
+        openai.AsyncClient: Async client
+    """
+    http_client = get_openai_provider(client).async_http_client
+    cached = _async_clients.get(id(client), None)
+    # the pool of the provider is created again after a fork
+    if cached is not None and cached[0] is http_client:
+        return cached[1]
+    async_client = openai.AsyncClient(
+        api_key=client.api_key, base_url=client.base_url, http_client=http_client
+    )
+    _async_clients[id(client)] = (http_client, async_client)
+    return async_client
+
+
+def get_provider_stats() -> dict:
+    """
+    Get the concurrency statistics of the providers of the worker
+    Returns:
+        dict: active and waiting requests per provider and limited model
+    """
+    stats = {}
+    for name, provider in list(_providers.items()):
+        if provider._limit:
+            stats[name] = {
+                "limit": provider._limit.limit,
+                "active": provider._limit.active,
+                "waiting": provider._limit.waiting,
+            }
+    for model, limit in list(_model_limits.items()):
+        if limit:
+            stats["model:" + model] = {
+                "limit": limit.limit,
+                "active": limit.active,
+                "waiting": limit.waiting,
+            }
+    return stats
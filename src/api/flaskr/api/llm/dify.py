@@ -1,8 +1,9 @@
 from flask import Flask
 from typing import Generator
-import requests
 import json
 
+from .client import get_provider_client
+
 
 class DifyChunkChatCompletionResponse:
     event: str
@@ -37,9 +38,10 @@ def dify_chat_message(
         "inputs": {},
         "files": [],
     }
-    response = requests.post(url, headers=headers, json=data, stream=True)
-    for res in response.iter_lines():
-        res = res.decode("utf-8")
+    response = get_provider_client("dify").stream_lines(
+        app, "dify", "POST", url, headers=headers, json=data
+    )
+    for res in response:
         app.logger.info("dify response data: {}".format(res))
         if res.startswith("data:"):
             json_data = res[5:].strip()
@@ -0,0 +1,191 @@
+"""
+LLM model discovery
+
+This module contains the background discovery of the models of the llm
+providers.
+
+Listing the models of a provider is a network call, it is not done while
+the workers boot. The discovered models are persisted in redis and shared by
+the workers, every worker keeps a copy in memory. A stale copy is still
+served while a refresh runs in the background, only a request for a model of
+a provider which was never discovered waits for the discovery.
+"""
+
+import json
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Optional
+
+from flask import Flask
+
+from flaskr.common.config import get_config
+from flaskr.dao import redis_client as redis
+from flaskr.util.async_bridge import run_in_background
+
+# seconds between two refresh attempts of a provider in a worker
+MODEL_DISCOVERY_RETRY_INTERVAL = 30
+# seconds a request waits for the first discovery of a provider
+MODEL_DISCOVERY_WAIT_TIMEOUT = 30
+MODEL_DISCOVERY_LOCK_EXPIRE = 60
+# seconds between two loads of the models discovered by another worker
+MODEL_DISCOVERY_WAIT_INTERVAL = 0.1
+
+_lock = threading.Lock()
+_app: Optional[Flask] = None
+# provider name: function returning {public model name: invoked model name}
+_discoveries: dict[str, Callable[[], dict[str, str]]] = {}
+# provider name: {"models": {...}, "updated": timestamp}
+_snapshots: dict[str, dict] = {}
+_refreshing: dict[str, Future] = {}
+_scheduled_at: dict[str, float] = {}
+# returned for a provider without models, the same dict until models appear
+_NO_MODELS: dict[str, str] = {}
+
+
+def _get_key(name: str) -> str:
+    return get_config("REDIS_KEY_PREFIX") + "llm_models:" + name
+
+
+def _is_stale(snapshot: Optional[dict]) -> bool:
+    # refreshed at half of the expiry, so redis never drops a used snapshot
+    expire = get_config("LLM_MODEL_DISCOVERY_EXPIRE")
+    return snapshot is None or time.time() - snapshot["updated"] > expire / 2
+
+
+def _load_snapshot(app: Flask, name: str) -> Optional[dict]:
+    try:
+        cached = redis.get(_get_key(name))
+    except Exception as e:
+        app.logger.warning(f"get llm models cache failed: {e}")
+        return None
+    return json.loads(cached) if cached else None
+
+
+def _discover(app: Flask, name: str) -> Optional[dict]:
+    try:
+        models = _discoveries[name]()
+    except Exception as e:
+        app.logger.warning(f"discover {name} models failed: {e}")
+        return None
+    app.logger.info(f"{name} models: {list(models.keys())}")
+    snapshot = {"models": models, "updated": time.time()}
+    try:
+        redis.set(
+            _get_key(name),
+            json.dumps(snapshot),
+            ex=get_config("LLM_MODEL_DISCOVERY_EXPIRE"),
+        )
+    except Exception as e:
+        app.logger.warning(f"set llm models cache failed: {e}")
+    return snapshot
+
+
+def _wait_discovery(app: Flask, name: str) -> Optional[dict]:
+    # another worker lists the models, load its result until the lock expires
+    deadline = time.time() + MODEL_DISCOVERY_LOCK_EXPIRE
+    while time.time() < deadline:
+        time.sleep(MODEL_DISCOVERY_WAIT_INTERVAL)
+        snapshot = _load_snapshot(app, name)
+        if not _is_stale(snapshot):
+            return snapshot
+        try:
+            if not redis.get(_get_key(name) + ":lock"):
+                # the discovery of the other worker failed
+                return snapshot
+        except Exception as e:
+            app.logger.warning(f"get llm models lock failed: {e}")
+            return snapshot
+    return None
+
+
+def _refresh(app: Flask, name: str) -> Optional[dict]:
+    with app.app_context():
+        snapshot = _load_snapshot(app, name)
+        if _is_stale(snapshot):
+            lock_key = _get_key(name) + ":lock"
+            try:
+                # one worker lists the models, the others load its result
+                locked = redis.set(lock_key, 1, nx=True, ex=MODEL_DISCOVERY_LOCK_EXPIRE)
+            except Exception as e:
+                app.logger.warning(f"lock llm models discovery failed: {e}")
+                locked = True
+            if locked:
+                try:
+                    snapshot = _discover(app, name) or snapshot
+                finally:
+                    try:
+                        redis.delete(lock_key)
+                    except Exception as e:
+                        app.logger.warning(f"unlock llm models discovery failed: {e}")
+            else:
+                snapshot = _wait_discovery(app, name) or snapshot
+        if snapshot is None:
+            # nothing to serve, the next request retries at once
+            with _lock:
+                _scheduled_at.pop(name, None)
+            return None
+        _snapshots[name] = snapshot
+        return snapshot
+
+
+def _schedule_refresh(name: str) -> Optional[Future]:
+    with _lock:
+        future = _refreshing.get(name)
+        if future is not None and not future.done():
+            return future
+        if time.time() - _scheduled_at.get(name, 0) < MODEL_DISCOVERY_RETRY_INTERVAL:
+            return None
+        _scheduled_at[name] = time.time()
+        future = run_in_background(_refresh, _app, name)
+        _refreshing[name] = future
+        return future
+
+
+def register_model_discovery(name: str, discover: Callable[[], dict[str, str]]):
+    """
+    Register the discovery of the models of a provider
+    Args:
+        name: Provider name
+        discover: Function listing the models of the provider, as a dict of
+            public model name to the model name sent to the provider
+    """
+    _discoveries[name] = discover
+
+
+def start_model_discovery(app: Flask):
+    """
+    Start discovering the models of the registered providers in the background
+    Args:
+        app: Flask application instance
+    """
+    global _app
+    _app = app
+    for name in _discoveries:
+        _schedule_refresh(name)
+
+
+def get_discovered_models(name: str, wait: bool = False) -> dict[str, str]:
+    """
+    Get the discovered models of a provider
+    a stale result is returned as is and refreshed in the background.
+    Args:
+        name: Provider name
+        wait: Wait for the discovery when the provider was never discovered
+    Returns:
+        dict[str, str]: Public model name to the model name sent to the provider
+    """
+    if name not in _discoveries:
+        return _NO_MODELS
+    snapshot = _snapshots.get(name)
+    if _is_stale(snapshot) and _app is not None:
+        future = _schedule_refresh(name)
+        if snapshot is None and wait:
+            future = future or _refreshing.get(name)
+            if future is not None:
+                try:
+                    future.result(timeout=MODEL_DISCOVERY_WAIT_TIMEOUT)
+                except Exception as e:
+                    _app.logger.warning(f"wait {name} models failed: {e}")
+            snapshot = _snapshots.get(name)
+    return snapshot["models"] if snapshot else _NO_MODELS
@@ -1,11 +1,12 @@
 from typing import Generator
-import requests
 
-# from ..dao import redis_client
 from flask import Flask
+import hashlib
 import json
 
 from flaskr.common.config import get_config
+from .client import get_provider_client
+from .token_manager import ProviderToken
 
 
 class ErnieUsage:
@@ -52,19 +53,33 @@ ERNIE_API_ID = get_config("ERNIE_API_ID")
 ERNIE_API_SECRET = get_config("ERNIE_API_SECRET")
 
 
-def get_access_token():
+def _fetch_access_token() -> tuple[str, float]:
     url = "https://aip.baidubce.com/oauth/2.0/token"
     params = {
         "grant_type": "client_credentials",
         "client_id": ERNIE_API_ID,
         "client_secret": ERNIE_API_SECRET,
     }
-    response = requests.post(url, params=params)
-    return response.json()["access_token"]
+    response = get_provider_client("ernie").request("POST", url, params=params)
+    data = response.json()
+    if "access_token" not in data:
+        raise Exception("get ernie access token failed", data)
+    return data["access_token"], data["expires_in"]
 
 
-def get_token():
-    return get_access_token()
+# the token is shared by the workers using the same api id
+_access_token = ProviderToken(
+    "ernie:" + hashlib.sha256(str(ERNIE_API_ID).encode()).hexdigest()[:16],
+    _fetch_access_token,
+)
+
+
+def get_access_token(app: Flask) -> str:
+    return _access_token.get(app)
+
+
+def get_token(app: Flask) -> str:
+    return get_access_token(app)
 
 
 URLS = {
@@ -86,20 +101,21 @@ def get_ernie_response(
     app, model, msg, **args
 ) -> Generator[ErnieStreamResponse, None, None]:
     url = URLS[model]
-    params = {"access_token": get_access_token()}
+    params = {"access_token": get_access_token(app)}
     data = {"messages": [{"role": "user", "content": msg}], "stream": True}
     for k, v in args.items():
         data[k] = v
     app.logger.info("ernie request data: {}".format(data))
-    response = requests.post(
+    response = get_provider_client("ernie").stream_lines(
+        app,
+        model,
+        "POST",
         url,
         params=params,
         json=data,
         headers={"Content-Type": "application/json"},
-        stream=True,
     )
-    for res in response.iter_lines():
-        res = res.decode("utf-8")
+    for res in response:
         app.logger.info("ernie response data: {}".format(res))
         if res.startswith("data:"):
             json_data = res[5:].strip()
@@ -114,7 +130,7 @@ def chat_ernie(
     app: Flask, model, messages, **args
 ) -> Generator[ErnieStreamResponse, None, None]:
     url = URLS[model]
-    params = {"access_token": get_access_token()}
+    params = {"access_token": get_access_token(app)}
 
     data = {}
     if messages[0].get("role", "") == "system":
@@ -127,15 +143,16 @@ def chat_ernie(
         data[k] = v
 
     app.logger.info("ernie request data: {}".format(data))
-    response = requests.post(
+    response = get_provider_client("ernie").stream_lines(
+        app,
+        model,
+        "POST",
         url,
         params=params,
         json=data,
         headers={"Content-Type": "application/json"},
-        stream=True,
     )
-    for res in response.iter_lines():
-        res = res.decode("utf-8")
+    for res in response:
         app.logger.info("ernie response data: {}".format(res))
         if res.startswith("data:"):
             json_data = res[5:].strip()
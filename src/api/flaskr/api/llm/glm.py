@@ -1,11 +1,12 @@
 from typing import Generator
-import requests
 from flask import Flask
 import jwt
 import time
 import json
 
 from flaskr.common.config import get_config
+from .client import get_provider_client
+from .token_manager import ProviderToken
 
 URL = "https://open.bigmodel.cn/api/paas/v4/chat/completions"
 
@@ -71,23 +72,37 @@ class Usage:
         return f"prompt_tokens:{self.prompt_tokens},completion_tokens:{self.completion_tokens},total_tokens:{self.total_tokens}"
 
 
-def get_token(app: Flask) -> str:
+# seconds a signed token is valid
+GLM_TOKEN_EXPIRE = 3600
+
+
+def _sign_token() -> tuple[str, float]:
     try:
         id, secret = get_config("BIGMODEL_API_KEY").split(".")
     except Exception as e:
         raise Exception("invalid apikey", e)
 
+    now = int(round(time.time() * 1000))
     payload = {
         "api_key": id,
-        "exp": int(round(time.time() * 1000)) + 10 * 1000,
-        "timestamp": int(round(time.time() * 1000)),
+        "exp": now + GLM_TOKEN_EXPIRE * 1000,
+        "timestamp": now,
     }
-    return jwt.encode(
+    token = jwt.encode(
         payload,
         secret,
         algorithm="HS256",
         headers={"alg": "HS256", "sign_type": "SIGN"},
     )
+    return token, GLM_TOKEN_EXPIRE
+
+
+# signed locally, every worker keeps its own token
+_token = ProviderToken("glm", _sign_token, shared=False)
+
+
+def get_token(app: Flask) -> str:
+    return _token.get(app)
 
 
 def get_chat_response(app: Flask, msg: str) -> Generator[ChatResponse, None, None]:
@@ -106,10 +121,11 @@ def invoke_glm(
     data = {**data, **args}
 
     headers = {"Authorization": "Bearer " + get_config("GLM_API_KEY")}
-    response = requests.post(URLS[model], json=data, headers=headers, stream=True)
     app.logger.info("request data: {}".format(json.dumps(data)))
-    for res in response.iter_lines():
-        res = res.decode("utf-8")
+    response = get_provider_client("glm").stream_lines(
+        app, model, "POST", URLS[model], json=data, headers=headers
+    )
+    for res in response:
         app.logger.info("zhipu response data: {}".format(res))
         if res.startswith("data:"):
             # 提取 'data:' 后面的内容
@@ -119,18 +135,6 @@ def invoke_glm(
                 break
             parsed_data = json.loads(json_data)
             yield ChatResponse(**parsed_data)
-    if response.status_code != 200:
-        try:
-            app.logger.error(
-                "zhipu response status code: {}".format(response.status_code)
-            )
-            app.logger.error("zhipu response data: {}".format(response.text))
-        except Exception as e:
-            app.logger.error("zhipu response error: {}".format(e))
-            pass
-        # raise Exception('zhipu response status code: {}'.format(response.status_code))
-
-    app.logger.error("ernie response data: {}".format(response))
 
 
 def get_zhipu_models(app: Flask) -> list[str]:
@@ -0,0 +1,242 @@
+"""
+LLM model registry
+
+This module contains the routing of a model name to its provider.
+
+Providers register once, with the models they serve. The registry keeps a
+dict from every model name to its route (provider, client, upstream model
+and capabilities), so routing a call is a dict lookup. The dict is rebuilt
+and swapped at once when the model list of a provider changes, eg. after a
+background discovery.
+"""
+
+import threading
+from typing import Callable, Optional
+
+import openai
+
+from flaskr.service.common.models import raise_error_with_args
+
+# apis of the providers, openai compatible providers share the same adapter
+API_OPENAI = "openai"
+API_ERNIE = "ernie"
+API_GLM = "glm"
+API_DIFY = "dify"
+
+
+class ModelRoute:
+    """
+    Route of a model name to its provider
+    """
+
+    provider: str
+    api: str
+    client: Optional[openai.Client]
+    model: str
+    supports_json: bool
+    enabled: bool
+    config_var: str
+
+    def __init__(
+        self,
+        provider: str,
+        api: str,
+        client: Optional[openai.Client],
+        model: str,
+        supports_json: bool,
+        enabled: bool,
+        config_var: str,
+    ):
+        self.provider = provider
+        self.api = api
+        self.client = client
+        self.model = model
+        self.supports_json = supports_json
+        self.enabled = enabled
+        self.config_var = config_var
+
+
+class ModelProvider:
+    """
+    Provider registered in the model registry
+    """
+
+    def __init__(
+        self,
+        name: str,
+        api: str,
+        get_models: Callable[[bool], dict[str, str]],
+        client: Optional[openai.Client] = None,
+        enabled: bool = True,
+        config_var: str = "",
+        prefix: str = "",
+        supports_json: bool = True,
+        match: Optional[Callable[[str], Optional[str]]] = None,
+    ):
+        self.name = name
+        self.api = api
+        self.get_models = get_models
+        self.client = client
+        self.enabled = enabled
+        self.config_var = config_var
+        self.prefix = prefix
+        self.supports_json = supports_json
+        self.match = match
+
+    def route(self, model: str) -> ModelRoute:
+        return ModelRoute(
+            self.name,
+            self.api,
+            self.client,
+            model,
+            self.supports_json,
+            self.enabled,
+            self.config_var,
+        )
+
+
+class ModelRegistry:
+    """
+    Routes of the model names of the registered providers
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._providers: list[ModelProvider] = []
+        self._models: tuple = ()
+        self._routes: dict[str, ModelRoute] = {}
+
+    def register(self, provider: ModelProvider):
+        """
+        Register a provider, the first registered provider of a model wins
+        Args:
+            provider: Provider
+        """
+        with self._lock:
+            self._providers.append(provider)
+            self._models = ()
+
+    def _get_routes(self, wait_prefix: str = "") -> dict[str, ModelRoute]:
+        providers = self._providers
+        models = tuple(
+            provider.get_models(
+                bool(wait_prefix and provider.prefix)
+                and wait_prefix.startswith(provider.prefix)
+            )
+            for provider in providers
+        )
+        current = self._models
+        if len(models) == len(current) and all(
+            new is old for new, old in zip(models, current)
+        ):
+            return self._routes
+        routes = {}
+        for provider, provider_models in zip(providers, models):
+            for name, model in provider_models.items():
+                routes.setdefault(name, provider.route(model))
+        with self._lock:
+            if providers is self._providers:
+                self._routes = routes
+                self._models = models
+        return routes
+
+    def find(self, model: str) -> Optional[ModelRoute]:
+        """
+        Find the route of a model name
+        Args:
+            model: Model name
+        Returns:
+            Optional[ModelRoute]: Route, None for an unknown model
+        """
+        route = self._get_routes().get(model)
+        if route is not None:
+            return route
+        for provider in self._providers:
+            if provider.match is not None:
+                upstream = provider.match(model)
+                if upstream is not None:
+                    return provider.route(upstream)
+        # the models of a provider may not be discovered yet
+        return self._get_routes(wait_prefix=model).get(model)
+
+    def get_models(self) -> list[str]:
+        """
+        Get the model names of the registered providers
+        Returns:
+            list[str]: Model names
+        """
+        return list(self._get_routes())
+
+
+_registry = ModelRegistry()
+
+
+def register_model_provider(
+    name: str,
+    api: str,
+    get_models: Callable[[bool], dict[str, str]],
+    client: Optional[openai.Client] = None,
+    enabled: bool = True,
+    config_var: str = "",
+    prefix: str = "",
+    supports_json: bool = True,
+    match: Optional[Callable[[str], Optional[str]]] = None,
+):
+    """
+    Register a provider in the model registry
+    Args:
+        name: Provider name
+        api: API_OPENAI, API_ERNIE, API_GLM or API_DIFY
+        get_models: Function returning the public model names mapped to the
+            upstream model ids, it returns the same dict while the models do
+            not change, its argument asks to wait for a pending discovery
+        client: Openai compatible client
+        enabled: Whether the provider is configured
+        config_var: Config vars to set when it is not configured
+        prefix: Prefix of the public model names
+        supports_json: Whether the provider supports json responses
+        match: Function returning the upstream model id of a model name
+            which is not listed, None when the provider does not serve it
+    """
+    _registry.register(
+        ModelProvider(
+            name,
+            api,
+            get_models,
+            client=client,
+            enabled=enabled,
+            config_var=config_var,
+            prefix=prefix,
+            supports_json=supports_json,
+            match=match,
+        )
+    )
+
+
+def get_model_route(model: str) -> ModelRoute:
+    """
+    Get the route of a model name
+    Args:
+        model: Model name
+    Returns:
+        ModelRoute: Route of the model
+    """
+    route = _registry.find(model)
+    if route is None:
+        raise_error_with_args("LLM.MODEL_NOT_SUPPORTED", model=model)
+    if not route.enabled:
+        raise_error_with_args(
+            "LLM.SPECIFIED_LLM_NOT_CONFIGURED",
+            model=model,
+            config_var=route.config_var,
+        )
+    return route
+
+
+def get_registered_models() -> list[str]:
+    """
+    Get the model names of the registered providers
+    Returns:
+        list[str]: Model names
+    """
+    return _registry.get_models()
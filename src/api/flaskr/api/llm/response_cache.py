@@ -0,0 +1,133 @@
+"""
+LLM response cache
+
+This module contains the exact match cache of the llm responses.
+
+Only the calls opting in are cached, they are deterministic for the same
+input, eg. summaries or validations. A response is keyed by the model, the
+normalized messages, the temperature and the json flag. The responses are
+stored in redis with an expiry and shared by the workers, every worker keeps
+the recently used ones in a bounded in memory LRU in front of redis.
+"""
+
+import hashlib
+import json
+import time
+from typing import Optional
+
+from flask import Flask
+
+from flaskr.common.config import get_config
+from flaskr.dao import redis_client as redis
+from flaskr.util.lru_cache import LRUCache
+
+
+_local = LRUCache(
+    maxsize=int(get_config("LLM_RESPONSE_CACHE_SIZE") or 1000),
+    ttl=int(get_config("LLM_RESPONSE_CACHE_EXPIRE") or 0),
+)
+
+
+def _normalize_messages(messages: list[dict]) -> list[dict]:
+    # only the role and the content reach the model
+    return [
+        {
+            "role": message.get("role", ""),
+            "content": str(message.get("content") or "").replace("\r\n", "\n").strip(),
+        }
+        for message in messages
+    ]
+
+
+def get_response_cache_key(
+    model: str,
+    messages: list[dict],
+    temperature: Optional[float],
+    json_mode: bool,
+    options: Optional[dict] = None,
+) -> Optional[str]:
+    """
+    Get the cache key of a llm call
+    Args:
+        model: Model name
+        messages: Messages sent to the model
+        temperature: Sampling temperature
+        json_mode: Whether a json response is requested
+        options: Other arguments of the call changing the response
+    Returns:
+        Optional[str]: Cache key, None when the cache is disabled
+    """
+    if get_config("LLM_RESPONSE_CACHE_EXPIRE") <= 0:
+        return None
+    content = json.dumps(
+        {
+            "model": model.strip(),
+            "messages": _normalize_messages(messages),
+            "temperature": None if temperature is None else float(temperature),
+            "json": bool(json_mode),
+            "options": options or {},
+        },
+        sort_keys=True,
+        ensure_ascii=False,
+        default=str,
+    )
+    return (
+        get_config("REDIS_KEY_PREFIX")
+        + "llm_response:"
+        + hashlib.sha256(content.encode("utf-8")).hexdigest()
+    )
+
+
+def get_cached_response(app: Flask, key: str) -> Optional[list[dict]]:
+    """
+    Get a cached response
+    Args:
+        app: Flask application instance
+        key: Cache key
+    Returns:
+        Optional[list[dict]]: Chunks of the response, None on a miss
+    """
+    chunks = _local.get(key)
+    if chunks is not None:
+        return chunks
+    try:
+        cached = redis.get(key)
+    except Exception as e:
+        app.logger.warning(f"get llm response cache failed: {e}")
+        return None
+    if not cached:
+        return None
+    cached = json.loads(cached)
+    # kept in memory until the redis entry expires
+    _local.set(key, cached["chunks"], ttl=max(cached["expires_at"] - time.time(), 1))
+    return cached["chunks"]
+
+
+def set_cached_response(app: Flask, key: str, chunks: list[dict]):
+    """
+    Cache a complete response
+    Args:
+        app: Flask application instance
+        key: Cache key
+        chunks: Chunks of the response
+    """
+    expire = get_config("LLM_RESPONSE_CACHE_EXPIRE")
+    expires_at = time.time() + expire
+    _local.set(key, chunks, ttl=expire)
+    try:
+        redis.set(
+            key,
+            json.dumps({"expires_at": expires_at, "chunks": chunks}),
+            ex=expire,
+        )
+    except Exception as e:
+        app.logger.warning(f"set llm response cache failed: {e}")
+
+
+def get_response_cache_stats() -> dict:
+    """
+    Get the in memory llm response cache statistics
+    Returns:
+        dict: size, maxsize, hits, misses and hit rate
+    """
+    return _local.stats()
@@ -0,0 +1,170 @@
+"""
+LLM provider tokens
+
+This module contains the cache of the access tokens of the llm providers.
+
+A token is kept in memory until shortly before it expires, then refreshed in
+the background while the current one is still served. Shared tokens are
+stored in redis, so the workers reuse the token fetched by one of them, and
+a redis lock keeps concurrent workers from all requesting a new one.
+"""
+
+import json
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Optional
+
+from flask import Flask
+
+from flaskr.common.config import get_config
+from flaskr.dao import redis_client as redis
+from flaskr.util.async_bridge import run_in_background
+
+# a token is refreshed this many seconds before it expires, at most
+TOKEN_REFRESH_MARGIN = 300
+TOKEN_LOCK_EXPIRE = 30
+# seconds a worker waits for the token fetched by another worker
+TOKEN_WAIT_TIMEOUT = 10
+TOKEN_WAIT_INTERVAL = 0.1
+
+
+class ProviderToken:
+    """
+    Cached access token of a provider
+    """
+
+    def __init__(
+        self,
+        name: str,
+        fetch: Callable[[], tuple[str, float]],
+        shared: bool = True,
+    ):
+        """
+        Args:
+            name: Name of the token, part of the redis key
+            fetch: Function requesting a new token, returns the token and
+                its lifetime in seconds
+            shared: Whether the token is shared by the workers through redis
+        """
+        self.name = name
+        self._fetch = fetch
+        self._shared = shared
+        self._lock = threading.Lock()
+        self._token: Optional[str] = None
+        self._expires_at = 0.0
+        self._lifetime = 0.0
+        self._refreshing: Optional[Future] = None
+
+    def _get_key(self) -> str:
+        return get_config("REDIS_KEY_PREFIX") + "llm_token:" + self.name
+
+    @staticmethod
+    def _get_margin(lifetime: float) -> float:
+        return min(TOKEN_REFRESH_MARGIN, lifetime / 10)
+
+    def _is_fresh(self, expires_at: float, lifetime: float) -> bool:
+        return time.time() < expires_at - self._get_margin(lifetime)
+
+    def _set(self, token: str, expires_at: float, lifetime: float):
+        self._token, self._expires_at, self._lifetime = token, expires_at, lifetime
+
+    def _load(self, app: Flask) -> bool:
+        try:
+            cached = redis.get(self._get_key())
+        except Exception as e:
+            app.logger.warning(f"get {self.name} token failed: {e}")
+            return False
+        if not cached:
+            return False
+        cached = json.loads(cached)
+        if not self._is_fresh(cached["expires_at"], cached["lifetime"]):
+            return False
+        self._set(cached["token"], cached["expires_at"], cached["lifetime"])
+        return True
+
+    def _lock_fetch(self, app: Flask) -> bool:
+        try:
+            return bool(
+                redis.set(self._get_key() + ":lock", 1, nx=True, ex=TOKEN_LOCK_EXPIRE)
+            )
+        except Exception as e:
+            app.logger.warning(f"lock {self.name} token failed: {e}")
+            return True
+
+    def _save(self, app: Flask):
+        try:
+            redis.set(
+                self._get_key(),
+                json.dumps(
+                    {
+                        "token": self._token,
+                        "expires_at": self._expires_at,
+                        "lifetime": self._lifetime,
+                    }
+                ),
+                ex=max(int(self._expires_at - time.time()), 1),
+            )
+            redis.delete(self._get_key() + ":lock")
+        except Exception as e:
+            app.logger.warning(f"set {self.name} token failed: {e}")
+
+    def refresh(self, app: Flask) -> str:
+        """
+        Get a fresh token, requesting a new one when no worker has one
+        Args:
+            app: Flask application instance
+        Returns:
+            str: Token
+        """
+        with self._lock:
+            if self._token and self._is_fresh(self._expires_at, self._lifetime):
+                return self._token
+            if self._shared:
+                if self._load(app):
+                    return self._token
+                if not self._lock_fetch(app):
+                    # another worker is fetching the token
+                    deadline = time.time() + TOKEN_WAIT_TIMEOUT
+                    while time.time() < deadline:
+                        time.sleep(TOKEN_WAIT_INTERVAL)
+                        if self._load(app):
+                            return self._token
+            token, lifetime = self._fetch()
+            self._set(token, time.time() + lifetime, lifetime)
+            app.logger.info(f"{self.name} token refreshed, expires in {lifetime}s")
+            if self._shared:
+                self._save(app)
+            return token
+
+    def _refresh_in_background(self, app: Flask):
+        with self._lock:
+            if self._refreshing is not None and not self._refreshing.done():
+                return
+            self._refreshing = run_in_background(self.refresh, app)
+
+        def log_error(future: Future):
+            if future.exception() is not None:
+                app.logger.warning(
+                    f"refresh {self.name} token failed: {future.exception()}"
+                )
+
+        self._refreshing.add_done_callback(log_error)
+
+    def get(self, app: Flask) -> str:
+        """
+        Get the token
+        a token close to its expiry is still returned while a new one is
+        requested in the background.
+        Args:
+            app: Flask application instance
+        Returns:
+            str: Token
+        """
+        token, expires_at, lifetime = self._token, self._expires_at, self._lifetime
+        if token and self._is_fresh(expires_at, lifetime):
+            return token
+        if token and time.time() < expires_at:
+            self._refresh_in_background(app)
+            return token
+        return self.refresh(app)
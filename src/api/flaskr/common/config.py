@@ -112,6 +112,13 @@ Default: "phone" (phone-only login if not configured)""",
         description="Path of log file",
         group="app",
     ),
+    "ASK_HISTORY_TOKEN_BUDGET": EnvVar(
+        name="ASK_HISTORY_TOKEN_BUDGET",
+        default=3000,
+        type=int,
+        description="Token budget of the history messages appended to LLM's context in ask, 0 for no limit",
+        group="app",
+    ),
     "ASK_MAX_HISTORY_LEN": EnvVar(
         name="ASK_MAX_HISTORY_LEN",
         default=10,
@@ -125,12 +132,95 @@ Default: "phone" (phone-only login if not configured)""",
         description="Shifu permission cache expiration time in seconds",
         group="app",
     ),
+    "SHIFU_STRUCT_CACHE_EXPIRE": EnvVar(
+        name="SHIFU_STRUCT_CACHE_EXPIRE",
+        default=86400,
+        type=int,
+        description="Published shifu struct cache expiration time in seconds",
+        group="app",
+    ),
+    "SHIFU_STRUCT_CACHE_SIZE": EnvVar(
+        name="SHIFU_STRUCT_CACHE_SIZE",
+        default=256,
+        type=int,
+        description="Max count of shifu structs cached per worker",
+        group="app",
+    ),
+    "MDFLOW_CACHE_SIZE": EnvVar(
+        name="MDFLOW_CACHE_SIZE",
+        default=512,
+        type=int,
+        description="Max count of parsed MarkdownFlow documents cached per worker",
+        group="app",
+    ),
+    "PROFILE_DEFINITION_CACHE_EXPIRE": EnvVar(
+        name="PROFILE_DEFINITION_CACHE_EXPIRE",
+        default=300,
+        type=int,
+        description="Expiration time in seconds of the profile item definitions cached per worker",
+        group="app",
+    ),
+    "GENERATION_CACHE_POLICY": EnvVar(
+        name="GENERATION_CACHE_POLICY",
+        default="never",
+        description="""Default policy of the cross learner cache of generated content blocks
+Values: "never" | "reuse" (replay the first generation) | "pool:N" (replay one of N generations)""",
+        group="app",
+    ),
+    "GENERATION_CACHE_SHIFU_POLICIES": EnvVar(
+        name="GENERATION_CACHE_SHIFU_POLICIES",
+        default="",
+        description="Generation cache policy per course, overrides GENERATION_CACHE_POLICY. Format: shifu_bid=policy,shifu_bid=policy",
+        group="app",
+    ),
+    "GENERATION_CACHE_EXPIRE": EnvVar(
+        name="GENERATION_CACHE_EXPIRE",
+        default=604800,
+        type=int,
+        description="Expiration time in seconds of cached generations of content blocks",
+        group="app",
+    ),
+    "GENERATION_STREAM_EXPIRE": EnvVar(
+        name="GENERATION_STREAM_EXPIRE",
+        default=600,
+        type=int,
+        description="Expiration time in seconds of the cached output of a generation, used to resume it after a reconnect",
+        group="app",
+    ),
+    "RUN_SCRIPT_PREFETCH_DEPTH": EnvVar(
+        name="RUN_SCRIPT_PREFETCH_DEPTH",
+        default=1,
+        type=int,
+        description="Count of following content blocks generated while the current block streams, 0 to disable",
+        group="app",
+    ),
+    "RUN_SCRIPT_STREAM_COALESCE_MS": EnvVar(
+        name="RUN_SCRIPT_STREAM_COALESCE_MS",
+        default=30,
+        type=int,
+        description="Window in milliseconds to merge streamed content chunks into one SSE frame, 0 to send every chunk",
+        group="app",
+    ),
+    "RUN_SCRIPT_STREAM_COALESCE_CHARS": EnvVar(
+        name="RUN_SCRIPT_STREAM_COALESCE_CHARS",
+        default=200,
+        type=int,
+        description="Max characters of streamed content merged into one SSE frame",
+        group="app",
+    ),
     "TZ": EnvVar(
         name="TZ",
         default="UTC",
         description="Timezone setting for the application",
         group="app",
     ),
+    "USER_PROFILE_CACHE_EXPIRE": EnvVar(
+        name="USER_PROFILE_CACHE_EXPIRE",
+        default=3600,
+        type=int,
+        description="Expiration time in seconds of the cached profiles of a user, the cache is cleared on profile writes",
+        group="app",
+    ),
     # LLM Configuration
     "OPENAI_API_KEY": EnvVar(
         name="OPENAI_API_KEY",
@@ -233,6 +323,63 @@ Default: "phone" (phone-only login if not configured)""",
         description="Alibaba Cloud Qwen API URL",
         group="llm",
     ),
+    "LLM_CONNECT_TIMEOUT": EnvVar(
+        name="LLM_CONNECT_TIMEOUT",
+        default=10,
+        type=int,
+        description="Connect timeout in seconds of the requests to LLM providers",
+        group="llm",
+    ),
+    "LLM_READ_TIMEOUT": EnvVar(
+        name="LLM_READ_TIMEOUT",
+        default=120,
+        type=int,
+        description="Read timeout in seconds of the requests to LLM providers, between two chunks of a stream",
+        group="llm",
+    ),
+    "LLM_POOL_MAXSIZE": EnvVar(
+        name="LLM_POOL_MAXSIZE",
+        default=100,
+        type=int,
+        description="Max keep-alive connections per LLM provider and worker",
+        group="llm",
+    ),
+    "LLM_PROVIDER_CONCURRENCY": EnvVar(
+        name="LLM_PROVIDER_CONCURRENCY",
+        default="",
+        description="""Max concurrent requests per LLM provider and worker, extra requests wait for a free slot
+Providers: openai, deepseek, qwen, silicon, ernie_v2, ark, ernie, glm, dify
+Example: openai=50,ernie=10""",
+        group="llm",
+    ),
+    "LLM_MODEL_CONCURRENCY": EnvVar(
+        name="LLM_MODEL_CONCURRENCY",
+        default="",
+        description="""Max concurrent requests per LLM model and worker, extra requests wait for a free slot
+Example: gpt-4o=20,deepseek-chat=10""",
+        group="llm",
+    ),
+    "LLM_RESPONSE_CACHE_EXPIRE": EnvVar(
+        name="LLM_RESPONSE_CACHE_EXPIRE",
+        default=86400,
+        type=int,
+        description="Expire seconds of the cached LLM responses of the calls opting in to the cache, 0 disables the cache",
+        group="llm",
+    ),
+    "LLM_RESPONSE_CACHE_SIZE": EnvVar(
+        name="LLM_RESPONSE_CACHE_SIZE",
+        default=1000,
+        type=int,
+        description="Max cached LLM responses kept in memory per worker, the least recently used are evicted",
+        group="llm",
+    ),
+    "LLM_MODEL_DISCOVERY_EXPIRE": EnvVar(
+        name="LLM_MODEL_DISCOVERY_EXPIRE",
+        default=3600,
+        type=int,
+        description="Expire seconds of the models listed from LLM providers, they are refreshed in the background at half of it",
+        group="llm",
+    ),
     "DEFAULT_LLM_MODEL": EnvVar(
         name="DEFAULT_LLM_MODEL",
         default="",
@@ -615,6 +762,20 @@ Generate secure key: python -c "import secrets; print(secrets.token_urlsafe(32))
         description="Content detection provider",
         group="content_detection",
     ),
+    "CHECK_TEXT_CACHE_EXPIRE": EnvVar(
+        name="CHECK_TEXT_CACHE_EXPIRE",
+        default=300,
+        type=int,
+        description="Expire seconds of the cached verdicts of a checked text, 0 to disable",
+        group="content_detection",
+    ),
+    "CHECK_TEXT_SPECULATIVE": EnvVar(
+        name="CHECK_TEXT_SPECULATIVE",
+        default=False,
+        type=bool,
+        description="Request the LLM while the learner input is checked, its output is held back until the input passes. The input reaches the LLM provider before it is checked and a rejected input still costs an LLM call",
+        group="content_detection",
+    ),
     "ILIVEDATA_PID": EnvVar(
         name="ILIVEDATA_PID",
         default="",
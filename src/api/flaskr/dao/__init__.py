@@ -2,6 +2,8 @@ from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from redis import Redis
 from sqlalchemy import event
+from sqlalchemy.orm import Session
+from typing import Callable
 import sqlparse
 import logging
 import traceback
@@ -64,6 +66,33 @@ def init_db(app: Flask):
             setup_sql_logging()
 
 
+# session info key of the functions run once the session commits
+_AFTER_COMMIT = "after_commit"
+
+
+def defer_until_commit(key: str, fn: Callable[[], None]):
+    """
+    Run a function once the current session commits
+    eg. clear a cache again so a concurrent load can not keep the uncommitted
+    state, the functions are dropped when the session rolls back.
+    Args:
+        key: Key of the function, a key is only run once per commit
+        fn: Function to run
+    """
+    db.session.info.setdefault(_AFTER_COMMIT, {})[key] = fn
+
+
+@event.listens_for(Session, "after_commit")
+def _run_after_commit(session: Session):
+    for fn in session.info.pop(_AFTER_COMMIT, {}).values():
+        fn()
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _clear_after_rollback(session: Session, previous_transaction):
+    session.info.pop(_AFTER_COMMIT, None)
+
+
 def init_redis(app: Flask):
     global redis_client
 
@@ -1,3 +1,9 @@
+import hashlib
+import json
+import unicodedata
+from concurrent.futures import Future
+from typing import Generator, Iterator, TypeVar
+
 from flask import Flask
 from ...dao import db
 from .models import RiskControlResult
@@ -5,6 +11,11 @@ from flaskr.api.check import check_text, CHECK_RESULT_REJECT, CHECK_RESULT_PASS
 from flaskr.service.common.models import raise_error
 from datetime import datetime
 from flaskr.api.check.dto import CheckResultDTO
+from flaskr.common.config import get_config
+from flaskr.dao import redis_client as redis
+from flaskr.util.async_bridge import run_in_background
+
+T = TypeVar("T")
 
 
 def add_risk_control_result(
@@ -53,3 +64,162 @@ def check_text_with_risk_control(
     )
     if res.check_result == CHECK_RESULT_REJECT:
         raise_error("CHECK.CHECK_RISK_CONTROL_REJECT")
+
+
+def add_risk_control_result_async(
+    app: Flask,
+    chat_id,
+    user_id,
+    text,
+    check_vendor,
+    check_result,
+    check_resp,
+    is_pass,
+    check_strategy,
+):
+    """
+    Write a risk control result without waiting for it
+    Args:
+        app: Flask application instance
+        same as add_risk_control_result
+    """
+    future = run_in_background(
+        add_risk_control_result,
+        app,
+        chat_id,
+        user_id,
+        text,
+        check_vendor,
+        check_result,
+        check_resp,
+        is_pass,
+        check_strategy,
+    )
+
+    def log_error(future: Future):
+        if future.exception() is not None:
+            app.logger.error(f"add risk control result failed: {future.exception()}")
+
+    future.add_done_callback(log_error)
+
+
+def _get_check_text_cache_key(app: Flask, text: str) -> str:
+    # verdicts do not depend on case, width or spacing of the text
+    normalized = " ".join(unicodedata.normalize("NFKC", text).lower().split())
+    digest = hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+    return (
+        get_config("REDIS_KEY_PREFIX")
+        + "check_text:"
+        + str(app.config.get("CHECK_PROVIDER"))
+        + ":"
+        + digest
+    )
+
+
+def check_text_cached(
+    app: Flask, data_id: str, text: str, user_id: str
+) -> CheckResultDTO:
+    """
+    Check a text, reusing the verdict of the same normalized text
+    only pass and reject verdicts are cached, for CHECK_TEXT_CACHE_EXPIRE seconds.
+    Args:
+        app: Flask application instance
+        data_id: Data id sent to the provider
+        text: Text to check
+        user_id: User id
+    Returns:
+        CheckResultDTO: Check result
+    """
+    expire = app.config.get("CHECK_TEXT_CACHE_EXPIRE", 0)
+    if not expire or not text:
+        return check_text(app, data_id, text, user_id)
+    key = _get_check_text_cache_key(app, text)
+    try:
+        cached = redis.get(key)
+    except Exception as e:
+        app.logger.warning(f"get check text cache failed: {e}")
+        cached = None
+    if cached:
+        verdict = json.loads(cached)
+        return CheckResultDTO(
+            check_result=verdict["check_result"],
+            risk_labels=verdict["risk_labels"],
+            risk_label_ids=verdict["risk_label_ids"],
+            provider=verdict["provider"],
+            raw_data={"cached": True},
+        )
+    res = check_text(app, data_id, text, user_id)
+    if res.check_result in (CHECK_RESULT_PASS, CHECK_RESULT_REJECT):
+        try:
+            redis.set(key, json.dumps(res.__to_dict__()), ex=expire)
+        except Exception as e:
+            app.logger.warning(f"set check text cache failed: {e}")
+    return res
+
+
+def start_check_text(app: Flask, data_id: str, text: str, user_id: str) -> Future:
+    """
+    Start checking a text in the background
+    the caller keeps working (eg. requests the llm) and waits for the future
+    when it needs the verdict, the risk control result is written once the
+    verdict is known, without blocking the caller.
+    Args:
+        app: Flask application instance
+        data_id: Data id of the text, used for the risk control result
+        text: Text to check
+        user_id: User id
+    Returns:
+        Future: Future of the CheckResultDTO
+    """
+    future = run_in_background(check_text_cached, app, data_id, text, user_id)
+
+    def record(future: Future):
+        if future.exception() is not None:
+            return
+        res: CheckResultDTO = future.result()
+        add_risk_control_result_async(
+            app,
+            data_id,
+            user_id,
+            text,
+            res.provider,
+            res.check_result,
+            str(res.raw_data),
+            1 if res.check_result == CHECK_RESULT_PASS else 0,
+            "check_text",
+        )
+
+    future.add_done_callback(record)
+    return future
+
+
+def hold_until_checked(check: Future, stream: Iterator[T]) -> Generator[T, None, None]:
+    """
+    Hold back the items of a stream until the text check passes
+    the items produced while the check runs are buffered and released once it
+    passes, when it rejects the stream is closed and nothing is released.
+    Args:
+        check: Future returned by start_check_text
+        stream: Stream started along the check
+    Returns:
+        Generator[T, None, None]: Items of the stream
+    """
+    buffered = []
+    try:
+        for item in stream:
+            if buffered is None:
+                yield item
+                continue
+            buffered.append(item)
+            if not check.done():
+                continue
+            if check.result().check_result == CHECK_RESULT_REJECT:
+                return
+            yield from buffered
+            buffered = None
+        if buffered and check.result().check_result != CHECK_RESULT_REJECT:
+            yield from buffered
+    finally:
+        close = getattr(stream, "close", None)
+        if close is not None:
+            close()
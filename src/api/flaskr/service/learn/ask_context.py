@@ -0,0 +1,258 @@
+"""
+Ask context
+
+This module contains the context assembly of the ask (follow-up) flow.
+
+The system message of an ask only depends on the prompts of the outline and
+the profiles of the learner, it is formatted once and cached by the hash of
+its inputs. The history is kept within a token budget instead of a count of
+messages, the newest messages are kept first and the oldest kept one may be
+cut.
+
+Tokens are estimated per model family from the count of characters, CJK
+characters are counted apart as they take about one token each.
+"""
+
+import hashlib
+import json
+import re
+import time
+from functools import lru_cache
+
+from flask import Flask
+
+from flaskr.service.learn.utils import get_fmt_prompt
+from flaskr.service.llm.funcs import format_script_prompt
+from flaskr.util.lru_cache import LRUCache
+
+ASK_SYSTEM_MESSAGE_CACHE_SIZE = 1024
+# tokens added by the chat format to every message
+MESSAGE_TOKEN_OVERHEAD = 4
+# a message is only cut when at least MIN_TRIMMED_TOKENS of it fit
+MIN_TRIMMED_TOKENS = 32
+TRIMMED_SUFFIX = "…"
+
+# model prefix: (characters per token of latin text, tokens per cjk character)
+_MODEL_TOKEN_RATIOS = (
+    ("gpt-4o", (4.0, 0.8)),
+    ("gpt-4.1", (4.0, 0.8)),
+    ("gpt-5", (4.0, 0.8)),
+    ("gpt", (4.0, 1.2)),
+    ("deepseek", (3.6, 0.6)),
+    ("qwen", (3.6, 0.7)),
+    ("glm", (3.6, 0.7)),
+    ("ernie", (3.6, 0.7)),
+    ("moonshot", (3.6, 0.7)),
+    ("kimi", (3.6, 0.7)),
+    ("doubao", (3.6, 0.7)),
+)
+_DEFAULT_TOKEN_RATIO = (4.0, 1.0)
+_CJK_PATTERN = re.compile(
+    r"[\u2e80-\u2fdf\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff"
+    r"\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]"
+)
+
+_system_message_cache = LRUCache(maxsize=ASK_SYSTEM_MESSAGE_CACHE_SIZE)
+
+
+@lru_cache(maxsize=256)
+def _get_token_ratio(model: str) -> tuple[float, float]:
+    name = (model or "").lower().rsplit("/", 1)[-1]
+    for prefix, ratio in _MODEL_TOKEN_RATIOS:
+        if name.startswith(prefix):
+            return ratio
+    return _DEFAULT_TOKEN_RATIO
+
+
+def estimate_tokens(text: str, model: str = "") -> int:
+    """
+    Estimate the count of tokens of a text for a model
+    Args:
+        text: Text
+        model: LLM model
+    Returns:
+        int: Estimated count of tokens
+    """
+    if not text:
+        return 0
+    chars_per_token, tokens_per_cjk = _get_token_ratio(model)
+    cjk = len(_CJK_PATTERN.findall(text))
+    return int((len(text) - cjk) / chars_per_token + cjk * tokens_per_cjk + 0.5)
+
+
+def estimate_messages_tokens(messages: list[dict], model: str = "") -> int:
+    """
+    Estimate the count of prompt tokens of chat messages
+    Args:
+        messages: Chat messages
+        model: LLM model
+    Returns:
+        int: Estimated count of tokens
+    """
+    return sum(
+        estimate_tokens(message.get("content") or "", model) + MESSAGE_TOKEN_OVERHEAD
+        for message in messages
+    )
+
+
+def _trim_text(text: str, tokens: int, model: str) -> str:
+    # keep the head of the text, cut on the estimated ratio then adjust
+    end = max(int(len(text) * tokens / max(estimate_tokens(text, model), 1)), 0)
+    while end > 0 and estimate_tokens(text[:end], model) > tokens:
+        end = int(end * 0.9)
+    return text[:end] + TRIMMED_SUFFIX
+
+
+def fit_history(messages: list[dict], budget: int, model: str = "") -> list[dict]:
+    """
+    Keep the newest history messages within a token budget
+    Args:
+        messages: History messages, oldest first
+        budget: Token budget of the history, 0 to keep every message
+        model: LLM model
+    Returns:
+        list[dict]: Kept messages, oldest first
+    """
+    if budget <= 0:
+        return list(messages)
+    kept = []
+    remaining = budget
+    for message in reversed(messages):
+        content = message.get("content") or ""
+        tokens = estimate_tokens(content, model) + MESSAGE_TOKEN_OVERHEAD
+        if tokens <= remaining:
+            kept.append(message)
+            remaining -= tokens
+            continue
+        if remaining - MESSAGE_TOKEN_OVERHEAD >= MIN_TRIMMED_TOKENS:
+            kept.append(
+                {
+                    "role": message["role"],
+                    "content": _trim_text(
+                        content, remaining - MESSAGE_TOKEN_OVERHEAD, model
+                    ),
+                }
+            )
+        break
+    return kept[::-1]
+
+
+def get_ask_system_message(
+    app: Flask,
+    user_id: str,
+    shifu_bid: str,
+    ask_prompt: str,
+    system_prompt_template: str,
+    profiles: dict,
+) -> str:
+    """
+    Get the formatted system message of an ask
+    the message is cached by the hash of the prompts and the profiles.
+    Args:
+        app: Flask application instance
+        user_id: User id
+        shifu_bid: Shifu bid
+        ask_prompt: Ask prompt of the outline
+        system_prompt_template: System prompt template of the outline
+        profiles: User profiles
+    Returns:
+        str: System message
+    """
+    key = hashlib.sha256(
+        json.dumps(
+            [ask_prompt, system_prompt_template or "", profiles],
+            ensure_ascii=False,
+            sort_keys=True,
+            default=str,
+        ).encode("utf-8")
+    ).hexdigest()
+    system_message = _system_message_cache.get(key)
+    if system_message is None:
+        system_prompt = (
+            get_fmt_prompt(app, user_id, shifu_bid, system_prompt_template)
+            if system_prompt_template
+            else None
+        )
+        system_message = (
+            format_script_prompt(system_prompt, profiles) if system_prompt else ""
+        )
+        system_message = ask_prompt.replace("{shifu_system_message}", system_message)
+        _system_message_cache.set(key, system_message)
+    return system_message
+
+
+class AskContext:
+    """
+    Messages of an ask with the report of their preparation
+    """
+
+    messages: list[dict]
+    prompt_tokens: int
+    history_count: int
+    history_kept: int
+    prepare_ms: float
+
+    def __init__(
+        self,
+        messages: list[dict],
+        prompt_tokens: int,
+        history_count: int,
+        history_kept: int,
+        prepare_ms: float,
+    ):
+        self.messages = messages
+        self.prompt_tokens = prompt_tokens
+        self.history_count = history_count
+        self.history_kept = history_kept
+        self.prepare_ms = prepare_ms
+
+    def report(self) -> dict:
+        return {
+            "prompt_tokens": self.prompt_tokens,
+            "history_count": self.history_count,
+            "history_kept": self.history_kept,
+            "prepare_ms": round(self.prepare_ms, 2),
+        }
+
+
+def build_ask_context(
+    app: Flask,
+    system_message: str,
+    history: list[dict],
+    input: str,
+    model: str,
+    started: float,
+) -> AskContext:
+    """
+    Build the messages of an ask within the history token budget
+    Args:
+        app: Flask application instance
+        system_message: Formatted system message
+        history: History messages, oldest first
+        input: Question of the user
+        model: LLM model
+        started: time.perf_counter() when the preparation started
+    Returns:
+        AskContext: Messages and report
+    """
+    budget = int(app.config.get("ASK_HISTORY_TOKEN_BUDGET", 0) or 0)
+    kept = fit_history(history, budget, model)
+    messages = [{"role": "system", "content": system_message}]
+    messages.extend(kept)
+    messages.append({"role": "user", "content": input})
+    return AskContext(
+        messages,
+        estimate_messages_tokens(messages, model),
+        len(history),
+        len(kept),
+        (time.perf_counter() - started) * 1000,
+    )
+
+
+def get_ask_system_message_cache_stats() -> dict:
+    """
+    Get the ask system message cache statistics
+    Returns:
+        dict: size, maxsize, hits, misses and hit rate
+    """
+    return _system_message_cache.stats()
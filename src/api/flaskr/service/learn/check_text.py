@@ -1,13 +1,12 @@
+from concurrent.futures import Future
+from typing import Optional
+
 from flask import Flask
 
 from flaskr.service.learn.models import LearnGeneratedBlock
 from flaskr.api.llm import invoke_llm
-from flaskr.api.check import (
-    check_text,
-    CHECK_RESULT_PASS,
-    CHECK_RESULT_REJECT,
-)
-from flaskr.service.check_risk import add_risk_control_result
+from flaskr.api.check import CHECK_RESULT_REJECT
+from flaskr.service.check_risk import start_check_text
 from flaskr.service.learn.const import (
     ROLE_TEACHER,
 )
@@ -34,20 +33,15 @@ def check_text_with_llm_response(
     llm_settings: LLMSettings,
     attend_id: str,
     fmt_prompt: str,
+    check: Optional[Future] = None,
 ):
-    res = check_text(app, log_script.generated_block_bid, input, user_info.user_id)
+    # the check may have been started along the llm request by the caller
+    if check is None:
+        check = start_check_text(
+            app, log_script.generated_block_bid, input, user_info.user_id
+        )
+    res = check.result()
     span.event(name="check_text", input=input, output=res)
-    add_risk_control_result(
-        app,
-        log_script.generated_block_bid,
-        user_info.user_id,
-        input,
-        res.provider,
-        res.check_result,
-        str(res.raw_data),
-        1 if res.check_result == CHECK_RESULT_PASS else 0,
-        "check_text",
-    )
 
     if res.check_result == CHECK_RESULT_REJECT:
         labels = res.risk_labels
@@ -75,6 +69,7 @@ def check_text_with_llm_response(
             json=False,
             stream=True,
             generation_name="check_text_reject_" + str(log_script.generated_block_bid),
+            cache=True,
             **{"temperature": llm_settings.temperature},
         )
         response_text = ""
@@ -1,8 +1,7 @@
-import queue
 import threading
-import asyncio
 import inspect
-from typing import Generator, Union, AsyncGenerator
+from concurrent.futures import Future
+from typing import Callable, Generator, Union, AsyncGenerator
 from enum import Enum
 from flaskr.service.learn.const import ROLE_STUDENT, ROLE_TEACHER
 from flaskr.service.shifu.consts import (
@@ -15,7 +14,6 @@ from markdown_flow import (
     ProcessMode,
     LLMProvider,
     BlockType,
-    InteractionParser,
 )
 from flask import Flask
 from flaskr.dao import db
@@ -24,6 +22,7 @@ from flaskr.service.shifu.shifu_struct_manager import (
     ShifuInfoDto,
     OutlineItemDtoWithMdflow,
     get_outline_item_dto_with_mdflow,
+    get_outline_llm_settings,
 )
 from flaskr.service.shifu.models import (
     DraftBlock,
@@ -48,16 +47,16 @@ from flaskr.service.order.consts import (
 from flaskr.service.lesson.const import LESSON_TYPE_NORMAL
 
 from flaskr.service.user.models import User
-from flaskr.service.shifu.struct_utils import find_node_with_parents
+from flaskr.service.shifu.struct_utils import StructIndex
 from flaskr.util import generate_id
-from flaskr.service.profile.funcs import get_user_profiles
+from flaskr.service.profile.funcs import get_user_profile_snapshot
 from flaskr.service.learn.learn_dtos import (
     RunMarkdownFlowDTO,
     GeneratedType,
     OutlineItemUpdateDTO,
     LearnStatus,
 )
-from flaskr.api.llm import invoke_llm
+from flaskr.api.llm import ainvoke_llm
 from flaskr.service.learn.input.handle_input_ask import _handle_input_ask
 from flaskr.service.profile.funcs import save_user_profiles, ProfileToSave
 from flaskr.service.profile.profile_manage import (
@@ -66,8 +65,41 @@ from flaskr.service.profile.profile_manage import (
 )
 from flaskr.service.learn.learn_dtos import VariableUpdateDTO
 from flaskr.service.learn.check_text import check_text_with_llm_response
+from flaskr.service.check_risk import start_check_text
+from flaskr.service.learn.interaction_validation import (
+    VALIDATION_LLM,
+    VALIDATION_LOCAL,
+    record_interaction_validation,
+    validate_interaction_input,
+)
 from flaskr.service.learn.llmsetting import LLMSettings
 from flaskr.service.learn.utils_v2 import init_generated_block
+from flaskr.service.learn.generation_cache import (
+    get_cached_generation,
+    get_generation_cache_policy,
+    make_generation_cache_key,
+    record_generation,
+    replay_generation,
+)
+from flaskr.service.learn.generation_stream import (
+    GENERATION_STREAM_END_INTERRUPTED,
+    GenerationStreamWriter,
+)
+from flaskr.service.shifu.shifu_bundle import (
+    CourseBundle,
+    CourseBundleLLMSettings,
+    get_course_bundle_mdflow,
+)
+from flaskr.service.shifu.mdflow_cache import (
+    ParsedMdflow,
+    build_markdown_flow,
+    get_parsed_mdflow,
+)
+from flaskr.util.async_bridge import (
+    iter_async_generator,
+    prefetch_async_generator,
+    run_async,
+)
 
 context_local = threading.local()
 
@@ -82,6 +114,7 @@ class RunScriptInfo:
     outline_bid: str
     block_position: int
     mdflow: str
+    parsed_mdflow: ParsedMdflow
 
     def __init__(
         self,
@@ -89,11 +122,13 @@ class RunScriptInfo:
         outline_bid: str,
         block_position: int,
         mdflow: str,
+        parsed_mdflow: ParsedMdflow,
     ):
         self.attend = attend
         self.outline_bid = outline_bid
         self.block_position = block_position
         self.mdflow = mdflow
+        self.parsed_mdflow = parsed_mdflow
 
 
 class RUNLLMProvider(LLMProvider):
@@ -126,7 +161,7 @@ class RUNLLMProvider(LLMProvider):
         last_message = messages[-1]
         prompt = last_message.get("content", "")
 
-        res = invoke_llm(
+        res = ainvoke_llm(
             self.app,
             self.trace_args.get("user_id", ""),
             self.trace,
@@ -136,10 +171,13 @@ class RUNLLMProvider(LLMProvider):
             stream=False,
             generation_name="run_llm",
             temperature=self.llm_settings.temperature,
+            # only the interaction validation completes, the same input of a
+            # block gets the same result
+            cache=True,
         )
         # Collect all stream responses and concatenate the results
         content_parts = []
-        for response in res:
+        async for response in res:
             if response.result:
                 content_parts.append(response.result)
         return "".join(content_parts)
@@ -156,7 +194,7 @@ class RUNLLMProvider(LLMProvider):
 
         # Check if there's a system message
 
-        res = invoke_llm(
+        res = ainvoke_llm(
             self.app,
             self.trace_args["user_id"],
             self.trace,
@@ -167,9 +205,71 @@ class RUNLLMProvider(LLMProvider):
             generation_name="run_llm",
             temperature=self.llm_settings.temperature,
         )
-        for i in res:
-            if i.result:
-                yield i.result
+        try:
+            async for i in res:
+                if i.result:
+                    yield i.result
+        finally:
+            await res.aclose()
+
+
+def _get_chunk_text(chunk) -> str:
+    # chunk may be a simple string or an object with content/result/text
+    if isinstance(chunk, str):
+        return chunk
+    if hasattr(chunk, "content") and chunk.content:
+        return chunk.content
+    if hasattr(chunk, "result") and chunk.result:
+        return chunk.result
+    if hasattr(chunk, "text") and chunk.text:
+        return chunk.text
+    return None
+
+
+async def stream_mdflow_block(
+    mdflow: MarkdownFlow,
+    block_index: int,
+    variables: dict = None,
+    user_input: str = None,
+) -> AsyncGenerator[str, None]:
+    """
+    Stream the content of a mdflow block as text chunks
+    Args:
+        mdflow: MarkdownFlow with llm provider
+        block_index: Block index
+        variables: Variables
+        user_input: User input
+    Returns:
+        AsyncGenerator[str, None]: Text chunks
+    """
+    # Run in STREAM mode; mdflow.process may return a coroutine or an async generator
+    stream_or_result = mdflow.process(
+        block_index,
+        ProcessMode.STREAM,
+        variables=variables,
+        user_input=user_input,
+    )
+    # Await if it's awaitable (coroutine returning either a result or an async generator)
+    if inspect.isawaitable(stream_or_result):
+        stream_or_result = await stream_or_result
+    # If it's an async generator, yield chunks from it
+    if inspect.isasyncgen(stream_or_result):
+        try:
+            async for chunk in stream_or_result:
+                text = _get_chunk_text(chunk)
+                yield text if text is not None else str(chunk)
+        finally:
+            await stream_or_result.aclose()
+        return
+
+    # Otherwise, handle a single result object
+    result = stream_or_result
+    text = _get_chunk_text(result)
+    if text is not None:
+        yield text
+    else:
+        # Fallback: convert to string to avoid leaking object reprs
+        yield str(result) if result else ""
 
 
 class RunScriptContextV2:
@@ -177,19 +277,7 @@ class RunScriptContextV2:
     attend_id: str
     is_paid: bool
 
-    def _collect_async_generator(self, async_gen):
-        """Helper method to collect results from an async generator"""
-
-        async def _collect():
-            results = []
-            async for item in async_gen:
-                results.append(item)
-            return results
-
-        return asyncio.run(_collect())
-
     preview_mode: bool
-    _q: queue.Queue
     _outline_item_info: ShifuOutlineItemDto
     _struct: HistoryItem
     _user_info: User
@@ -218,10 +306,16 @@ class RunScriptContextV2:
         user_info: User,
         is_paid: bool,
         preview_mode: bool,
+        struct_index: StructIndex = None,
+        bundle: CourseBundle = None,
+        is_cancelled: Callable[[], bool] = None,
     ):
         self._last_position = -1
         self.app = app
         self._struct = struct
+        self._struct_index = struct_index or StructIndex(struct)
+        self._bundle = bundle
+        self._is_cancelled = is_cancelled or (lambda: False)
         self._outline_item_info = outline_item_info
         self._user_info = user_info
         self._is_paid = is_paid
@@ -233,6 +327,10 @@ class RunScriptContextV2:
         self.current_outline_item = None
         self._run_type = RunType.INPUT
         self._can_continue = True
+        # generated blocks are written behind, see flush
+        self._pending_generated_blocks: list[LearnGeneratedBlock] = []
+        # (outline_bid, block_position) -> (text chunks, prefetch handle)
+        self._prefetched_blocks: dict[tuple[str, int], tuple] = {}
 
         if preview_mode:
             self._outline_model = DraftOutlineItem
@@ -243,16 +341,7 @@ class RunScriptContextV2:
             self._block_model = PublishedBlock
             self._shifu_model = PublishedShifu
         # get current attend
-        self._q = queue.Queue()
-        self._q.put(struct)
-        while not self._q.empty():
-            item = self._q.get()
-            if item.bid == outline_item_info.bid:
-                self._current_outline_item = item
-                break
-            if item.children:
-                for child in item.children:
-                    self._q.put(child)
+        self._current_outline_item = self._struct_index.get_node(outline_item_info.bid)
         self._current_attend = self._get_current_attend(self._outline_item_info.bid)
         self._trace_args = {}
         self._trace_args["user_id"] = user_info.user_id
@@ -291,7 +380,7 @@ class RunScriptContextV2:
             if outline_item_info_db.type == LESSON_TYPE_NORMAL:
                 if (not self._is_paid) and (not self._preview_mode):
                     raise_error("ORDER.COURSE_NOT_PAID")
-            parent_path = find_node_with_parents(self._struct, outline_bid)
+            parent_path = self._struct_index.get_path(outline_bid)
             attend_info = None
             for item in parent_path:
                 if item.type == "outline":
@@ -329,113 +418,77 @@ class RunScriptContextV2:
     # get the outline items to start or complete
     def _get_next_outline_item(self) -> list[OutlineItemUpdateDTO]:
         res = []
-        q = queue.Queue()
-        q.put(self._struct)
-        outline_ids = []
-        while not q.empty():
-            item: HistoryItem = q.get()
-            if item.type == "outline":
-                outline_ids.append(item.bid)
-            if item.children:
-                for child in item.children:
-                    q.put(child)
-        outline_item_info_db: list[tuple[str, bool, str]] = (
-            db.session.query(
-                self._outline_model.outline_item_bid,
-                self._outline_model.hidden,
-                self._outline_model.title,
-            )
-            .filter(
-                self._outline_model.outline_item_bid.in_(outline_ids),
-                self._outline_model.deleted == 0,
+        if self._bundle:
+            # the navigation of a published version is precomputed in the bundle
+            def get_title(bid: str) -> str:
+                outline_item = self._bundle.get_outline_item(bid)
+                return outline_item.title if outline_item else ""
+
+            def get_next_visible_leaf(bid: str):
+                return self._bundle.get_navigation(bid)
+        else:
+            outline_ids = [item.bid for item in self._struct_index.get_outline_items()]
+            outline_item_info_db: list[tuple[str, bool, str]] = (
+                db.session.query(
+                    self._outline_model.outline_item_bid,
+                    self._outline_model.hidden,
+                    self._outline_model.title,
+                )
+                .filter(
+                    self._outline_model.outline_item_bid.in_(outline_ids),
+                    self._outline_model.deleted == 0,
+                )
+                .all()
             )
-            .all()
-        )
-        outline_item_hidden_map: dict[str, bool] = {
-            bid: hidden for bid, hidden, _title in outline_item_info_db
-        }
-        outline_item_title_map: dict[str, str] = {
-            bid: title for bid, _hidden, title in outline_item_info_db
-        }
+            outline_item_hidden_map: dict[str, bool] = {
+                bid: hidden for bid, hidden, _title in outline_item_info_db
+            }
+            outline_item_title_map: dict[str, str] = {
+                bid: title for bid, _hidden, title in outline_item_info_db
+            }
+
+            def get_title(bid: str) -> str:
+                return outline_item_title_map.get(bid, "")
+
+            def get_next_visible_leaf(bid: str):
+                return self._struct_index.get_next_visible_leaf(
+                    bid, lambda bid: outline_item_hidden_map.get(bid, True)
+                )
 
         def _mark_sub_node_completed(
             outline_item_info: HistoryItem, res: list[OutlineItemUpdateDTO]
         ):
-            q = queue.Queue()
-            q.put(self._struct)
-            if self._is_leaf_outline_item(outline_item_info):
+            completed, started = get_next_visible_leaf(outline_item_info.bid)
+            for item in completed:
                 res.append(
                     OutlineItemUpdateDTO(
-                        outline_bid=outline_item_info.bid,
-                        title=outline_item_title_map.get(outline_item_info.bid, ""),
+                        outline_bid=item.bid,
+                        title=get_title(item.bid),
                         status=LearnStatus.COMPLETED,
-                        has_children=False,
+                        has_children=not self._struct_index.is_leaf_outline(item.bid),
                     )
                 )
-            else:
+            for item in started:
                 res.append(
                     OutlineItemUpdateDTO(
-                        outline_bid=outline_item_info.bid,
-                        title=outline_item_title_map.get(outline_item_info.bid, ""),
-                        status=LearnStatus.COMPLETED,
-                        has_children=True,
+                        outline_bid=item.bid,
+                        title=get_title(item.bid),
+                        status=LearnStatus.IN_PROGRESS,
+                        has_children=not self._struct_index.is_leaf_outline(item.bid),
                     )
                 )
-            while not q.empty():
-                item: HistoryItem = q.get()
-                if item.children and outline_item_info.bid in [
-                    child.bid for child in item.children
-                ]:
-                    index = [child.bid for child in item.children].index(
-                        outline_item_info.bid
-                    )
-                    while index < len(item.children) - 1:
-                        # not sub node
-                        current_node = item.children[index + 1]
-                        if outline_item_hidden_map.get(current_node.bid, True):
-                            index += 1
-                            continue
-                        while (
-                            current_node.children
-                            and current_node.children[0].type == "outline"
-                        ):
-                            res.append(
-                                OutlineItemUpdateDTO(
-                                    outline_bid=current_node.bid,
-                                    title=outline_item_title_map.get(
-                                        current_node.bid, ""
-                                    ),
-                                    status=LearnStatus.IN_PROGRESS,
-                                    has_children=True,
-                                )
-                            )
-                            current_node = current_node.children[0]
-                        res.append(
-                            OutlineItemUpdateDTO(
-                                outline_bid=current_node.bid,
-                                title=outline_item_title_map.get(current_node.bid, ""),
-                                status=LearnStatus.IN_PROGRESS,
-                                has_children=False,
-                            )
-                        )
-                        return
-                    if index == len(item.children) - 1 and item.type == "outline":
-                        _mark_sub_node_completed(item, res)
-                if item.children and item.children[0].type == "outline":
-                    for child in item.children:
-                        q.put(child)
 
         def _mark_sub_node_start(
             outline_item_info: HistoryItem, res: list[OutlineItemUpdateDTO]
         ):
-            path = find_node_with_parents(self._struct, outline_item_info.bid)
+            path = self._struct_index.get_path(outline_item_info.bid)
             for item in path:
                 if item.type == "outline":
                     if item.children and item.children[0].type == "outline":
                         res.append(
                             OutlineItemUpdateDTO(
                                 outline_bid=item.bid,
-                                title=outline_item_title_map.get(item.bid, ""),
+                                title=get_title(item.bid),
                                 status=LearnStatus.IN_PROGRESS,
                                 has_children=True,
                             )
@@ -444,7 +497,7 @@ class RunScriptContextV2:
                         res.append(
                             OutlineItemUpdateDTO(
                                 outline_bid=item.bid,
-                                title=outline_item_title_map.get(item.bid, ""),
+                                title=get_title(item.bid),
                                 status=LearnStatus.IN_PROGRESS,
                                 has_children=False,
                             )
@@ -465,15 +518,20 @@ class RunScriptContextV2:
         self, outline_updates: list[OutlineItemUpdateDTO], new_chapter: bool = False
     ) -> Generator[str, None, None]:
         shifu_bids = [o.outline_bid for o in outline_updates]
-        outline_item_info_db: Union[DraftOutlineItem, PublishedOutlineItem] = (
-            self._outline_model.query.filter(
-                self._outline_model.outline_item_bid.in_(shifu_bids),
-                self._outline_model.deleted == 0,
-            ).all()
-        )
-        outline_item_info_map: dict[
-            str, Union[DraftOutlineItem, PublishedOutlineItem]
-        ] = {o.outline_item_bid: o for o in outline_item_info_db}
+        if self._bundle:
+            outline_item_info_map = {
+                bid: self._bundle.get_outline_item(bid) for bid in shifu_bids
+            }
+        else:
+            outline_item_info_db: Union[DraftOutlineItem, PublishedOutlineItem] = (
+                self._outline_model.query.filter(
+                    self._outline_model.outline_item_bid.in_(shifu_bids),
+                    self._outline_model.deleted == 0,
+                ).all()
+            )
+            outline_item_info_map: dict[
+                str, Union[DraftOutlineItem, PublishedOutlineItem]
+            ] = {o.outline_item_bid: o for o in outline_item_info_db}
         for update in outline_updates:
             outline_item_info = outline_item_info_map.get(update.outline_bid, None)
             if not outline_item_info:
@@ -494,7 +552,6 @@ class RunScriptContextV2:
                         type=GeneratedType.OUTLINE_ITEM_UPDATE,
                         content=update,
                     )
-                    db.session.flush()
                     continue
                 self._current_attend = self._get_current_attend(update.outline_bid)
                 if (
@@ -503,7 +560,6 @@ class RunScriptContextV2:
                 ):
                     self._current_attend.status = LEARN_STATUS_IN_PROGRESS
                     self._current_attend.block_position = 0
-                    db.session.flush()
                 yield RunMarkdownFlowDTO(
                     outline_bid=update.outline_bid,
                     generated_block_bid="",
@@ -514,7 +570,6 @@ class RunScriptContextV2:
                 current_attend = self._get_current_attend(update.outline_bid)
                 current_attend.status = LEARN_STATUS_COMPLETED
                 self._current_attend = current_attend
-                db.session.flush()
                 yield RunMarkdownFlowDTO(
                     outline_bid=update.outline_bid,
                     generated_block_bid="",
@@ -530,8 +585,6 @@ class RunScriptContextV2:
                 current_attend.status = status
                 current_attend.block_position = 0
 
-                db.session.flush()
-
                 yield RunMarkdownFlowDTO(
                     outline_bid=update.outline_bid,
                     generated_block_bid="",
@@ -541,7 +594,6 @@ class RunScriptContextV2:
             elif update.has_children and update.status == LearnStatus.COMPLETED:
                 current_attend = self._get_current_attend(update.outline_bid)
                 current_attend.status = LEARN_STATUS_COMPLETED
-                db.session.flush()
                 yield RunMarkdownFlowDTO(
                     outline_bid=update.outline_bid,
                     generated_block_bid="",
@@ -562,27 +614,35 @@ class RunScriptContextV2:
         self._input = input
 
     def _get_outline_struct(self, outline_item_id: str) -> HistoryItem:
-        q = queue.Queue()
-        q.put(self._struct)
-        outline_struct = None
-        while not q.empty():
-            item = q.get()
-            if item.bid == outline_item_id:
-                outline_struct = item
-                break
-            if item.children:
-                for child in item.children:
-                    q.put(child)
-        return outline_struct
+        return self._struct_index.get_node(outline_item_id)
+
+    def _get_outline_item_mdflow(
+        self, outline_item_id: str
+    ) -> OutlineItemDtoWithMdflow:
+        if not self._bundle:
+            return get_outline_item_dto_with_mdflow(
+                self.app, outline_item_id, self._preview_mode
+            )
+        outline_item = self._bundle.get_outline_item(outline_item_id)
+        if not outline_item:
+            raise_error("SHIFU.OUTLINE_ITEM_NOT_FOUND")
+        return OutlineItemDtoWithMdflow(
+            id=outline_item.id,
+            mdflow=get_course_bundle_mdflow(self.app, self._bundle, outline_item_id),
+            outline_bid=outline_item.bid,
+            title=outline_item.title,
+        )
 
     def _get_run_script_info(self, attend: LearnProgressRecord) -> RunScriptInfo:
         outline_item_id = attend.outline_item_bid
-        outline_item_info: OutlineItemDtoWithMdflow = get_outline_item_dto_with_mdflow(
-            self.app, outline_item_id, self._preview_mode
+        outline_item_info: OutlineItemDtoWithMdflow = self._get_outline_item_mdflow(
+            outline_item_id
         )
 
-        mddoc = MarkdownFlow(outline_item_info.mdflow)
-        block_list = mddoc.get_all_blocks()
+        parsed_mdflow = get_parsed_mdflow(
+            outline_item_info.id, outline_item_info.mdflow
+        )
+        block_list = parsed_mdflow.blocks
         self.app.logger.info(
             f"attend position: {attend.block_position} blocks:{len(block_list)}"
         )
@@ -593,6 +653,7 @@ class RunScriptContextV2:
             outline_bid=outline_item_info.outline_bid,
             block_position=attend.block_position,
             mdflow=outline_item_info.mdflow,
+            parsed_mdflow=parsed_mdflow,
         )
 
     def _get_run_script_info_by_block_id(self, block_id: str) -> RunScriptInfo:
@@ -602,8 +663,8 @@ class RunScriptContextV2:
         ).first()
         if not generate_block:
             raise_error("LESSON.LESSON_NOT_FOUND_IN_COURSE")
-        outline_item_info: OutlineItemDtoWithMdflow = get_outline_item_dto_with_mdflow(
-            self.app, generate_block.outline_item_bid, self._preview_mode
+        outline_item_info: OutlineItemDtoWithMdflow = self._get_outline_item_mdflow(
+            generate_block.outline_item_bid
         )
         attend: LearnProgressRecord = LearnProgressRecord.query.filter(
             LearnProgressRecord.user_bid == self._user_info.user_id,
@@ -616,9 +677,46 @@ class RunScriptContextV2:
             outline_bid=outline_item_info.outline_bid,
             block_position=generate_block.position,
             mdflow=outline_item_info.mdflow,
+            parsed_mdflow=get_parsed_mdflow(
+                outline_item_info.id, outline_item_info.mdflow
+            ),
         )
 
     def run(self, app: Flask) -> Generator[RunMarkdownFlowDTO, None, None]:
+        # the records of a run are only read back after the run,
+        # so the queries in between do not need to flush them
+        with db.session.no_autoflush:
+            yield from self._run(app)
+        if not self._can_continue:
+            self.flush()
+
+    def _complete_content_block(self, generated_block: LearnGeneratedBlock):
+        # the block is recorded before the break is sent,
+        # so a client leaving at the break does not lose it
+        self._add_generated_block(generated_block)
+        self._can_continue = True
+        self._current_attend.status = LEARN_STATUS_IN_PROGRESS
+        self._current_attend.block_position += 1
+
+    def _add_generated_block(self, generated_block: LearnGeneratedBlock):
+        if generated_block not in self._pending_generated_blocks:
+            self._pending_generated_blocks.append(generated_block)
+
+    def flush(self):
+        """
+        Write the buffered generated blocks and progress changes of the run
+        in one batch, called when the run stops and before the commit.
+        a block interrupted while streaming is kept as history with the
+        content generated so far.
+        """
+        if self._pending_generated_blocks:
+            # blocks are referenced by their generated_block_bid, so the ids
+            # are not fetched back and the inserts are sent as one batch
+            db.session.bulk_save_objects(self._pending_generated_blocks)
+            self._pending_generated_blocks = []
+        db.session.flush()
+
+    def _run(self, app: Flask) -> Generator[RunMarkdownFlowDTO, None, None]:
         app.logger.info(
             f"run_context.run {self._current_attend.block_position} {self._current_attend.status}"
         )
@@ -627,7 +725,6 @@ class RunScriptContextV2:
         outline_updates = self._get_next_outline_item()
         if len(outline_updates) > 0:
             yield from self._render_outline_updates(outline_updates, new_chapter=False)
-            db.session.flush()
             if self._current_attend.status != LEARN_STATUS_IN_PROGRESS:
                 self._can_continue = False
                 return
@@ -641,12 +738,11 @@ class RunScriptContextV2:
                     outline_updates, new_chapter=True
                 )
                 self._can_continue = False
-                db.session.flush()
             return
         llm_settings = self.get_llm_settings(run_script_info.outline_bid)
         system_prompt = self.get_system_prompt(run_script_info.outline_bid)
-        mdflow = MarkdownFlow(
-            run_script_info.mdflow,
+        mdflow = build_markdown_flow(
+            run_script_info.parsed_mdflow,
             llm_provider=RUNLLMProvider(
                 app, system_prompt, llm_settings, self._trace, self._trace_args
             ),
@@ -678,16 +774,13 @@ class RunScriptContextV2:
                         content=i,
                     )
                 self._can_continue = False
-                db.session.flush()
             return
 
-        user_profile = get_user_profiles(
-            app, self._user_info.user_id, self._outline_item_info.shifu_bid
-        )
+        user_profile = get_user_profile_snapshot(
+            app, self._user_info.user_id, self._user_info
+        ).get_profiles(app, self._outline_item_info.shifu_bid)
         variable_definition: list[ProfileItemDefinition] = (
-            get_profile_item_definition_list(
-                app, self._user_info.user_id, self._outline_item_info.shifu_bid
-            )
+            get_profile_item_definition_list(app, self._outline_item_info.shifu_bid)
         )
         variable_definition_key_id_map: dict[str, str] = {
             p.profile_key: p.profile_id for p in variable_definition
@@ -700,7 +793,6 @@ class RunScriptContextV2:
                     outline_updates, new_chapter=True
                 )
                 self._can_continue = False
-                db.session.flush()
             return
         block = block_list[run_script_info.block_position]
         if self._run_type == RunType.INPUT:
@@ -708,10 +800,10 @@ class RunScriptContextV2:
                 self._can_continue = True
                 self._run_type = RunType.OUTPUT
                 self._current_attend.status = LEARN_STATUS_IN_PROGRESS
-                db.session.flush()
                 return
-            interaction_parser: InteractionParser = InteractionParser()
-            parsed_interaction = interaction_parser.parse(block.content)
+            parsed_interaction = run_script_info.parsed_mdflow.get_interaction(
+                run_script_info.block_position
+            )
             generated_block: LearnGeneratedBlock = (
                 LearnGeneratedBlock.query.filter(
                     LearnGeneratedBlock.progress_record_bid
@@ -737,20 +829,17 @@ class RunScriptContextV2:
                                 content=block.content,
                             )
                             self._can_continue = False
-                            db.session.flush()
                             return
                         else:
                             self._can_continue = True
                             self._current_attend.block_position += 1
                             self._run_type = RunType.OUTPUT
-                            db.session.flush()
                             return
                     if button.get("value") == "_sys_login":
                         if bool(self._user_info.mobile):
                             self._can_continue = True
                             self._current_attend.block_position += 1
                             self._run_type = RunType.OUTPUT
-                            db.session.flush()
                             return
                         else:
                             yield RunMarkdownFlowDTO(
@@ -760,76 +849,62 @@ class RunScriptContextV2:
                                 content=block.content,
                             )
                             self._can_continue = False
-                            db.session.flush()
                             return
 
             generated_block.generated_content = self._input
             generated_block.role = ROLE_STUDENT
-            db.session.flush()
-            res = check_text_with_llm_response(
-                app,
-                self._user_info,
-                generated_block,
-                self._input,
-                self._trace,
-                self._outline_item_info.bid,
-                self._outline_item_info.position,
-                self._outline_item_info.shifu_bid,
-                llm_settings,
-                self._current_attend.progress_record_bid,
-                "",
-            )
-            # Check if the generator yields any content (not None)
-            has_content = False
-            for i in res:
-                if i is not None and i != "":
-                    self.app.logger.info(f"check_text_with_llm_response: {i}")
-                    has_content = True
-                    yield RunMarkdownFlowDTO(
-                        outline_bid=run_script_info.outline_bid,
-                        generated_block_bid=generated_block.generated_block_bid,
-                        type=GeneratedType.CONTENT,
-                        content=i,
-                    )
-
-            if has_content:
-                self._can_continue = False
-                yield RunMarkdownFlowDTO(
-                    outline_bid=run_script_info.outline_bid,
-                    generated_block_bid=generated_block.generated_block_bid,
-                    type=GeneratedType.BREAK,
-                    content="",
+            # a clicked button is accepted as is, it needs neither the
+            # moderation nor the llm validation
+            variables = validate_interaction_input(parsed_interaction, self._input)
+            validate_result = None
+            if variables is not None:
+                record_interaction_validation(parsed_interaction, VALIDATION_LOCAL)
+            else:
+                check = start_check_text(
+                    app,
+                    generated_block.generated_block_bid,
+                    self._input,
+                    self._user_info.user_id,
                 )
-                yield RunMarkdownFlowDTO(
-                    outline_bid=run_script_info.outline_bid,
-                    generated_block_bid=generated_block.generated_block_bid,
-                    type=GeneratedType.INTERACTION,
-                    content=block.content,
+                if parsed_interaction.get("variable") and app.config.get(
+                    "CHECK_TEXT_SPECULATIVE", False
+                ):
+                    # validate along the moderation, the result is only used
+                    # once the input passes
+                    record_interaction_validation(parsed_interaction, VALIDATION_LLM)
+                    validate_result = run_async(
+                        mdflow.process(
+                            run_script_info.block_position,
+                            ProcessMode.COMPLETE,
+                            user_input=self._input,
+                        )
+                    )
+                    variables = validate_result.variables
+                rejected = yield from self._check_input_text(
+                    app, run_script_info, generated_block, block, llm_settings, check
                 )
-
-                db.session.flush()
-                return
+                if rejected:
+                    return
             if not parsed_interaction.get("variable"):
                 self._can_continue = True
                 self._run_type = RunType.OUTPUT
                 self._current_attend.status = LEARN_STATUS_IN_PROGRESS
                 self._current_attend.block_position += 1
-                db.session.flush()
                 return
-            validate_result = asyncio.run(
-                mdflow.process(
-                    run_script_info.block_position,
-                    ProcessMode.COMPLETE,
-                    user_input=self._input,
+            if variables is None and validate_result is None:
+                record_interaction_validation(parsed_interaction, VALIDATION_LLM)
+                validate_result = run_async(
+                    mdflow.process(
+                        run_script_info.block_position,
+                        ProcessMode.COMPLETE,
+                        user_input=self._input,
+                    )
                 )
-            )
+                variables = validate_result.variables
 
-            if (
-                validate_result.variables is not None
-                and len(validate_result.variables) > 0
-            ):
+            if variables is not None and len(variables) > 0:
                 profile_to_save: list[ProfileToSave] = []
-                for key, value in validate_result.variables.items():
+                for key, value in variables.items():
                     profile_id = variable_definition_key_id_map.get(key, "")
                     profile_to_save.append(ProfileToSave(key, value, profile_id))
 
@@ -856,7 +931,6 @@ class RunScriptContextV2:
                 self.app.logger.warning(
                     f"passed and position: {self._current_attend.block_position}"
                 )
-                db.session.flush()
                 return
             else:
                 generated_block: LearnGeneratedBlock = init_generated_block(
@@ -872,8 +946,7 @@ class RunScriptContextV2:
                 generated_block.type = BLOCK_TYPE_MDERRORMESSAGE_VALUE
                 generated_block.block_content_conf = block.content
                 generated_block.role = ROLE_TEACHER
-                db.session.add(generated_block)
-                db.session.flush()
+                self._add_generated_block(generated_block)
                 content = ""
                 for i in validate_result.content:
                     content += i
@@ -892,8 +965,7 @@ class RunScriptContextV2:
                 generated_block.generated_content = content
                 generated_block.type = BLOCK_TYPE_MDERRORMESSAGE_VALUE
                 generated_block.block_content_conf = block.content
-                db.session.add(generated_block)
-                db.session.flush()
+                self._add_generated_block(generated_block)
                 generated_block: LearnGeneratedBlock = init_generated_block(
                     app,
                     shifu_bid=run_script_info.attend.shifu_bid,
@@ -905,8 +977,7 @@ class RunScriptContextV2:
                     block_index=block.index,
                 )
                 generated_block.role = ROLE_TEACHER
-                db.session.add(generated_block)
-                db.session.flush()
+                self._add_generated_block(generated_block)
                 yield RunMarkdownFlowDTO(
                     outline_bid=run_script_info.outline_bid,
                     generated_block_bid=generated_block.generated_block_bid,
@@ -915,8 +986,7 @@ class RunScriptContextV2:
                 )
                 self._can_continue = False
                 self._current_attend.status = LEARN_STATUS_IN_PROGRESS
-                db.session.add(generated_block)
-                db.session.flush()
+                self._add_generated_block(generated_block)
         if self._run_type == RunType.OUTPUT:
             generated_block: LearnGeneratedBlock = init_generated_block(
                 app,
@@ -929,8 +999,9 @@ class RunScriptContextV2:
                 block_index=block.index,
             )
             if block.block_type == BlockType.INTERACTION:
-                interaction_parser: InteractionParser = InteractionParser()
-                parsed_interaction = interaction_parser.parse(block.content)
+                parsed_interaction = run_script_info.parsed_mdflow.get_interaction(
+                    run_script_info.block_position
+                )
                 if (
                     parsed_interaction.get("buttons")
                     and len(parsed_interaction.get("buttons")) > 0
@@ -941,7 +1012,6 @@ class RunScriptContextV2:
                                 self._can_continue = True
                                 self._current_attend.block_position += 1
                                 self._run_type = RunType.OUTPUT
-                                db.session.flush()
                                 return
                         if button.get("value") == "_sys_login":
                             self.app.logger.warning(
@@ -951,7 +1021,6 @@ class RunScriptContextV2:
                                 self._can_continue = True
                                 self._current_attend.block_position += 1
                                 self._run_type = RunType.OUTPUT
-                                db.session.flush()
                                 return
                 generated_block.type = BLOCK_TYPE_MDINTERACTION_VALUE
                 generated_block.generated_content = ""
@@ -963,140 +1032,288 @@ class RunScriptContextV2:
                 )
                 self._can_continue = False
                 self._current_attend.status = LEARN_STATUS_IN_PROGRESS
-                db.session.add(generated_block)
-                db.session.flush()
+                self._add_generated_block(generated_block)
             else:
                 generated_block.type = BLOCK_TYPE_MDCONTENT_VALUE
                 generated_content = ""
+                generation_stream = GenerationStreamWriter(
+                    app,
+                    generated_block.generated_block_bid,
+                    self._user_info.user_id,
+                    run_script_info.outline_bid,
+                )
 
-                async def process_stream():
-                    # Run in STREAM mode; mdflow.process may return a coroutine or an async generator
-                    stream_or_result = mdflow.process(
-                        run_script_info.block_position,
-                        ProcessMode.STREAM,
-                        variables=user_profile,
-                        user_input=self._input,
-                    )
-                    # Await if it's awaitable (coroutine returning either a result or an async generator)
-                    if inspect.isawaitable(stream_or_result):
-                        stream_or_result = await stream_or_result
-                    # If it's an async generator, yield chunks from it
-                    if inspect.isasyncgen(stream_or_result):
-                        async for chunk in stream_or_result:
-                            # chunk may be a simple string or an object with content/result/text
-                            if isinstance(chunk, str):
-                                yield chunk
-                            elif hasattr(chunk, "content") and chunk.content:
-                                yield chunk.content
-                            elif hasattr(chunk, "result") and chunk.result:
-                                yield chunk.result
-                            elif hasattr(chunk, "text") and chunk.text:
-                                yield chunk.text
+                res = self._stream_content_block(
+                    app,
+                    mdflow,
+                    run_script_info,
+                    user_profile,
+                    llm_settings,
+                    system_prompt,
+                )
+                try:
+                    for i in res:
+                        generated_content += i
+                        generation_stream.append(i)
+                        yield RunMarkdownFlowDTO(
+                            outline_bid=run_script_info.outline_bid,
+                            generated_block_bid=generated_block.generated_block_bid,
+                            type=GeneratedType.CONTENT,
+                            content=i,  # i is now a string, not an object with content attribute
+                        )
+                except GeneratorExit:
+                    # the client went away: finish the block so it can be
+                    # resumed, unless the run was taken over by a new run
+                    completed = False
+                    try:
+                        if not self._is_cancelled():
+                            for i in res:
+                                generated_content += i
+                                generation_stream.append(i)
+                                if self._is_cancelled():
+                                    break
                             else:
-                                yield str(chunk)
-                        return
-
-                    # Otherwise, handle a single result object
-                    result = stream_or_result
-                    if isinstance(result, str):
-                        yield result
-                    elif hasattr(result, "content") and result.content:
-                        yield result.content
-                    elif hasattr(result, "result") and result.result:
-                        yield result.result
-                    elif hasattr(result, "text") and result.text:
-                        yield result.text
+                                completed = True
+                    except Exception as e:
+                        app.logger.warning(f"finish generated block failed: {e}")
+                    generated_block.generated_content = generated_content
+                    if completed:
+                        self._complete_content_block(generated_block)
+                        generation_stream.close()
                     else:
-                        # Fallback: convert to string to avoid leaking object reprs
-                        yield str(result) if result else ""
-
-                res = self._collect_async_generator(process_stream())
-                for i in res:
-                    generated_content += i
-                    yield RunMarkdownFlowDTO(
-                        outline_bid=run_script_info.outline_bid,
-                        generated_block_bid=generated_block.generated_block_bid,
-                        type=GeneratedType.CONTENT,
-                        content=i,  # i is now a string, not an object with content attribute
-                    )
+                        # keep the partial output as history, the block is
+                        # generated again on the next run
+                        generated_block.status = 0
+                        self._add_generated_block(generated_block)
+                        generation_stream.close(GENERATION_STREAM_END_INTERRUPTED)
+                    raise
+                finally:
+                    # close the stream explicitly when the client goes away
+                    res.close()
+                generated_block.generated_content = generated_content
+                self._complete_content_block(generated_block)
+                generation_stream.close()
                 yield RunMarkdownFlowDTO(
                     outline_bid=run_script_info.outline_bid,
                     generated_block_bid=generated_block.generated_block_bid,
                     type=GeneratedType.BREAK,
                     content="",
                 )
-                generated_block.generated_content = generated_content
-                db.session.add(generated_block)
-                self._can_continue = True
-                self._current_attend.status = LEARN_STATUS_IN_PROGRESS
-                self._current_attend.block_position += 1
-                db.session.flush()
         outline_updates = self._get_next_outline_item()
         if len(outline_updates) > 0:
             yield from self._render_outline_updates(outline_updates, new_chapter=True)
             self._can_continue = False
-            db.session.flush()
         self._trace.update(**self._trace_args)
 
+    def _check_input_text(
+        self,
+        app: Flask,
+        run_script_info: RunScriptInfo,
+        generated_block: LearnGeneratedBlock,
+        block,
+        llm_settings: LLMSettings,
+        check: Future,
+    ) -> Generator[RunMarkdownFlowDTO, None, bool]:
+        res = check_text_with_llm_response(
+            app,
+            self._user_info,
+            generated_block,
+            self._input,
+            self._trace,
+            self._outline_item_info.bid,
+            self._outline_item_info.shifu_bid,
+            run_script_info.block_position,
+            llm_settings,
+            self._current_attend.progress_record_bid,
+            "",
+            check,
+        )
+        # Check if the generator yields any content (not None)
+        has_content = False
+        for i in res:
+            if i is not None and i != "":
+                self.app.logger.info(f"check_text_with_llm_response: {i}")
+                has_content = True
+                yield RunMarkdownFlowDTO(
+                    outline_bid=run_script_info.outline_bid,
+                    generated_block_bid=generated_block.generated_block_bid,
+                    type=GeneratedType.CONTENT,
+                    content=i,
+                )
+
+        if has_content:
+            self._can_continue = False
+            yield RunMarkdownFlowDTO(
+                outline_bid=run_script_info.outline_bid,
+                generated_block_bid=generated_block.generated_block_bid,
+                type=GeneratedType.BREAK,
+                content="",
+            )
+            yield RunMarkdownFlowDTO(
+                outline_bid=run_script_info.outline_bid,
+                generated_block_bid=generated_block.generated_block_bid,
+                type=GeneratedType.INTERACTION,
+                content=block.content,
+            )
+        return has_content
+
+    def _stream_content_block(
+        self,
+        app: Flask,
+        mdflow: MarkdownFlow,
+        run_script_info: RunScriptInfo,
+        user_profile: dict,
+        llm_settings: LLMSettings,
+        system_prompt: str,
+    ) -> Generator[str, None, None]:
+        """
+        Stream the text of a content block
+        the block is taken from the prefetched blocks when it was started
+        while the previous block streamed, and the following content blocks
+        are prefetched in turn.
+        Args:
+            app: Flask application
+            mdflow: MarkdownFlow with the llm provider of the run
+            run_script_info: Run script info
+            user_profile: Variables of the learner
+            llm_settings: LLM settings of the outline
+            system_prompt: System prompt of the outline
+        Returns:
+            Generator[str, None, None]: Text chunks
+        """
+        prefetched = self._prefetched_blocks.pop(
+            (run_script_info.outline_bid, run_script_info.block_position), None
+        )
+        if prefetched is not None:
+            res = prefetched[0]
+        else:
+            res = self._open_content_block(
+                app,
+                mdflow,
+                run_script_info.parsed_mdflow,
+                run_script_info.block_position,
+                user_profile,
+                llm_settings,
+                system_prompt,
+            )
+        depth = app.config.get("RUN_SCRIPT_PREFETCH_DEPTH", 0)
+        blocks = run_script_info.parsed_mdflow.blocks
+        for block_position in range(
+            run_script_info.block_position + 1,
+            min(run_script_info.block_position + 1 + depth, len(blocks)),
+        ):
+            # content blocks only depend on the variables, which are only
+            # changed by interactions, so the blocks up to the next
+            # interaction can be generated ahead
+            if blocks[block_position].block_type == BlockType.INTERACTION:
+                break
+            key = (run_script_info.outline_bid, block_position)
+            if key in self._prefetched_blocks:
+                continue
+            self._prefetched_blocks[key] = self._open_content_block(
+                app,
+                mdflow,
+                run_script_info.parsed_mdflow,
+                block_position,
+                user_profile,
+                llm_settings,
+                system_prompt,
+                prefetch=True,
+            )
+        return res
+
+    def _open_content_block(
+        self,
+        app: Flask,
+        mdflow: MarkdownFlow,
+        parsed_mdflow: ParsedMdflow,
+        block_position: int,
+        user_profile: dict,
+        llm_settings: LLMSettings,
+        system_prompt: str,
+        prefetch: bool = False,
+    ):
+        """
+        Open the text stream of a content block
+        a course with a generation cache policy replays a cached generation
+        of the same prompt when there is one, and caches new generations.
+        Args:
+            app: Flask application
+            mdflow: MarkdownFlow with the llm provider of the run
+            parsed_mdflow: Parsed mdflow of the outline
+            block_position: Block index
+            user_profile: Variables of the learner
+            llm_settings: LLM settings of the outline
+            system_prompt: System prompt of the outline
+            prefetch: start the generation now and buffer it
+        Returns:
+            Generator[str, None, None]: Text chunks, with prefetch a tuple of
+            the text chunks and the PrefetchedAsyncGenerator to close
+        """
+        block = parsed_mdflow.blocks[block_position]
+        cache_key = None
+        policy = get_generation_cache_policy(self._outline_item_info.shifu_bid)
+        if (
+            policy.enabled
+            and not self._preview_mode
+            and block.block_type == BlockType.CONTENT
+        ):
+            block_variables = parsed_mdflow.get_block_variables(block_position)
+            cache_key = make_generation_cache_key(
+                block.content,
+                {key: user_profile.get(key) for key in block_variables},
+                system_prompt,
+                llm_settings.model,
+                llm_settings.temperature,
+            )
+            cached = get_cached_generation(app, cache_key, policy)
+            if cached is not None:
+                res = replay_generation(cached)
+                return (res, None) if prefetch else res
+        stream = stream_mdflow_block(
+            mdflow,
+            block_position,
+            variables=user_profile,
+            user_input=None if prefetch else self._input,
+        )
+        handle = None
+        if prefetch:
+            handle = prefetch_async_generator(stream)
+            res = handle.iterate()
+        else:
+            res = iter_async_generator(stream)
+        if cache_key:
+            res = record_generation(app, res, cache_key, policy)
+        return (res, handle) if prefetch else res
+
+    def close(self):
+        """
+        Stop the generations prefetched for blocks the run did not reach
+        """
+        prefetched_blocks = self._prefetched_blocks
+        self._prefetched_blocks = {}
+        for res, handle in prefetched_blocks.values():
+            if handle is not None:
+                handle.close()
+
     def has_next(self) -> bool:
         return self._can_continue
 
-    def get_system_prompt(self, outline_item_bid: str) -> str:
-        path = find_node_with_parents(self._struct, outline_item_bid)
-        path = list(reversed(path))
-        outline_ids = [item.id for item in path if item.type == "outline"]
-        shifu_ids = [item.id for item in path if item.type == "shifu"]
-        outline_item_info_db: Union[DraftOutlineItem, PublishedOutlineItem] = (
-            self._outline_model.query.filter(
-                self._outline_model.id.in_(outline_ids),
-                self._outline_model.deleted == 0,
-            ).all()
-        )
-        outline_item_info_map: dict[
-            str, Union[DraftOutlineItem, PublishedOutlineItem]
-        ] = {o.id: o for o in outline_item_info_db}
-        for id in outline_ids:
-            outline_item_info = outline_item_info_map.get(id, None)
-            if outline_item_info and outline_item_info.llm_system_prompt:
-                return outline_item_info.llm_system_prompt
-        shifu_info_db: Union[DraftShifu, PublishedShifu] = (
-            self._shifu_model.query.filter(
-                self._shifu_model.id.in_(shifu_ids),
-                self._shifu_model.deleted == 0,
-            ).first()
+    def _get_outline_llm_settings(self, outline_bid: str) -> CourseBundleLLMSettings:
+        if self._bundle:
+            return self._bundle.get_llm_settings(outline_bid)
+        return get_outline_llm_settings(
+            self.app, self._outline_item_info.shifu_bid, outline_bid, self._preview_mode
         )
-        if shifu_info_db and shifu_info_db.llm_system_prompt:
-            return shifu_info_db.llm_system_prompt
-        return None
+
+    def get_system_prompt(self, outline_item_bid: str) -> str:
+        return self._get_outline_llm_settings(outline_item_bid).system_prompt
 
     def get_llm_settings(self, outline_bid: str) -> LLMSettings:
-        path = find_node_with_parents(self._struct, outline_bid)
-        path.reverse()
-        outline_ids = [item.id for item in path if item.type == "outline"]
-        shifu_ids = [item.id for item in path if item.type == "shifu"]
-        outline_item_info_db: Union[DraftOutlineItem, PublishedOutlineItem] = (
-            self._outline_model.query.filter(
-                self._outline_model.id.in_(outline_ids),
-                self._outline_model.deleted == 0,
-            ).all()
-        )
-        outline_item_info_map = {o.id: o for o in outline_item_info_db}
-        for id in outline_ids:
-            outline_item_info = outline_item_info_map.get(id, None)
-            if outline_item_info and outline_item_info.llm:
-                return LLMSettings(
-                    model=outline_item_info.llm,
-                    temperature=outline_item_info.llm_temperature,
-                )
-        shifu_info_db: Union[DraftShifu, PublishedShifu] = (
-            self._shifu_model.query.filter(
-                self._shifu_model.id.in_(shifu_ids),
-                self._shifu_model.deleted == 0,
-            ).first()
-        )
-        if shifu_info_db and shifu_info_db.llm:
+        llm_settings = self._get_outline_llm_settings(outline_bid)
+        if llm_settings.model:
             return LLMSettings(
-                model=shifu_info_db.llm, temperature=shifu_info_db.llm_temperature
+                model=llm_settings.model, temperature=llm_settings.temperature
             )
         return self._get_default_llm_settings()
 
@@ -39,7 +39,7 @@ from flaskr.service.user.models import User
 from flaskr.service.shifu.shifu_struct_manager import (
     get_shifu_outline_tree,
     get_outline_item_dto,
-    get_shifu_struct,
+    get_shifu_struct_index,
     ShifuInfoDto,
     ShifuOutlineItemDto,
     HistoryItem,
@@ -55,7 +55,7 @@ from flaskr.service.shifu.adapter import (
 )
 from flaskr.service.shifu.consts import BLOCK_TYPE_CONTENT
 import queue
-from flaskr.service.shifu.struct_utils import find_node_with_parents
+from flaskr.service.shifu.struct_utils import StructIndex
 from flaskr.service.learn.output.handle_output_continue import _handle_output_continue
 from flaskr.service.order.models import Order
 
@@ -274,44 +274,24 @@ def get_study_record(
         if not shifu_info:
             return ret
         ret.teacher_avatar = shifu_info.avatar
-        shifu_struct: HistoryItem = get_shifu_struct(
+        struct_index: StructIndex = get_shifu_struct_index(
             app, outline_item.shifu_bid, preview_mode
         )
-        if not shifu_struct:
+        if not struct_index:
             return ret
 
-        q = queue.Queue()
-        q.put(shifu_struct)
-        lesson_info: HistoryItem = None
-        while not q.empty():
-            item: HistoryItem = q.get()
-            if item.bid == lesson_id:
-                lesson_info = item
-                break
-            if item.children:
-                for child in item.children:
-                    q.put(child)
+        lesson_info: HistoryItem = struct_index.get_node(lesson_id)
         if not lesson_info:
             return ret
 
-        q = queue.Queue()
-        q.put(lesson_info)
         lesson_ids = []
         lesson_outline_map = {}
         outline_block_map = {}
-        while not q.empty():
-            item: HistoryItem = q.get()
-            if item.type == "outline":
-                lesson_ids.append(item.bid)
-            if item.children:
-                if item.children[0].type == "outline":
-                    for child in item.children:
-                        q.put(child)
-                else:
-                    lesson_outline_map[item.bid] = [
-                        block.bid for block in item.children
-                    ]
-                    outline_block_map[item.bid] = [block.bid for block in item.children]
+        for item in struct_index.get_outline_items(lesson_id):
+            lesson_ids.append(item.bid)
+            if item.children and item.children[0].type != "outline":
+                lesson_outline_map[item.bid] = [block.bid for block in item.children]
+                outline_block_map[item.bid] = [block.bid for block in item.children]
 
         if not lesson_ids:
             return ret
@@ -461,27 +441,19 @@ def reset_user_study_info_by_lesson(
         if not outline_item:
             app.logger.info("lesson_info not found")
             return False
-        struct: HistoryItem = get_shifu_struct(
+        struct_index: StructIndex = get_shifu_struct_index(
             app, outline_item.shifu_bid, preview_mode
         )
+        struct: HistoryItem = struct_index.root
 
-        current_path = find_node_with_parents(struct, outline_item.bid)
-        lesson_ids = set()
+        current_path = struct_index.get_path(outline_item.bid)
         if not current_path or len(current_path) < 2:
             app.logger.info("current_path not found")
             return False
         root_outline_item: HistoryItem = current_path[1]
-        q = queue.Queue()
-        q.put(root_outline_item)
-        first_lesson_ids = []
-        while not q.empty():
-            item: HistoryItem = q.get()
-            if item.type == "outline":
-                lesson_ids.add(item.bid)
-
-            if item.children and item.children[0].type == "outline":
-                for child in item.children:
-                    q.put(child)
+        lesson_ids = set(
+            item.bid for item in struct_index.get_outline_items(root_outline_item.bid)
+        )
 
         first_lesson_ids = set()
         first_lesson_ids.add(root_outline_item.bid)
@@ -0,0 +1,248 @@
+"""
+Generation cache
+
+This module contains the cross learner cache of generated content blocks.
+
+A content block sends the same prompt to the llm for every learner unless
+it references learner variables, so its output can be shared. The cache key
+is built from everything the llm sees: the block content, the values of the
+variables the block references, the system prompt, the model and the
+temperature.
+
+The policy is set per course:
+- never: every learner gets a new generation (default)
+- reuse: the first generation is replayed to everyone
+- pool:N: up to N generations are kept, once the pool is full a random one
+  is replayed, so learners do not all read the same text
+
+Generations are kept in redis as a list of variants, each variant stores the
+chunks with the delay they arrived after, so a replay is streamed at the
+pace of the original generation.
+"""
+
+import hashlib
+import json
+import random
+import threading
+import time
+import zlib
+from functools import lru_cache
+from typing import Generator, Optional
+
+from flask import Flask
+
+from flaskr.common.config import get_config
+from flaskr.dao import redis_client as redis
+
+GENERATION_CACHE_POLICY_NEVER = "never"
+GENERATION_CACHE_POLICY_REUSE = "reuse"
+GENERATION_CACHE_POLICY_POOL = "pool"
+
+# a replayed chunk waits at most MAX_REPLAY_DELAY seconds
+MAX_REPLAY_DELAY = 0.1
+
+_stats_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "saves": 0}
+
+
+class GenerationCachePolicy:
+    """
+    Generation cache policy of a course
+    """
+
+    mode: str
+    pool_size: int
+
+    def __init__(self, mode: str, pool_size: int = 1):
+        self.mode = mode
+        self.pool_size = pool_size
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != GENERATION_CACHE_POLICY_NEVER
+
+
+def _parse_policy(value: str) -> GenerationCachePolicy:
+    value = (value or "").strip().lower()
+    if value == GENERATION_CACHE_POLICY_REUSE:
+        return GenerationCachePolicy(GENERATION_CACHE_POLICY_REUSE)
+    if value.startswith(GENERATION_CACHE_POLICY_POOL + ":"):
+        pool_size = value.split(":", 1)[1]
+        if pool_size.isdigit() and int(pool_size) > 0:
+            return GenerationCachePolicy(GENERATION_CACHE_POLICY_POOL, int(pool_size))
+    return GenerationCachePolicy(GENERATION_CACHE_POLICY_NEVER)
+
+
+@lru_cache(maxsize=16)
+def _parse_shifu_policies(value: str) -> dict[str, GenerationCachePolicy]:
+    policies = {}
+    for item in (value or "").split(","):
+        if "=" not in item:
+            continue
+        shifu_bid, policy = item.split("=", 1)
+        policies[shifu_bid.strip()] = _parse_policy(policy)
+    return policies
+
+
+def get_generation_cache_policy(shifu_bid: str) -> GenerationCachePolicy:
+    """
+    Get the generation cache policy of a course
+    Args:
+        shifu_bid: Shifu bid
+    Returns:
+        GenerationCachePolicy: the course policy, or the default one
+    """
+    policies = _parse_shifu_policies(get_config("GENERATION_CACHE_SHIFU_POLICIES"))
+    policy = policies.get(shifu_bid, None)
+    if policy is None:
+        policy = _parse_policy(get_config("GENERATION_CACHE_POLICY"))
+    return policy
+
+
+def make_generation_cache_key(
+    block_content: str,
+    variables: dict,
+    system_prompt: str,
+    model: str,
+    temperature: float,
+) -> str:
+    """
+    Make the cache key of a content block generation
+    Args:
+        block_content: Content of the mdflow block
+        variables: Values of the variables referenced by the block
+        system_prompt: Resolved system prompt
+        model: LLM model
+        temperature: LLM temperature
+    Returns:
+        str: Cache key
+    """
+    payload = json.dumps(
+        [block_content, variables, system_prompt or "", model, temperature],
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return (
+        get_config("REDIS_KEY_PREFIX")
+        + "generation_cache:"
+        + hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    )
+
+
+def _count(name: str):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def get_cached_generation(
+    app: Flask, key: str, policy: GenerationCachePolicy
+) -> Optional[list]:
+    """
+    Get a cached generation to replay
+    Args:
+        app: Flask application
+        key: Cache key
+        policy: Generation cache policy of the course
+    Returns:
+        Optional[list]: [chunk, delay] pairs, None when a new generation
+        is needed
+    """
+    if redis is None or not policy.enabled:
+        return None
+    try:
+        if policy.mode == GENERATION_CACHE_POLICY_POOL:
+            variants = redis.lrange(key, 0, policy.pool_size - 1)
+            # the pool is filled before it is reused
+            value = (
+                random.choice(variants) if len(variants) >= policy.pool_size else None
+            )
+        else:
+            value = redis.lindex(key, 0)
+    except Exception as e:
+        app.logger.warning(f"get generation cache failed: {e}")
+        return None
+    if value is None:
+        _count("misses")
+        return None
+    _count("hits")
+    return json.loads(zlib.decompress(value).decode("utf-8"))
+
+
+def save_generation(app: Flask, key: str, policy: GenerationCachePolicy, chunks: list):
+    """
+    Save a completed generation as a variant of the key
+    Args:
+        app: Flask application
+        key: Cache key
+        policy: Generation cache policy of the course
+        chunks: [chunk, delay] pairs of the generation
+    """
+    if redis is None or not policy.enabled or not chunks:
+        return
+    value = zlib.compress(json.dumps(chunks, ensure_ascii=False).encode("utf-8"))
+    try:
+        pipeline = redis.pipeline()
+        pipeline.lpush(key, value)
+        pipeline.ltrim(key, 0, policy.pool_size - 1)
+        pipeline.expire(key, get_config("GENERATION_CACHE_EXPIRE", 604800))
+        pipeline.execute()
+        _count("saves")
+    except Exception as e:
+        app.logger.warning(f"save generation cache failed: {e}")
+
+
+def record_generation(
+    app: Flask,
+    chunks: Generator[str, None, None],
+    key: str,
+    policy: GenerationCachePolicy,
+) -> Generator[str, None, None]:
+    """
+    Pass the chunks of a generation through and cache it once complete
+    an interrupted generation is not cached.
+    Args:
+        app: Flask application
+        chunks: Chunks of the llm stream
+        key: Cache key
+        policy: Generation cache policy of the course
+    Returns:
+        Generator[str, None, None]: the same chunks
+    """
+    recorded = []
+    last = time.monotonic()
+    try:
+        for chunk in chunks:
+            now = time.monotonic()
+            recorded.append([chunk, round(min(now - last, MAX_REPLAY_DELAY), 3)])
+            last = now
+            yield chunk
+    finally:
+        chunks.close()
+    save_generation(app, key, policy, recorded)
+
+
+def replay_generation(chunks: list) -> Generator[str, None, None]:
+    """
+    Replay a cached generation at the pace it was generated
+    Args:
+        chunks: [chunk, delay] pairs of the generation
+    Returns:
+        Generator[str, None, None]: Text chunks
+    """
+    for chunk, delay in chunks:
+        if delay > 0:
+            time.sleep(delay)
+        yield chunk
+
+
+def get_generation_cache_stats() -> dict:
+    """
+    Get the generation cache statistics of the worker
+    Returns:
+        dict: hits, misses, saves and hit rate
+    """
+    with _stats_lock:
+        stats = dict(_stats)
+    total = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = stats["hits"] / total if total else 0.0
+    return stats
@@ -0,0 +1,163 @@
+"""
+Generation stream
+
+This module keeps the output of an in-flight generation in a redis stream,
+so a learner who loses the connection can resume the block.
+
+Every generated block being streamed appends its text to the stream
+generation_stream:<generated_block_bid>, the first entry carries the owner
+and the last one the end marker. A reconnecting client replays the cached
+text from its offset and then follows the live tail until the end marker,
+the block is not sent to the llm again.
+"""
+
+import time
+from typing import Generator, Optional
+
+from flask import Flask
+
+from flaskr.common.config import get_config
+from flaskr.dao import redis_client as redis
+
+GENERATION_STREAM_END_COMPLETED = "completed"
+GENERATION_STREAM_END_INTERRUPTED = "interrupted"
+
+# text is appended at most every WRITE_INTERVAL seconds
+WRITE_INTERVAL = 0.05
+# a follower stops when the writer is silent for IDLE_TIMEOUT seconds
+IDLE_TIMEOUT = 30
+
+
+def _get_stream_key(generated_block_bid: str) -> str:
+    return get_config("REDIS_KEY_PREFIX") + "generation_stream:" + generated_block_bid
+
+
+def _get_stream_expire() -> int:
+    return get_config("GENERATION_STREAM_EXPIRE", 600)
+
+
+def _decode(value) -> str:
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    return value
+
+
+class GenerationStreamWriter:
+    """
+    Append the text of a generated block to its generation stream
+    """
+
+    def __init__(
+        self,
+        app: Flask,
+        generated_block_bid: str,
+        user_bid: str,
+        outline_bid: str,
+    ):
+        self.app = app
+        self.key = _get_stream_key(generated_block_bid)
+        self.user_bid = user_bid
+        self.outline_bid = outline_bid
+        self._pending: list[str] = []
+        self._last_write = time.monotonic()
+        self._started = False
+        self._closed = False
+
+    def append(self, text: str):
+        """
+        Append text to the stream, the text is written in batches
+        Args:
+            text: generated text
+        """
+        if redis is None or self._closed:
+            return
+        self._pending.append(text)
+        now = time.monotonic()
+        if now - self._last_write >= WRITE_INTERVAL:
+            self._write()
+            self._last_write = now
+
+    def close(self, end: str = GENERATION_STREAM_END_COMPLETED):
+        """
+        Write the pending text and the end marker
+        Args:
+            end: how the generation ended
+        """
+        if redis is None or self._closed:
+            return
+        self._closed = True
+        self._write({"e": end})
+
+    def _write(self, fields: Optional[dict] = None):
+        entry = dict(fields or {})
+        if self._pending:
+            entry["c"] = "".join(self._pending)
+            self._pending = []
+        if not entry:
+            return
+        if not self._started:
+            entry["u"] = self.user_bid
+            entry["o"] = self.outline_bid
+        try:
+            pipeline = redis.pipeline()
+            pipeline.xadd(self.key, entry)
+            if not self._started or "e" in entry:
+                pipeline.expire(self.key, _get_stream_expire())
+            pipeline.execute()
+            self._started = True
+        except Exception as e:
+            # the stream only serves resumes, the generation goes on without it
+            self.app.logger.warning(f"generation stream write failed: {e}")
+            self._closed = True
+
+
+def read_generation_stream(
+    app: Flask,
+    generated_block_bid: str,
+    user_bid: str,
+    offset: int = 0,
+) -> Generator[str, None, Optional[str]]:
+    """
+    Read the text of a generation from offset and follow it until it ends
+    the cached text is yielded as one chunk, then every new entry as it
+    is written.
+    Args:
+        app: Flask application
+        generated_block_bid: generated block bid
+        user_bid: user bid, the stream is only readable by its owner
+        offset: count of characters the client already has
+    Returns:
+        Generator[str, None, Optional[str]]: text chunks, the generator
+        returns how the generation ended, or None if there is no stream
+    """
+    if redis is None:
+        return None
+    key = _get_stream_key(generated_block_bid)
+    entries = redis.xrange(key)
+    if not entries or _decode(entries[0][1].get(b"u")) != user_bid:
+        return None
+    position = 0
+    last_id = "0"
+    idle_since = time.monotonic()
+    while True:
+        texts = []
+        end = None
+        for entry_id, fields in entries:
+            last_id = entry_id
+            text = _decode(fields.get(b"c")) or ""
+            if position + len(text) > offset:
+                texts.append(text[max(offset - position, 0) :])
+            position += len(text)
+            if b"e" in fields:
+                end = _decode(fields[b"e"])
+        if texts:
+            yield "".join(texts)
+            idle_since = time.monotonic()
+        if end is not None:
+            return end
+        if time.monotonic() - idle_since >= IDLE_TIMEOUT:
+            # the writer is gone without an end marker (eg. worker restart)
+            app.logger.warning(f"generation stream idle: {generated_block_bid}")
+            return GENERATION_STREAM_END_INTERRUPTED
+        result = redis.xread({key: last_id}, block=1000)
+        entries = result[0][1] if result else []
@@ -1,3 +1,4 @@
+import time
 from typing import Generator
 from flask import Flask
 from flaskr.api.llm import chat_llm
@@ -12,19 +13,23 @@ from flaskr.service.learn.utils import (
     get_fmt_prompt,
 )
 from flaskr.service.profile.funcs import get_user_profiles
-from flaskr.service.llm.funcs import format_script_prompt
+from flaskr.service.learn.ask_context import build_ask_context, get_ask_system_message
 from flaskr.dao import db
 from flaskr.service.learn.input_funcs import (
     BreakException,
     check_text_with_llm_response,
     generation_attend,
 )
+from flaskr.api.check import CHECK_RESULT_REJECT
+from flaskr.service.check_risk import hold_until_checked, start_check_text
 from flaskr.service.user.models import User
 from flaskr.service.lesson.const import UI_TYPE_ASK
-from flaskr.service.shifu.shifu_struct_manager import ShifuOutlineItemDto
+from flaskr.service.shifu.shifu_struct_manager import (
+    ShifuOutlineItemDto,
+    get_outline_llm_settings,
+)
 from flaskr.service.shifu.adapter import BlockDTO
 from langfuse.client import StatefulTraceClient
-from flaskr.service.learn.context import RunScriptContext
 
 
 @register_shifu_input_handler("ask")
@@ -48,12 +53,17 @@ def _handle_input_ask(
 
     # Get follow-up information (including Q&A prompts and model configuration)
     follow_up_info = get_follow_up_info(
-        app, outline_item_info.shifu_bid, block_dto, attend_id, is_preview
+        app,
+        outline_item_info.shifu_bid,
+        block_dto,
+        attend_id,
+        is_preview,
+        outline_bid=outline_item_info.bid,
     )
 
-    context = RunScriptContext.get_current_context(app)
     app.logger.info("follow_up_info:{}".format(follow_up_info.__json__()))
 
+    started = time.perf_counter()
     raw_ask_max_history_len = app.config.get("ASK_MAX_HISTORY_LEN", 10)
     try:
         ask_max_history_len = int(raw_ask_max_history_len)
@@ -72,64 +82,55 @@ def _handle_input_ask(
 
     history_scripts = history_scripts[::-1]
 
-    messages = []  # List to store conversation messages
     input = input.replace("{", "{{").replace(
         "}", "}}"
     )  # Escape braces to avoid formatting conflicts
-    system_prompt_template = context.get_system_prompt(outline_item_info)
-    system_prompt = (
-        None
-        if system_prompt_template is None or system_prompt_template == ""
-        else get_fmt_prompt(
-            app,
-            user_info.user_id,
-            outline_item_info.shifu_bid,
-            system_prompt_template,
-        )
-    )
+    system_prompt_template = get_outline_llm_settings(
+        app, outline_item_info.shifu_bid, outline_item_info.bid, is_preview
+    ).system_prompt
 
     # Obtain user configuration information to replace system variables
     user_profiles = get_user_profiles(
         app, user_info.user_id, outline_item_info.shifu_bid
     )
 
-    # Format the system prompt and replace the variables within it
-    system_message = (
-        format_script_prompt(system_prompt, user_profiles) if system_prompt else ""
-    )
-
-    # Format shifu Q&A prompt, insert system prompt
-    system_message = follow_up_info.ask_prompt.replace(
-        "{shifu_system_message}", system_message
+    # Format the system prompt into the shifu Q&A prompt, cached per profiles
+    system_message = get_ask_system_message(
+        app,
+        user_info.user_id,
+        outline_item_info.shifu_bid,
+        follow_up_info.ask_prompt,
+        system_prompt_template,
+        user_profiles,
     )
-    messages.append({"role": "system", "content": system_message})  # Add system message
 
-    # Add historical conversation records to system messages
+    # Historical conversation records
+    history = []
     for script in history_scripts:
         if script.role == ROLE_STUDENT:
-            messages.append(
+            history.append(
                 {"role": "user", "content": script.generated_content}
             )  # Add user message
         elif script.role == ROLE_TEACHER:
-            messages.append(
+            history.append(
                 {"role": "assistant", "content": script.generated_content}
             )  # Add assistant message
 
     # RAG retrieval has been removed from this system
 
-    messages.append(
-        {
-            "role": "user",
-            "content": input,
-        }
-    )
-    app.logger.info(f"messages: {messages}")
-
     # Get model for follow-up Q&A
     follow_up_model = follow_up_info.ask_model
     if not follow_up_model:
         follow_up_model = app.config.get("DEFAULT_LLM_MODEL", "")
 
+    # Keep the history within the token budget of the ask
+    ask_context = build_ask_context(
+        app, system_message, history, input, follow_up_model, started
+    )
+    messages = ask_context.messages
+    app.logger.info(f"messages: {messages}")
+    app.logger.info(f"ask context: {ask_context.report()}")
+
     # Log user input to database
     log_script: LearnGeneratedBlock = generation_attend(
         app, user_info, attend_id, outline_item_info, block_dto
@@ -140,8 +141,15 @@ def _handle_input_ask(
     log_script.position = last_position
     db.session.add(log_script)
 
+    # Moderate the input in the background, in speculative mode the LLM is
+    # requested meanwhile and its output held back until the input passes
+    check = start_check_text(
+        app, log_script.generated_block_bid, input, user_info.user_id
+    )
+    speculative = app.config.get("CHECK_TEXT_SPECULATIVE", False)
+
     # Create trace span
-    span = trace.span(name="user_follow_up", input=input)
+    span = trace.span(name="user_follow_up", input=input, metadata=ask_context.report())
 
     # Format prompt for content checking
     prompt = get_fmt_prompt(
@@ -165,18 +173,20 @@ def _handle_input_ask(
         attend_id,
         prompt,
         last_position,
+        check,
     )
 
-    try:
-        # If check result is not empty, return check result directly
-        first_value = next(res)
-        app.logger.info("check_text_by_edun is not None")
-        yield first_value
-        yield from res
-        db.session.flush()
-        raise BreakException  # Throw break exception to end processing
-    except StopIteration:
-        app.logger.info("check_text_by_edun is None ,invoke_llm")
+    if not speculative:
+        try:
+            # If check result is not empty, return check result directly
+            first_value = next(res)
+            app.logger.info("check_text_by_edun is not None")
+            yield first_value
+            yield from res
+            db.session.flush()
+            raise BreakException  # Throw break exception to end processing
+        except StopIteration:
+            app.logger.info("check_text_by_edun is None ,invoke_llm")
 
     # Call LLM to generate response
     resp = chat_llm(
@@ -197,6 +207,8 @@ def _handle_input_ask(
         + str(outline_item_info.bid),
         messages=messages,  # Pass complete conversation history
     )
+    if speculative:
+        resp = hold_until_checked(check, resp)
 
     response_text = ""  # Store complete response text
     # Stream process LLM response
@@ -213,6 +225,18 @@ def _handle_input_ask(
                 log_script.generated_block_bid,
             )
 
+    if speculative:
+        verdict = check.result()
+        if verdict.check_result == CHECK_RESULT_REJECT:
+            # The LLM stream was cancelled, answer the rejected input instead,
+            # the check result is traced while answering
+            app.logger.info("check_text rejected, llm response dropped")
+            yield from res
+            db.session.flush()
+            raise BreakException
+        # The check answer is not run when the input passes, trace the result here
+        span.event(name="check_text", input=input, output=verdict)
+
     # Log AI response to database
     log_script = generation_attend(
         app, user_info, attend_id, outline_item_info, block_dto
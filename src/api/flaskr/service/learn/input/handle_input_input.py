@@ -183,6 +183,7 @@ def _handle_input_input(
         + str(block_dto.bid)
         + "_",
         temperature=model_setting.temperature,
+        cache=True,
     )
     response_text = ""
     check_success = False
@@ -1,16 +1,14 @@
 import time
+from concurrent.futures import Future
+from typing import Optional
 
 from flask import Flask
 
 from flaskr.service.learn.models import LearnGeneratedBlock
 from flaskr.api.llm import invoke_llm
-from flaskr.api.check import (
-    check_text,
-    CHECK_RESULT_PASS,
-    CHECK_RESULT_REJECT,
-)
+from flaskr.api.check import CHECK_RESULT_REJECT
 from flaskr.service.learn.utils import generation_attend
-from flaskr.service.check_risk import add_risk_control_result
+from flaskr.service.check_risk import start_check_text
 from flaskr.service.learn.const import (
     ROLE_TEACHER,
 )
@@ -37,20 +35,15 @@ def check_text_with_llm_response(
     attend_id: str,
     fmt_prompt: str,
     last_position: int = -1,
+    check: Optional[Future] = None,
 ):
-    res = check_text(app, log_script.generated_block_bid, input, user_info.user_id)
+    # the check may have been started along the llm request by the caller
+    if check is None:
+        check = start_check_text(
+            app, log_script.generated_block_bid, input, user_info.user_id
+        )
+    res = check.result()
     span.event(name="check_text", input=input, output=res)
-    add_risk_control_result(
-        app,
-        log_script.generated_block_bid,
-        user_info.user_id,
-        input,
-        res.provider,
-        res.check_result,
-        str(res.raw_data),
-        1 if res.check_result == CHECK_RESULT_PASS else 0,
-        "check_text",
-    )
     context = RunScriptContext.get_current_context(app)
 
     if res.check_result == CHECK_RESULT_REJECT:
@@ -85,6 +78,7 @@ def check_text_with_llm_response(
             + str(block_dto.bid)
             + "_"
             + str(outline_item_info.bid),
+            cache=True,
             **{"temperature": model_setting.temperature},
         )
         response_text = ""
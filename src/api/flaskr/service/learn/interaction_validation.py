@@ -0,0 +1,86 @@
+"""
+Interaction validation
+
+This module contains the local validation of interaction inputs.
+
+A learner clicking one of the buttons of an interaction sends back the
+button value or label, the input is known to be valid and the variable is
+set without asking the llm. Only free text goes through the llm validation
+of MarkdownFlow.
+"""
+
+import threading
+from typing import Optional
+
+from markdown_flow.utils import InteractionType
+
+VALIDATION_LOCAL = "local"
+VALIDATION_LLM = "llm"
+
+_stats_lock = threading.Lock()
+_stats: dict[str, dict[str, int]] = {}
+
+
+def _get_interaction_type(parsed_interaction: dict) -> str:
+    interaction_type = parsed_interaction.get("type", None)
+    if isinstance(interaction_type, InteractionType):
+        return interaction_type.value
+    return str(interaction_type)
+
+
+def validate_interaction_input(
+    parsed_interaction: dict, user_input: str
+) -> Optional[dict[str, str]]:
+    """
+    Validate the input of an interaction without the llm
+    the input is accepted when it is one of the declared buttons, buttons
+    whose label or value reference a variable are left to MarkdownFlow.
+    Args:
+        parsed_interaction: Result of InteractionParser.parse
+        user_input: User input
+    Returns:
+        Optional[dict[str, str]]: Variables to save, empty for a button that
+        sets no variable, None when the input needs the llm validation
+    """
+    if not user_input or "error" in parsed_interaction:
+        return None
+    user_input = user_input.strip()
+    for button in parsed_interaction.get("buttons", None) or []:
+        display = button.get("display", "")
+        value = button.get("value", "")
+        if "{{" in display or "{{" in value:
+            continue
+        if user_input in (display, value):
+            variable = parsed_interaction.get("variable", None)
+            return {variable: value} if variable else {}
+    return None
+
+
+def record_interaction_validation(parsed_interaction: dict, validation: str):
+    """
+    Count an interaction validation
+    Args:
+        parsed_interaction: Result of InteractionParser.parse
+        validation: VALIDATION_LOCAL or VALIDATION_LLM
+    """
+    interaction_type = _get_interaction_type(parsed_interaction)
+    with _stats_lock:
+        counts = _stats.setdefault(
+            interaction_type, {VALIDATION_LOCAL: 0, VALIDATION_LLM: 0}
+        )
+        counts[validation] += 1
+
+
+def get_interaction_validation_stats() -> dict:
+    """
+    Get the interaction validation statistics of the worker
+    Returns:
+        dict: local and llm validations per interaction type, with the
+        share of llm calls avoided
+    """
+    with _stats_lock:
+        stats = {key: dict(value) for key, value in _stats.items()}
+    for counts in stats.values():
+        total = counts[VALIDATION_LOCAL] + counts[VALIDATION_LLM]
+        counts["avoided_rate"] = counts[VALIDATION_LOCAL] / total if total else 0.0
+    return stats
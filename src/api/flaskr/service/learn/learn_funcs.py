@@ -18,14 +18,16 @@ from flaskr.service.shifu.models import (
     DraftShifu,
     PublishedShifu,
     DraftOutlineItem,
-    PublishedOutlineItem,
-    LogDraftStruct,
-    LogPublishedStruct,
 )
 from flaskr.service.learn.models import LearnProgressRecord, LearnGeneratedBlock
 from flaskr.service.common import raise_error
 from flaskr.service.shifu.utils import get_shifu_res_url
 from flaskr.service.shifu.shifu_history_manager import HistoryItem
+from flaskr.service.shifu.shifu_struct_manager import get_shifu_struct_index
+from flaskr.service.shifu.shifu_bundle import (
+    CourseBundleOutlineItem,
+    get_course_bundle,
+)
 from flaskr.service.order.models import Order, BannerInfo
 from flaskr.i18n import _
 from flaskr.service.order.consts import (
@@ -36,7 +38,6 @@ from flaskr.service.order.consts import (
     LEARN_STATUS_COMPLETED,
     LEARN_STATUS_RESET,
 )
-import queue
 from flaskr.dao import db
 from flaskr.service.lesson.const import LESSON_TYPE_NORMAL
 from flaskr.service.shifu.consts import (
@@ -81,13 +82,8 @@ def get_outline_item_tree(
         is_paid = preview_mode
         if preview_mode:
             outline_item_model = DraftOutlineItem
-            struct_model = LogDraftStruct
             shifu_model = DraftShifu
-        else:
-            outline_item_model = PublishedOutlineItem
-            struct_model = LogPublishedStruct
-            shifu_model = PublishedShifu
-        if not is_paid:
+            bundle = None
             shifu = (
                 shifu_model.query.filter(
                     shifu_model.shifu_bid == shifu_bid, shifu_model.deleted == 0
@@ -97,6 +93,11 @@ def get_outline_item_tree(
             )
             if not shifu:
                 raise_error("SHIFU.SHIFU_NOT_FOUND")
+        else:
+            # the published shifu, struct and outline items come from the bundle
+            bundle = get_course_bundle(app, shifu_bid)
+            shifu = bundle.shifu
+        if not is_paid:
             if shifu.price == 0:
                 is_paid = True
             else:
@@ -113,32 +114,20 @@ def get_outline_item_tree(
                     is_paid = False
                 else:
                     is_paid = True
-        struct = (
-            struct_model.query.filter(
-                struct_model.shifu_bid == shifu_bid, struct_model.deleted == 0
-            )
-            .order_by(struct_model.id.desc())
-            .first()
-        )
-        if not struct:
-            raise_error("SHIFU.SHIFU_STRUCT_NOT_FOUND")
-        struct = HistoryItem.from_json(struct.struct)
-        outline_items: list[HistoryItem] = []
-        q = queue.Queue()
-        q.put(struct)
-        while not q.empty():
-            item: HistoryItem = q.get()
-            if item.type == "outline":
-                outline_items.append(item)
-            if item.children:
-                for child in item.children:
-                    q.put(child)
-        outline_items_ids = [i.id for i in outline_items]
+        if bundle:
+            struct_index = bundle.struct_index
+        else:
+            struct_index = get_shifu_struct_index(app, shifu_bid, preview_mode)
+        struct = struct_index.root
+        outline_items: list[HistoryItem] = struct_index.get_outline_items()
         outline_items_bids = [i.bid for i in outline_items]
-        outline_items_dbs = outline_item_model.query.filter(
-            outline_item_model.id.in_(outline_items_ids),
-            outline_item_model.deleted == 0,
-        ).all()
+        if bundle:
+            outline_items_dbs = list(bundle.outline_items.values())
+        else:
+            outline_items_dbs = outline_item_model.query.filter(
+                outline_item_model.id.in_([i.id for i in outline_items]),
+                outline_item_model.deleted == 0,
+            ).all()
         progress_records = LearnProgressRecord.query.filter(
             LearnProgressRecord.user_bid == user_bid,
             LearnProgressRecord.shifu_bid == shifu_bid,
@@ -150,15 +139,17 @@ def get_outline_item_tree(
             i.outline_item_bid: i for i in progress_records
         }
 
+        outline_items_db_map: dict[int, DraftOutlineItem | CourseBundleOutlineItem] = {
+            i.id: i for i in outline_items_dbs
+        }
+
         def build_outline_item_tree(item: HistoryItem):
-            outline_item: DraftOutlineItem | PublishedOutlineItem = next(
-                (i for i in outline_items_dbs if i.id == item.id), None
+            outline_item: DraftOutlineItem | CourseBundleOutlineItem = (
+                outline_items_db_map.get(item.id, None)
             )
             if not outline_item or outline_item.hidden == 1:
                 return None
-            progress_record = progress_records_map.get(
-                outline_item.outline_item_bid, None
-            )
+            progress_record = progress_records_map.get(item.bid, None)
             if not progress_record:
                 if is_paid:
                     status = LEARN_STATUS_NOT_STARTED
@@ -169,7 +160,7 @@ def get_outline_item_tree(
             else:
                 status = progress_record.status
             outline_item_info = LearnOutlineItemInfoDTO(
-                bid=outline_item.outline_item_bid,
+                bid=item.bid,
                 position=outline_item.position,
                 title=outline_item.title,
                 status=STATUS_MAP.get(status, LearnStatus.LOCKED),
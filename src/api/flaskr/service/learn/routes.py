@@ -9,7 +9,7 @@ from flaskr.service.learn.learn_funcs import (
     handle_reaction,
     reset_learn_record,
 )
-from flaskr.service.learn.runscript_v2 import run_script
+from flaskr.service.learn.runscript_v2 import resume_run_script, run_script
 
 
 @inject
@@ -170,6 +170,60 @@ def register_learn_routes(app: Flask, path_prefix: str = "/api/learn") -> Flask:
             app.logger.error(e)
             return make_common_response(e)
 
+    @app.route(
+        path_prefix
+        + "/shifu/<shifu_bid>/run/<outline_bid>/resume/<generated_block_bid>",
+        methods=["GET"],
+    )
+    def resume_outline_item_api(
+        shifu_bid: str, outline_bid: str, generated_block_bid: str
+    ):
+        """
+        resume the stream of a generated block after a reconnect
+        ---
+        tags:
+            - learn
+        parameters:
+            - name: shifu_bid
+              type: string
+              required: true
+            - name: outline_bid
+              type: string
+              required: true
+            - name: generated_block_bid
+              type: string
+              required: true
+            - in: query
+              name: offset
+              type: integer
+              required: false
+              description: count of characters of the block already received
+        responses:
+            200:
+                description: resume the stream of the generated block success
+                content:
+                    text/event-stream:
+                        schema:
+                            $ref: "#/components/schemas/RunMarkdownFlowDTO"
+        """
+        user_bid = request.user.user_id
+        offset = request.args.get("offset", 0, type=int)
+        try:
+            return Response(
+                resume_run_script(
+                    app=app,
+                    user_bid=user_bid,
+                    outline_bid=outline_bid,
+                    generated_block_bid=generated_block_bid,
+                    offset=max(offset, 0),
+                ),
+                headers={"Cache-Control": "no-cache"},
+                mimetype="text/event-stream",
+            )
+        except Exception as e:
+            app.logger.error(e)
+            return make_common_response(e)
+
     @app.route(
         path_prefix + "/shifu/<shifu_bid>/records/<outline_bid>", methods=["GET"]
     )
@@ -1,15 +1,21 @@
+import contextvars
 import traceback
-from typing import Generator
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Callable, Generator
 from flask import Flask
 
 from flaskr.service.common.models import AppException, raise_error
 from flaskr.service.user.models import User
 from flaskr.i18n import _
 import json
+import time
+from json.encoder import encode_basestring
+from pydantic import BaseModel
 
 
 from flaskr.service.learn.learn_dtos import RunMarkdownFlowDTO
 from flaskr.dao import db, redis_client
+from flaskr.util import generate_id
 from flaskr.service.learn.utils import (
     make_script_dto,
 )
@@ -19,13 +25,16 @@ from flaskr.service.shifu.shifu_struct_manager import (
     ShifuInfoDto,
     ShifuOutlineItemDto,
     get_default_shifu_dto,
-    get_shifu_struct,
+    get_shifu_struct_index,
 )
+from flaskr.service.shifu.shifu_bundle import get_course_bundle
 from flaskr.service.shifu.shifu_history_manager import HistoryItem
 from flaskr.service.order.models import Order
 from flaskr.service.order.consts import ORDER_STATUS_SUCCESS
 from flaskr.service.learn.context_v2 import RunScriptContextV2
 from flaskr.service.learn.input_funcs import BreakException
+from flaskr.service.learn.generation_stream import read_generation_stream
+from flaskr.service.learn.models import LearnGeneratedBlock
 from flaskr.service.learn.learn_dtos import GeneratedType
 import datetime
 
@@ -39,11 +48,13 @@ def run_script_inner(
     input_type: str = None,
     reload_generated_block_bid: str = None,
     preview_mode: bool = False,
+    is_cancelled: Callable[[], bool] = None,
 ) -> Generator[RunMarkdownFlowDTO, None, None]:
     """
     Core function for running course scripts
     """
     with app.app_context():
+        run_script_context: RunScriptContextV2 = None
         try:
             user_info = User.query.filter(User.user_id == user_bid).first()
             shifu_info: ShifuInfoDto = None
@@ -67,7 +78,14 @@ def run_script_inner(
                 if not shifu_info:
                     raise_error("LESSON.COURSE_NOT_FOUND")
 
-            struct_info = get_shifu_struct(app, shifu_info.bid, preview_mode)
+            if preview_mode:
+                bundle = None
+                struct_index = get_shifu_struct_index(app, shifu_bid, preview_mode)
+            else:
+                # one fetch for the published struct, settings and lesson mdflow
+                bundle = get_course_bundle(app, shifu_bid, outline_bid)
+                struct_index = bundle.struct_index
+            struct_info = struct_index.root
             if not struct_info:
                 raise_error("LESSON.SHIFU_NOT_FOUND")
             if not outline_item_info:
@@ -94,14 +112,17 @@ def run_script_inner(
             else:
                 is_paid = True
 
-            run_script_context: RunScriptContextV2 = RunScriptContextV2(
+            run_script_context = RunScriptContextV2(
                 app=app,
                 shifu_info=shifu_info,
                 struct=struct_info,
+                struct_index=struct_index,
+                bundle=bundle,
                 outline_item_info=outline_item_info,
                 user_info=user_info,
                 is_paid=is_paid,
                 preview_mode=preview_mode,
+                is_cancelled=is_cancelled,
             )
 
             run_script_context.set_input(input, input_type)
@@ -110,13 +131,59 @@ def run_script_inner(
                 db.session.commit()
             while run_script_context.has_next():
                 yield from run_script_context.run(app)
+            run_script_context.flush()
             db.session.commit()
         except BreakException:
+            if run_script_context:
+                run_script_context.flush()
             db.session.commit()
             app.logger.info("BreakException")
         except GeneratorExit:
-            db.session.rollback()
+            # keep the blocks completed before the client went away
+            if run_script_context:
+                run_script_context.flush()
+                db.session.commit()
+            else:
+                db.session.rollback()
             app.logger.info("GeneratorExit")
+        finally:
+            if run_script_context:
+                run_script_context.close()
+
+
+RUN_SCRIPT_CANCEL_CHECK_INTERVAL = 0.2
+
+
+class RunCancellation:
+    """
+    Tells whether a run was taken over by a newer run of the same user
+    the newest run writes its bid to run_script_run:<user>, the running one
+    compares it at most every RUN_SCRIPT_CANCEL_CHECK_INTERVAL seconds.
+    """
+
+    def __init__(self, app: Flask, user_bid: str):
+        self.key = app.config.get("REDIS_KEY_PREFIX") + ":run_script_run:" + user_bid
+        self.run_bid = generate_id(app)
+        self._last_check = time.monotonic()
+        self._cancelled = False
+
+    def start(self, timeout: int):
+        redis_client.set(self.key, self.run_bid, ex=timeout)
+
+    def is_cancelled(self) -> bool:
+        if self._cancelled:
+            return True
+        now = time.monotonic()
+        if now - self._last_check < RUN_SCRIPT_CANCEL_CHECK_INTERVAL:
+            return False
+        self._last_check = now
+        current_run_bid = redis_client.get(self.key)
+        if isinstance(current_run_bid, bytes):
+            current_run_bid = current_run_bid.decode("utf-8")
+        self._cancelled = (
+            current_run_bid is not None and current_run_bid != self.run_bid
+        )
+        return self._cancelled
 
 
 def fmt(o):
@@ -126,6 +193,147 @@ def fmt(o):
         return o.__json__()
 
 
+_sse_encoder = json.JSONEncoder(ensure_ascii=False, default=fmt)
+
+
+def _encode_sse_value(value) -> str:
+    if isinstance(value, str):
+        return encode_basestring(value)
+    return _sse_encoder.encode(value)
+
+
+def make_run_script_frame(item: RunMarkdownFlowDTO) -> str:
+    """
+    Serialize a run script item to a SSE frame
+    Args:
+        item: the item yielded by run_script_inner
+    Returns:
+        str: the SSE frame, same payload as json.dumps(item, default=fmt)
+    """
+    if not isinstance(item, RunMarkdownFlowDTO):
+        return "data: " + _sse_encoder.encode(item) + "\n\n"
+    content = item.content
+    if isinstance(content, BaseModel):
+        content = content.__json__()
+    return (
+        'data: {"outline_bid": '
+        + _encode_sse_value(item.outline_bid)
+        + ', "generated_block_bid": '
+        + _encode_sse_value(item.generated_block_bid)
+        + ', "type": "'
+        + item.type.value
+        + '", "content": '
+        + _encode_sse_value(content)
+        + "}\n\n"
+    )
+
+
+def _merge_content(items: list[RunMarkdownFlowDTO]) -> RunMarkdownFlowDTO:
+    if len(items) == 1:
+        return items[0]
+    return RunMarkdownFlowDTO(
+        outline_bid=items[0].outline_bid,
+        generated_block_bid=items[0].generated_block_bid,
+        type=GeneratedType.CONTENT,
+        content="".join(i.content for i in items),
+    )
+
+
+_END = object()
+
+
+def coalesce_run_script_stream(
+    items: Generator[RunMarkdownFlowDTO, None, None],
+    window_ms: int,
+    max_chars: int,
+) -> Generator[RunMarkdownFlowDTO, None, None]:
+    """
+    Merge the content chunks of a run into fewer items
+    Chunks arriving within window_ms of the last sent item are held back and
+    merged until the window passes or max_chars is reached, so slow streams
+    are sent chunk by chunk and fast streams in batches. Any other item type,
+    or content of another block, sends the pending chunks first.
+    The items are read by a worker, one at a time, so the pending chunks are
+    sent when the window passes even if the next item is slow to come. The
+    worker reads and closes the items in a copy of the caller context, as the
+    items may keep an app context open between two items.
+    Args:
+        items: the items yielded by run_script_inner
+        window_ms: coalescing window in milliseconds, 0 to disable
+        max_chars: max characters merged into one item
+    Returns:
+        Generator[RunMarkdownFlowDTO, None, None]: the merged items
+    """
+    if window_ms <= 0:
+        yield from items
+        return
+    window = window_ms / 1000
+    context = contextvars.copy_context()
+    executor = ThreadPoolExecutor(max_workers=1)
+    future = None
+    pending: list[RunMarkdownFlowDTO] = []
+    pending_chars = 0
+    last_sent = time.monotonic()
+    try:
+        while True:
+            if future is None:
+                future = executor.submit(context.run, next, items, _END)
+            try:
+                item = future.result(
+                    timeout=max(last_sent + window - time.monotonic(), 0)
+                    if pending
+                    else None
+                )
+            except FutureTimeoutError:
+                # the next item is late, send what the learner should see
+                yield _merge_content(pending)
+                pending = []
+                pending_chars = 0
+                last_sent = time.monotonic()
+                continue
+            future = None
+            if item is _END:
+                break
+            if item.type == GeneratedType.CONTENT and isinstance(item.content, str):
+                if pending and (
+                    pending[0].generated_block_bid != item.generated_block_bid
+                    or pending[0].outline_bid != item.outline_bid
+                ):
+                    yield _merge_content(pending)
+                    pending = []
+                    pending_chars = 0
+                pending.append(item)
+                pending_chars += len(item.content)
+                now = time.monotonic()
+                if pending_chars >= max_chars or now - last_sent >= window:
+                    yield _merge_content(pending)
+                    pending = []
+                    pending_chars = 0
+                    last_sent = now
+                continue
+            if pending:
+                yield _merge_content(pending)
+                pending = []
+                pending_chars = 0
+            yield item
+            last_sent = time.monotonic()
+        if pending:
+            yield _merge_content(pending)
+    finally:
+        # the items can not be closed while an item is read
+        if future is not None:
+            try:
+                future.result()
+            except Exception:
+                pass
+        close = getattr(items, "close", None)
+        try:
+            if close is not None:
+                executor.submit(context.run, close).result()
+        finally:
+            executor.shutdown()
+
+
 def run_script(
     app: Flask,
     shifu_bid: str,
@@ -137,12 +345,18 @@ def run_script(
     preview_mode: bool = False,
 ) -> Generator[str, None, None]:
     timeout = 5 * 60
-    blocking_timeout = 1
+    blocking_timeout = 3
     lock_key = app.config.get("REDIS_KEY_PREFIX") + ":run_script:" + user_bid
+    # the newest run of a user wins, an in-flight run sees the new run bid at
+    # its next chunk, stops and releases the lock
+    cancellation = RunCancellation(app, user_bid)
+    cancellation.start(timeout)
     lock = redis_client.lock(
         lock_key, timeout=timeout, blocking_timeout=blocking_timeout
     )
     if lock.acquire(blocking=True):
+        res = None
+        stream = None
         try:
             res = run_script_inner(
                 app=app,
@@ -153,13 +367,18 @@ def run_script(
                 input_type=input_type,
                 reload_generated_block_bid=reload_generated_block_bid,
                 preview_mode=preview_mode,
+                is_cancelled=cancellation.is_cancelled,
             )
-            for item in res:
-                yield (
-                    "data: "
-                    + json.dumps(item, default=fmt, ensure_ascii=False)
-                    + "\n\n".encode("utf-8").decode("utf-8")
-                )
+            stream = coalesce_run_script_stream(
+                res,
+                app.config.get("RUN_SCRIPT_STREAM_COALESCE_MS", 0),
+                app.config.get("RUN_SCRIPT_STREAM_COALESCE_CHARS", 200),
+            )
+            for item in stream:
+                yield make_run_script_frame(item)
+                if cancellation.is_cancelled():
+                    app.logger.info(f"run_script cancelled: {cancellation.run_bid}")
+                    break
         except Exception as e:
             app.logger.error("run_script error")
             app.logger.error(e)
@@ -171,54 +390,99 @@ def run_script(
 
             if isinstance(e, AppException):
                 app.logger.info(error_info)
-                yield (
-                    "data: "
-                    + json.dumps(
-                        RunMarkdownFlowDTO(
-                            outline_bid=outline_bid,
-                            generated_block_bid="",
-                            type=GeneratedType.CONTENT,
-                            content=str(e),
-                        ),
-                        default=fmt,
-                        ensure_ascii=False,
+                yield make_run_script_frame(
+                    RunMarkdownFlowDTO(
+                        outline_bid=outline_bid,
+                        generated_block_bid="",
+                        type=GeneratedType.CONTENT,
+                        content=str(e),
                     )
-                    + "\n\n".encode("utf-8").decode("utf-8")
                 )
             else:
                 app.logger.error(error_info)
-                yield (
-                    "data: "
-                    + json.dumps(
-                        RunMarkdownFlowDTO(
-                            outline_bid=outline_bid,
-                            generated_block_bid="",
-                            type=GeneratedType.CONTENT,
-                            content=str(_("COMMON.UNKNOWN_ERROR")),
-                        ),
-                        default=fmt,
-                        ensure_ascii=False,
-                    )
-                    + "\n\n".encode("utf-8").decode("utf-8")
-                )
-            yield (
-                "data: "
-                + json.dumps(
+                yield make_run_script_frame(
                     RunMarkdownFlowDTO(
                         outline_bid=outline_bid,
                         generated_block_bid="",
-                        type=GeneratedType.BREAK,
-                        content=None,
-                    ),
-                    default=fmt,
-                    ensure_ascii=False,
+                        type=GeneratedType.CONTENT,
+                        content=str(_("COMMON.UNKNOWN_ERROR")),
+                    )
+                )
+            yield make_run_script_frame(
+                RunMarkdownFlowDTO(
+                    outline_bid=outline_bid,
+                    generated_block_bid="",
+                    type=GeneratedType.BREAK,
+                    content="",
                 )
-                + "\n\n".encode("utf-8").decode("utf-8")
             )
         finally:
+            # a disconnect or a new run stops the generation here: closing the
+            # run closes the llm stream and persists the generated output
+            # before the lock is handed to the next run
+            if stream is not None:
+                stream.close()
+            if res is not None:
+                res.close()
             lock.release()
         return
     else:
         app.logger.warning("lockfail")
         yield make_script_dto("text_end", "", None)
     return
+
+
+def resume_run_script(
+    app: Flask,
+    user_bid: str,
+    outline_bid: str,
+    generated_block_bid: str,
+    offset: int = 0,
+) -> Generator[str, None, None]:
+    """
+    Resume the stream of a generated block after a reconnect
+    the text after offset is replayed from the generation stream, then the
+    live tail is followed until the generation ends, without a new llm call.
+    a block which is no longer streamed is read from the database.
+    Args:
+        app: Flask application
+        user_bid: user bid
+        outline_bid: outline bid
+        generated_block_bid: generated block bid of the interrupted stream
+        offset: count of characters the client already has
+    Returns:
+        Generator[str, None, None]: SSE frames, ended by a break
+    """
+    with app.app_context():
+
+        def make_frame(type: GeneratedType, content: str) -> str:
+            return make_run_script_frame(
+                RunMarkdownFlowDTO(
+                    outline_bid=outline_bid,
+                    generated_block_bid=generated_block_bid,
+                    type=type,
+                    content=content,
+                )
+            )
+
+        stream = read_generation_stream(app, generated_block_bid, user_bid, offset)
+        while True:
+            try:
+                text = next(stream)
+            except StopIteration as e:
+                end = e.value
+                break
+            yield make_frame(GeneratedType.CONTENT, text)
+        if end is None:
+            generated_block = LearnGeneratedBlock.query.filter(
+                LearnGeneratedBlock.generated_block_bid == generated_block_bid,
+                LearnGeneratedBlock.user_bid == user_bid,
+                LearnGeneratedBlock.status == 1,
+                LearnGeneratedBlock.deleted == 0,
+            ).first()
+            if generated_block and len(generated_block.generated_content) > offset:
+                yield make_frame(
+                    GeneratedType.CONTENT,
+                    generated_block.generated_content[offset:],
+                )
+        yield make_frame(GeneratedType.BREAK, "")
@@ -1,14 +1,10 @@
 import datetime
 import json
 import re
-from typing import Union
 from flaskr.service.common.models import raise_error
 from flask import Flask
 from flaskr.util.uuid import generate_id
-from ...service.lesson.const import (
-    ASK_MODE_DEFAULT,
-    ASK_MODE_DISABLE,
-)
+from ...service.lesson.const import ASK_MODE_DISABLE
 from ...service.lesson.models import AICourse, AILesson, AILessonScript
 from ...service.profile.funcs import get_user_profiles
 from ...service.learn.dtos import ScriptDTO
@@ -20,15 +16,10 @@ from flaskr.service.shifu.dtos import LabelDTO
 from flaskr.service.shifu.shifu_struct_manager import ShifuOutlineItemDto
 from flaskr.service.shifu.adapter import BlockDTO
 from flaskr.service.shifu.consts import BLOCK_TYPE_VALUES
-from flaskr.service.shifu.shifu_struct_manager import get_shifu_struct
-from flaskr.service.shifu.struct_utils import find_node_with_parents
-from flaskr.service.shifu.models import (
-    PublishedOutlineItem,
-    PublishedShifu,
-    DraftOutlineItem,
-    DraftShifu,
+from flaskr.service.shifu.shifu_struct_manager import (
+    get_outline_ask_settings,
+    get_shifu_struct_index,
 )
-from flaskr.service.shifu.shifu_history_manager import HistoryItem
 
 
 def generation_attend(
@@ -296,6 +287,7 @@ def get_follow_up_info(
     block_dto: BlockDTO,
     attend_id: str,
     is_preview: bool = False,
+    outline_bid: str = None,
 ) -> FollowUpInfo:
     """
     Get follow up info.
@@ -308,13 +300,19 @@ def get_follow_up_info(
         is_preview (bool, optional): Whether to retrieve the follow up info in preview mode.
             If True, retrieves data as it would appear in preview (unpublished) state; if False,
             retrieves data as it appears in the published state. Defaults to False.
+        outline_bid (str, optional): The outline item business ID, when not given
+            the outline item of the block is looked up in the shifu struct.
 
     Returns:
         FollowUpInfo: The follow up information for the given parameters.
     """
-    struct_info = get_shifu_struct(app, shifu_bid, is_preview)
-    path = find_node_with_parents(struct_info, block_dto.bid)
-    if not path:
+    if not outline_bid and block_dto:
+        struct_index = get_shifu_struct_index(app, shifu_bid, is_preview)
+        path = struct_index.get_path(block_dto.bid)
+        outline_path = [p for p in path if p.type == "outline"]
+        if outline_path:
+            outline_bid = outline_path[-1].bid
+    if not outline_bid:
         return FollowUpInfo(
             ask_model="",
             ask_prompt="",
@@ -323,51 +321,14 @@ def get_follow_up_info(
             model_args={"temperature": 0.0},
             ask_mode=ASK_MODE_DISABLE,
         )
-    path = list(reversed(path))
-    path: list[HistoryItem] = [p for p in path if p.type == "outline"]
-    outline_ids = [p.id for p in path]
-    outline_model = PublishedOutlineItem if not is_preview else DraftOutlineItem
-    shifu_model = PublishedShifu if not is_preview else DraftShifu
-    outline_infos: list[Union[PublishedOutlineItem, DraftOutlineItem]] = (
-        outline_model.query.filter(
-            outline_model.id.in_(outline_ids),
-        ).all()
-    )
-    outline_infos_map: dict[str, Union[PublishedOutlineItem, DraftOutlineItem]] = {
-        o.outline_item_bid: o for o in outline_infos
-    }
-
-    for p in path:
-        if p.type == "outline":
-            outline_info = outline_infos_map.get(p.bid, None)
-            if outline_info.ask_enabled_status != ASK_MODE_DEFAULT:
-                return FollowUpInfo(
-                    ask_model=outline_info.ask_llm,
-                    ask_prompt=outline_info.ask_llm_system_prompt,
-                    ask_history_count=10,
-                    ask_limit_count=10,
-                    model_args={"temperature": outline_info.ask_llm_temperature},
-                    ask_mode=outline_info.ask_enabled_status,
-                )
-    shifu_info: Union[PublishedShifu, DraftShifu] = (
-        shifu_model.query.filter(
-            shifu_model.shifu_bid == shifu_bid, shifu_model.deleted == 0
-        )
-        .order_by(shifu_model.id.desc())
-        .first()
-    )
-    ask_model = shifu_info.ask_llm
-    ask_prompt = shifu_info.ask_llm_system_prompt
-    ask_history_count = 10
-    ask_limit_count = 10
-    model_args = {"temperature": shifu_info.ask_llm_temperature}
+    ask_settings = get_outline_ask_settings(app, shifu_bid, outline_bid, is_preview)
     return FollowUpInfo(
-        ask_model,
-        ask_prompt,
-        ask_history_count,
-        ask_limit_count,
-        model_args,
-        shifu_info.ask_enabled_status,
+        ask_model=ask_settings.ask_model,
+        ask_prompt=ask_settings.ask_prompt,
+        ask_history_count=10,
+        ask_limit_count=10,
+        model_args={"temperature": ask_settings.ask_temperature},
+        ask_mode=ask_settings.ask_mode,
     )
 
 
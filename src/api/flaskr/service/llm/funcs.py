@@ -1,14 +1,13 @@
 from flaskr.api.llm import invoke_llm
 from flaskr.api.langfuse import langfuse_client
-from flaskr.service.learn.utils import get_model_setting
 from flaskr.service.learn.utils import extract_variables
 from langchain.prompts import PromptTemplate
 from flaskr.service.common import raise_error
 from flaskr.service.learn.dtos import ScriptDTO
 from flaskr.service.learn.utils import make_script_dto_to_stream
-from flaskr.service.lesson.const import STATUS_PUBLISH, STATUS_DRAFT
 
 from flaskr.service.shifu.models import DraftBlock
+from flaskr.service.shifu.shifu_struct_manager import get_outline_llm_settings
 
 
 def format_script_prompt(script_prompt: str, script_variables: dict) -> str:
@@ -58,18 +57,23 @@ def debug_script(
             trace_args["name"] = "debug"
             trace = langfuse_client.trace(**trace_args)
             app.logger.info(f"debug_script {block_id} ")
-            model_setting = get_model_setting(
-                app, block_info, [STATUS_PUBLISH, STATUS_DRAFT]
+            llm_settings = get_outline_llm_settings(
+                app, block_info.shifu_bid, block_info.outline_item_bid, True
             )
-            app.logger.info(f"model_setting: {model_setting}")
+            app.logger.info(f"llm_settings: {llm_settings}")
             app.logger.info(f"block_model: {block_model}")
             app.logger.info(f"block_temperature: {block_temperature}")
             app.logger.info(f"block_variables: {block_variables}")
             app.logger.info(f"block_other_conf: {block_other_conf}")
             if not block_model or not block_model.strip():
-                block_model = model_setting.model_name
+                block_model = llm_settings.model or app.config.get("DEFAULT_LLM_MODEL")
             if block_temperature is None:
-                block_temperature = model_setting.model_args.get("temperature", 0.8)
+                if llm_settings.model:
+                    block_temperature = llm_settings.temperature
+                else:
+                    block_temperature = float(
+                        app.config.get("DEFAULT_LLM_TEMPERATURE", 0.8)
+                    )
             if block_variables:
                 block_prompt = format_script_prompt(block_prompt, block_variables)
             if block_system_prompt and block_system_prompt.strip():
@@ -90,16 +94,23 @@ def debug_script(
                 system=system_prompt,
                 **{"temperature": block_temperature},
                 generation_name="debug-" + block_id,
+                cache=True,
             )
             for chunk in response:
                 response_text += chunk.result
                 yield make_script_dto_to_stream(
                     ScriptDTO(
-                        "text", chunk.result, block_info.lesson_id, block_id, trace.id
+                        "text",
+                        chunk.result,
+                        block_info.outline_item_bid,
+                        block_id,
+                        trace.id,
                     )
                 )
             yield make_script_dto_to_stream(
-                ScriptDTO("text_end", "", block_info.lesson_id, block_id, trace.id)
+                ScriptDTO(
+                    "text_end", "", block_info.outline_item_bid, block_id, trace.id
+                )
             )
             span.update(output=response_text)
             trace.end()
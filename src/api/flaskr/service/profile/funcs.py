@@ -1,9 +1,12 @@
-from flask import Flask
+import json
+
+from flask import Flask, g, has_app_context
+from sqlalchemy import insert, or_, update
 
 
 from .constants import SYS_USER_LANGUAGE
 from .models import UserProfile
-from ...dao import db
+from ...dao import db, defer_until_commit
 from ..user.models import User
 from ..user.utils import get_user_language
 from ...i18n import _
@@ -15,6 +18,8 @@ from flaskr.api.check import (
     CHECK_RESULT_REJECT,
 )
 from flaskr.util.uuid import generate_id
+from flaskr.common.config import get_config
+from flaskr.dao import redis_client as redis
 from flaskr.service.common import raise_error
 from flaskr.service.profile.profile_manage import get_profile_item_definition_list
 from flaskr.service.profile.models import (
@@ -22,7 +27,7 @@ from flaskr.service.profile.models import (
     PROFILE_TYPE_INPUT_TEXT,
     CONST_PROFILE_TYPE_OPTION,
 )
-from flaskr.service.profile.dtos import ProfileToSave
+from flaskr.service.profile.dtos import ProfileItemDefinition, ProfileToSave
 from flaskr.service.user.dtos import UserProfileLabelDTO, UserProfileLabelItemDTO
 
 _LANGUAGE_BASE_DISPLAY = {
@@ -107,6 +112,168 @@ class UserProfileDTO:
         }
 
 
+class UserProfileSnapshot:
+    """
+    Profiles of a user loaded once per run
+    the profiles are indexed by profile id and by profile key, the profiles
+    of a course are resolved once against its profile item definitions.
+    """
+
+    user_id: str
+    language_code: str
+
+    def __init__(self, user_id: str, rows: list, language_code: str):
+        self.user_id = user_id
+        self.language_code = language_code
+        self._by_id: dict[str, str] = {}
+        self._by_key: dict[str, str] = {}
+        self._definitions: dict[str, list] = {}
+        self._profiles: dict[str, dict] = {}
+        for profile_id, profile_key, profile_value in rows:
+            # the oldest profile wins, as with a scan of the rows
+            if profile_id:
+                self._by_id.setdefault(profile_id, profile_value)
+            self._by_key.setdefault(profile_key, profile_value)
+
+    def get_profiles(self, app: Flask, course_id: str) -> dict:
+        """
+        Get the profiles of the user for a course
+        Args:
+            app: Flask application instance
+            course_id: Course id
+        Returns:
+            dict: User profiles by profile key
+        """
+        profiles = self._profiles.get(course_id, None)
+        if profiles is None:
+            definitions = self._definitions.get(course_id, None)
+            if definitions is None:
+                definitions = get_profile_item_definition_list(app, course_id)
+                self._definitions[course_id] = definitions
+            profiles = {SYS_USER_LANGUAGE: _language_display_value(self.language_code)}
+            for profile_item in definitions:
+                if profile_item.profile_id in self._by_id:
+                    profiles[profile_item.profile_key] = self._by_id[
+                        profile_item.profile_id
+                    ]
+                elif profile_item.profile_key in self._by_key:
+                    profiles[profile_item.profile_key] = self._by_key[
+                        profile_item.profile_key
+                    ]
+            self._profiles[course_id] = profiles
+        # callers add their own keys to the result
+        return dict(profiles)
+
+    def update(self, profile_key: str, profile_id: str, profile_value: str):
+        """
+        Update a profile in place after it is saved
+        Args:
+            profile_key: Profile key
+            profile_id: Profile id
+            profile_value: Profile value
+        """
+        if profile_id:
+            self._by_id[profile_id] = profile_value
+        self._by_key[profile_key] = profile_value
+        self._profiles.clear()
+
+
+def _get_user_profile_cache_key(user_id: str) -> str:
+    return get_config("REDIS_KEY_PREFIX") + "user_profile:" + user_id
+
+
+def _get_run_snapshots() -> dict:
+    if not has_app_context():
+        return {}
+    if "user_profile_snapshots" not in g:
+        g.user_profile_snapshots = {}
+    return g.user_profile_snapshots
+
+
+def _load_user_profile_rows(app: Flask, user_id: str) -> list:
+    key = _get_user_profile_cache_key(user_id)
+    if redis is not None:
+        try:
+            value = redis.get(key)
+            if value is not None:
+                return json.loads(value)
+        except Exception as e:
+            app.logger.warning(f"get user profile cache failed: {e}")
+    rows = [
+        list(row)
+        for row in db.session.query(
+            UserProfile.profile_id, UserProfile.profile_key, UserProfile.profile_value
+        )
+        .filter(UserProfile.user_id == user_id)
+        .order_by(UserProfile.id.asc())
+        .all()
+    ]
+    if redis is not None:
+        try:
+            redis.set(
+                key,
+                json.dumps(rows, ensure_ascii=False),
+                ex=get_config("USER_PROFILE_CACHE_EXPIRE", 3600),
+            )
+        except Exception as e:
+            app.logger.warning(f"set user profile cache failed: {e}")
+    return rows
+
+
+def get_user_profile_snapshot(
+    app: Flask, user_id: str, user_info: User = None
+) -> UserProfileSnapshot:
+    """
+    Get the profile snapshot of a user for the current run
+    the snapshot is loaded once per app context, from redis when cached.
+    Args:
+        app: Flask application instance
+        user_id: User id
+        user_info: User, queried when not given
+    Returns:
+        UserProfileSnapshot: Profile snapshot
+    """
+    snapshots = _get_run_snapshots()
+    snapshot = snapshots.get(user_id, None)
+    if snapshot is None:
+        rows = _load_user_profile_rows(app, user_id)
+        if user_info is None:
+            user_info = User.query.filter(User.user_id == user_id).first()
+        language_code = get_user_language(user_info) if user_info else None
+        snapshot = UserProfileSnapshot(user_id, rows, language_code)
+        snapshots[user_id] = snapshot
+    return snapshot
+
+
+def _delete_user_profile_cache(user_ids):
+    if redis is None:
+        return
+    for user_id in user_ids:
+        try:
+            redis.delete(_get_user_profile_cache_key(user_id))
+        except Exception:
+            # the cache expires on its own
+            pass
+
+
+def invalidate_user_profile_snapshot(user_id: str, keep_run_snapshot: bool = False):
+    """
+    Clear the cached profiles of a user after a write
+    the redis copy is cleared now and again when the session commits, so a
+    concurrent load can not cache the uncommitted state for long.
+    Args:
+        user_id: User id
+        keep_run_snapshot: keep the snapshot of the current run, when it
+        was updated in place
+    """
+    if not keep_run_snapshot:
+        _get_run_snapshots().pop(user_id, None)
+    _delete_user_profile_cache([user_id])
+    defer_until_commit(
+        "user_profile:" + user_id, lambda: _delete_user_profile_cache([user_id])
+    )
+
+
 def get_profile_labels(course_id: str = None):
     # language = get_current_language()
     return {
@@ -201,6 +368,7 @@ def save_user_profile(
                 )
             setattr(user_info, profile_lable["mapping"], profile_value)
     db.session.flush()
+    invalidate_user_profile_snapshot(user_id)
     return UserProfileDTO(
         user_profile.user_id,
         user_profile.profile_key,
@@ -212,15 +380,56 @@ def save_user_profile(
 def save_user_profiles(
     app: Flask, user_id: str, course_id: str, profiles: list[ProfileToSave]
 ) -> bool:
+    """
+    Save user profiles
+    the existing profiles are loaded in one query, the updates and the
+    inserts are each written as one batched statement.
+    Args:
+        app: Flask application instance
+        user_id: User id
+        course_id: Course id
+        profiles: Profiles to save
+    Returns:
+        bool: True
+    """
+    if not profiles:
+        return True
     PROFILES_LABLES = get_profile_labels()
     app.logger.info("save user profiles:{}".format(profiles))
-    user_info = User.query.filter(User.user_id == user_id).first()
-    profiles_items = get_profile_item_definition_list(app, course_id)
-    for profile in profiles:
-        profile_item = next(
-            (item for item in profiles_items if item.profile_key == profile.key), None
+    profile_items: dict[str, ProfileItemDefinition] = {}
+    for item in get_profile_item_definition_list(app, course_id):
+        profile_items.setdefault(item.profile_key, item)
+    profile_ids = [
+        profile_items[p.key].profile_id for p in profiles if p.key in profile_items
+    ]
+    profile_keys = [p.key for p in profiles]
+    user_profiles: list[UserProfile] = (
+        UserProfile.query.filter(
+            UserProfile.user_id == user_id,
+            or_(
+                UserProfile.profile_id.in_(profile_ids),
+                UserProfile.profile_key.in_(profile_keys),
+            ),
         )
-        profile_id = ""
+        .order_by(UserProfile.id.desc())
+        .all()
+    )
+    user_info = None
+    if any(PROFILES_LABLES.get(p.key, {}).get("mapping") for p in profiles):
+        user_info = User.query.filter(User.user_id == user_id).first()
+    # the latest profile of an id, then of a key, is updated
+    profiles_by_id: dict[str, dict] = {}
+    profiles_by_key: dict[str, dict] = {}
+    for user_profile in user_profiles:
+        row = {"id": user_profile.id}
+        if user_profile.profile_id:
+            profiles_by_id.setdefault(user_profile.profile_id, row)
+        profiles_by_key.setdefault(user_profile.profile_key, row)
+    snapshot = _get_run_snapshots().get(user_id, None)
+    updates: dict[int, dict] = {}
+    inserts: list[dict] = []
+    for profile in profiles:
+        profile_item = profile_items.get(profile.key, None)
         if profile_item:
             profile_type = (
                 PROFILE_TYPE_INPUT_SELECT
@@ -232,47 +441,44 @@ def save_user_profiles(
         else:
             profile_type = 1
             profile_id = ""
-        user_profile: UserProfile = (
-            UserProfile.query.filter(
-                UserProfile.user_id == user_id,
-                UserProfile.profile_id == profile_id,
-            )
-            .order_by(UserProfile.id.desc())
-            .first()
+        row = profiles_by_id.get(profile_id, None) if profile_id else None
+        if row is None:
+            row = profiles_by_key.get(profile.key, None)
+        if row is None:
+            row = {"user_id": user_id, "profile_key": profile.key}
+            inserts.append(row)
+        elif "id" in row:
+            updates[row["id"]] = row
+        row.update(
+            profile_value=profile.value,
+            profile_type=profile_type,
+            profile_id=profile_id,
+            status=1,
         )
-        if not user_profile:
-            user_profile: UserProfile = (
-                UserProfile.query.filter(
-                    UserProfile.user_id == user_id,
-                    UserProfile.profile_key == profile.key,
+        if profile_id:
+            profiles_by_id[profile_id] = row
+        profiles_by_key[profile.key] = row
+        if snapshot is not None:
+            snapshot.update(profile.key, profile_id, profile.value)
+        profile_lable = PROFILES_LABLES.get(profile.key, None)
+        if profile_lable and profile_lable.get("mapping") and user_info is not None:
+            if profile_lable.get("items_mapping"):
+                profile.value = profile_lable["items_mapping"].get(
+                    profile.value, profile.value
                 )
-                .order_by(UserProfile.id.desc())
-                .first()
-            )
-        if user_profile:
-            user_profile.profile_value = profile.value
-            user_profile.profile_type = profile_type
-            user_profile.profile_id = profile_id
-            user_profile.status = 1
-        else:
-            user_profile = UserProfile(
-                user_id=user_id,
-                profile_key=profile.key,
-                profile_value=profile.value,
-                profile_type=profile_type,
-                profile_id=profile_id,
-                status=1,
-            )
-            db.session.add(user_profile)
-        if profile.key in PROFILES_LABLES:
-            profile_lable = PROFILES_LABLES[profile.key]
-            if profile_lable.get("mapping"):
-                if profile_lable.get("items_mapping"):
-                    profile.value = profile_lable["items_mapping"].get(
-                        profile.value, profile.value
-                    )
-                setattr(user_info, profile_lable["mapping"], profile.value)
+            setattr(user_info, profile_lable["mapping"], profile.value)
+            if snapshot is not None:
+                snapshot.language_code = get_user_language(user_info)
     db.session.flush()
+    if updates:
+        db.session.execute(update(UserProfile), list(updates.values()))
+        # the loaded rows are refreshed on their next access
+        for user_profile in user_profiles:
+            if user_profile.id in updates:
+                db.session.expire(user_profile)
+    if inserts:
+        db.session.execute(insert(UserProfile), inserts)
+    invalidate_user_profile_snapshot(user_id, keep_run_snapshot=True)
     return True
 
 
@@ -286,35 +492,7 @@ def get_user_profiles(app: Flask, user_id: str, course_id: str) -> dict:
     Returns:
         dict: User profiles
     """
-    profiles_items = get_profile_item_definition_list(app, course_id)
-    user_profiles = UserProfile.query.filter_by(user_id=user_id).all()
-    user_info = User.query.filter(User.user_id == user_id).first()
-    result = {}
-
-    language_code = get_user_language(user_info) if user_info else None
-    result[SYS_USER_LANGUAGE] = _language_display_value(language_code)
-
-    for profile_item in profiles_items:
-        user_profile = next(
-            (
-                item
-                for item in user_profiles
-                if item.profile_id == profile_item.profile_id
-            ),
-            None,
-        )
-        if not user_profile:
-            user_profile = next(
-                (
-                    item
-                    for item in user_profiles
-                    if item.profile_key == profile_item.profile_key
-                ),
-                None,
-            )
-        if user_profile:
-            result[profile_item.profile_key] = user_profile.profile_value
-    return result
+    return get_user_profile_snapshot(app, user_id).get_profiles(app, course_id)
 
 
 def get_user_profile_labels(
@@ -511,6 +689,7 @@ def update_user_profile_with_lable(
                 )
                 db.session.add(user_profile)
         db.session.flush()
+        invalidate_user_profile_snapshot(user_id)
         return True
 
 
@@ -1,3 +1,5 @@
+import threading
+
 from flask import Flask
 from datetime import datetime
 from .models import (
@@ -11,7 +13,10 @@ from .models import (
     PROFILE_CONF_TYPE_PROFILE,
     PROFILE_CONF_TYPE_ITEM,
 )
-from ...dao import db
+from ...dao import db, defer_until_commit
+from flaskr.dao import redis_client as redis
+from flaskr.common.config import get_config
+from flaskr.util.lru_cache import LRUCache
 from flaskr.util.uuid import generate_id
 import json
 from flaskr.service.common import raise_error
@@ -36,6 +41,8 @@ from .models import (
 # from datetime import datetime
 from flaskr.service.lesson.models import AICourse
 
+PROFILE_DEFINITION_CACHE_SIZE = 1024
+
 
 # get color setting
 def get_color_setting(color_setting: str):
@@ -93,6 +100,109 @@ def convert_profile_item_to_profile_item_definition(
     )
 
 
+class _ProfileItemDefinitions:
+    """
+    Profile items of a course with their definitions rendered per language
+    """
+
+    def __init__(self, profile_items: list):
+        self.profile_items = profile_items
+        self._lock = threading.Lock()
+        self._by_language: dict[str, list[ProfileItemDefinition]] = {}
+
+    def get(self, language: str) -> list[ProfileItemDefinition]:
+        definitions = self._by_language.get(language, None)
+        if definitions is None:
+            definitions = [
+                convert_profile_item_to_profile_item_definition(profile_item)
+                for profile_item in self.profile_items
+            ]
+            with self._lock:
+                self._by_language[language] = definitions
+        return definitions
+
+
+_profile_definition_cache = LRUCache(
+    maxsize=PROFILE_DEFINITION_CACHE_SIZE,
+    ttl=int(get_config("PROFILE_DEFINITION_CACHE_EXPIRE") or 300),
+)
+
+
+def _get_profile_definition_version_key(parent_id: str) -> str:
+    return get_config("REDIS_KEY_PREFIX") + "profile_definition_version:" + parent_id
+
+
+def _get_profile_definition_version(parent_id: str) -> tuple:
+    # the system profiles are part of every course
+    if redis is None:
+        return ()
+    try:
+        return tuple(
+            redis.mget(
+                _get_profile_definition_version_key(parent_id),
+                _get_profile_definition_version_key(""),
+            )
+        )
+    except Exception:
+        return ()
+
+
+def _load_profile_item_definitions(parent_id: str) -> _ProfileItemDefinitions:
+    profile_items = (
+        db.session.query(
+            ProfileItem.profile_key,
+            ProfileItem.profile_color_setting,
+            ProfileItem.profile_type,
+            ProfileItem.profile_remark,
+            ProfileItem.parent_id,
+            ProfileItem.profile_id,
+        )
+        .filter(ProfileItem.parent_id.in_([parent_id, ""]), ProfileItem.status == 1)
+        .order_by(ProfileItem.profile_index.asc())
+        .all()
+    )
+    return _ProfileItemDefinitions(profile_items)
+
+
+def _bump_profile_definition_version(parent_ids):
+    for parent_id in parent_ids:
+        _profile_definition_cache.delete_if(
+            lambda key: parent_id == "" or key[0] == parent_id
+        )
+        if redis is None:
+            continue
+        try:
+            redis.incr(_get_profile_definition_version_key(parent_id))
+        except Exception:
+            # the cached definitions expire on their own
+            pass
+
+
+def invalidate_profile_item_definitions(parent_id: str):
+    """
+    Clear the cached profile item definitions of a course
+    the cache is cleared now and again when the session commits, the
+    version kept in redis clears the cache of the other workers.
+    Args:
+        parent_id: Course id, empty for the system profiles
+    """
+    parent_id = parent_id or ""
+    _bump_profile_definition_version([parent_id])
+    defer_until_commit(
+        "profile_definition:" + parent_id,
+        lambda: _bump_profile_definition_version([parent_id]),
+    )
+
+
+def get_profile_definition_cache_stats() -> dict:
+    """
+    Get the profile item definition cache statistics
+    Returns:
+        dict: size, maxsize, hits, misses and hit rate
+    """
+    return _profile_definition_cache.stats()
+
+
 # get profile item definition list
 # type: all, text, option
 # parent_id: scenario_id, profile_id
@@ -101,24 +211,27 @@ def convert_profile_item_to_profile_item_definition(
 def get_profile_item_definition_list(
     app: Flask, parent_id: str, type: str = "all"
 ) -> list[ProfileItemDefinition]:
+    parent_id = parent_id or ""
     with app.app_context():
-        query = ProfileItem.query.filter(
-            ProfileItem.parent_id.in_([parent_id, ""]), ProfileItem.status == 1
-        )
+        key = (parent_id, _get_profile_definition_version(parent_id))
+        profile_item_definitions = _profile_definition_cache.get(key)
+        if profile_item_definitions is None:
+            profile_item_definitions = _load_profile_item_definitions(parent_id)
+            _profile_definition_cache.set(key, profile_item_definitions)
+        definitions = profile_item_definitions.get(get_current_language())
         if type == CONST_PROFILE_TYPE_TEXT:
-            query = query.filter(ProfileItem.profile_type == PROFILE_TYPE_INPUT_TEXT)
+            profile_type = PROFILE_TYPE_INPUT_TEXT
         elif type == CONST_PROFILE_TYPE_OPTION:
-            query = query.filter(ProfileItem.profile_type == PROFILE_TYPE_INPUT_SELECT)
-        elif type == "all":
-            query = query
-        app.logger.info(type)
-        profile_item_list = query.order_by(ProfileItem.profile_index.asc()).all()
-        if profile_item_list:
-            return [
-                convert_profile_item_to_profile_item_definition(profile_item)
-                for profile_item in profile_item_list
-            ]
-        return []
+            profile_type = PROFILE_TYPE_INPUT_SELECT
+        else:
+            return list(definitions)
+        return [
+            definition
+            for profile_item, definition in zip(
+                profile_item_definitions.profile_items, definitions
+            )
+            if profile_item.profile_type == profile_type
+        ]
 
 
 def get_profile_item_definition_option_list(
@@ -166,6 +279,7 @@ def add_profile_item_quick_internal(app: Flask, parent_id: str, key: str, user_i
     profile_item.status = 1
     db.session.add(profile_item)
     db.session.flush()
+    invalidate_profile_item_definitions(parent_id)
     app.logger.info(profile_item.profile_color_setting)
     return convert_profile_item_to_profile_item_definition(profile_item)
 
@@ -336,6 +450,7 @@ def save_profile_item(
                     ProfileItemI18n.id.in_(delete_item_ids),
                     ProfileItemI18n.status == 1,
                 ).update({"status": 0})
+        invalidate_profile_item_definitions(profile_item.parent_id)
         db.session.commit()
         return convert_profile_item_to_profile_item_definition(profile_item)
 
@@ -379,6 +494,7 @@ def update_profile_item(
                 ]
                 profile_item_value.updated_by = user_id
                 profile_item_value.status = 1
+        invalidate_profile_item_definitions(profile_item.parent_id)
         db.session.commit()
         return convert_profile_item_to_profile_item_definition(profile_item)
 
@@ -474,6 +590,7 @@ def delete_profile_item(app: Flask, user_id: str, profile_id: str):
                     "updated": datetime.now(),
                 }
             )
+        invalidate_profile_item_definitions(profile_item.parent_id)
         db.session.commit()
         return True
 
@@ -622,6 +739,7 @@ def save_profile_item_defination(
             ProfileItemValue.status == 1,
         ).update({"status": 0})
         db.session.flush()
+    invalidate_profile_item_definitions(scenario_id)
     return profile_item
 
 
@@ -0,0 +1,127 @@
+"""
+Shifu mdflow cache
+
+This module contains a process level cache of parsed mdflow documents.
+
+Parsing a MarkdownFlow document is pure, so the block list, the variables
+and the interaction parses of an outline are computed once per content
+version and shared by all the learners served by the worker.
+The llm provider is attached per call on a new MarkdownFlow instance,
+so nothing request specific is kept in the cache.
+"""
+
+import hashlib
+import threading
+from typing import Optional
+
+from markdown_flow import (
+    InteractionParser,
+    LLMProvider,
+    MarkdownFlow,
+    extract_variables_from_text,
+)
+from markdown_flow.models import Block
+
+from flaskr.common.config import get_config
+from flaskr.util.lru_cache import LRUCache
+
+
+class ParsedMdflow:
+    """
+    Parsed mdflow document
+    the blocks and the interaction parses are shared, do not modify them.
+    """
+
+    document: str
+    blocks: list[Block]
+    variables: list[str]
+
+    def __init__(self, document: str):
+        self.document = document
+        markdown_flow = MarkdownFlow(document)
+        self.blocks = markdown_flow.get_all_blocks()
+        self.variables = markdown_flow.extract_variables()
+        self._interactions: dict[int, dict] = {}
+        self._block_variables: dict[int, list[str]] = {}
+        self._lock = threading.Lock()
+
+    def get_interaction(self, block_index: int) -> dict:
+        """
+        Get the parsed interaction of a block
+        Args:
+            block_index: Block index
+        Returns:
+            dict: Result of InteractionParser.parse
+        """
+        interaction = self._interactions.get(block_index, None)
+        if interaction is None:
+            interaction = InteractionParser().parse(self.blocks[block_index].content)
+            with self._lock:
+                self._interactions[block_index] = interaction
+        return interaction
+
+    def get_block_variables(self, block_index: int) -> list[str]:
+        """
+        Get the variables referenced by a block
+        Args:
+            block_index: Block index
+        Returns:
+            list[str]: Variable names
+        """
+        variables = self._block_variables.get(block_index, None)
+        if variables is None:
+            variables = extract_variables_from_text(self.blocks[block_index].content)
+            with self._lock:
+                self._block_variables[block_index] = variables
+        return variables
+
+
+_mdflow_cache = LRUCache(maxsize=int(get_config("MDFLOW_CACHE_SIZE") or 512))
+
+
+def get_mdflow_content_hash(document: str) -> str:
+    return hashlib.sha1((document or "").encode("utf-8")).hexdigest()
+
+
+def get_parsed_mdflow(outline_item_id: int, document: str) -> ParsedMdflow:
+    """
+    Get the parsed mdflow of an outline item
+    Args:
+        outline_item_id: Id of the outline item version (draft or published)
+        document: Mdflow content of the outline item
+    Returns:
+        ParsedMdflow: Parsed mdflow
+    """
+    key = (outline_item_id, get_mdflow_content_hash(document))
+    return _mdflow_cache.get_or_set(key, lambda: ParsedMdflow(document or ""))
+
+
+def build_markdown_flow(
+    parsed: ParsedMdflow, llm_provider: Optional[LLMProvider] = None
+) -> MarkdownFlow:
+    """
+    Build a MarkdownFlow with the cached blocks and the given llm provider
+    Args:
+        parsed: Parsed mdflow
+        llm_provider: LLM provider of the current run
+    Returns:
+        MarkdownFlow: MarkdownFlow ready to process
+    """
+    markdown_flow = MarkdownFlow(parsed.document, llm_provider=llm_provider)
+    # MarkdownFlow only parses the document when _blocks is empty,
+    # and copies a block before rendering it, so the list can be shared
+    markdown_flow._blocks = parsed.blocks
+    return markdown_flow
+
+
+def get_mdflow_cache_stats() -> dict:
+    """
+    Get the mdflow cache statistics
+    Returns:
+        dict: size, maxsize, hits, misses and hit rate
+    """
+    return _mdflow_cache.stats()
+
+
+def clear_mdflow_cache():
+    _mdflow_cache.clear()
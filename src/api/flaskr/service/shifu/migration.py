@@ -46,7 +46,10 @@ from flaskr.service.shifu.shifu_history_manager import __save_shifu_history
 from flaskr.service.lesson.const import SCRIPT_TYPE_SYSTEM
 from flaskr.service.lesson.models import AILessonScript
 from flaskr.service.shifu.utils import parse_shifu_res_bid
-from flaskr.service.shifu.shifu_struct_manager import get_shifu_struct
+from flaskr.service.shifu.shifu_struct_manager import (
+    get_shifu_struct,
+    invalidate_shifu_struct_cache,
+)
 from flaskr.service.shifu.block_to_mdflow_adapter import convert_block_to_mdflow
 from flaskr.service.shifu.shifu_block_funcs import (
     generate_block_dto_from_model_internal,
@@ -415,6 +418,7 @@ def migrate_shifu_draft_to_shifu_draft_v2(app, shifu_bid: str):
         shifu_log_published_struct.created_at = now_time
         db.session.add(shifu_log_published_struct)
         db.session.commit()
+        invalidate_shifu_struct_cache(app, shifu_bid)
         plugin_manager.is_enabled = True
 
         # 刷新数据库连接，避免连接超时
@@ -0,0 +1,532 @@
+"""
+Shifu bundle
+
+This module contains the course bundle of a published shifu.
+
+The bundle is an immutable snapshot of a published version: the struct,
+the shifu and outline metadata, the navigation between the outline
+items, the resolved llm settings and system prompt
+of every outline and the resource urls. The ask settings are not part of it,
+they are written to the published version after the bundle is built. It is built when the shifu is
+published (or lazily on first use) and is what the learner runtime reads
+instead of joining the published tables on every request.
+
+The struct logs are append only, so the id of the latest published struct
+log is the version of the bundle. The version of a shifu is shared by the
+workers in redis and written by publish once the new bundle is stored.
+
+In redis a bundle is a hash, the metadata is one field and the mdflow of
+each outline is another one, all zlib compressed. Loading the bundle with
+the mdflow of the current lesson is one HMGET, and its size only depends on
+the count of outline items, not on their content.
+"""
+
+import zlib
+from decimal import Decimal
+from typing import Optional, Union
+
+from flask import Flask
+from pydantic import BaseModel, Field, PrivateAttr
+
+from flaskr.common.config import get_config
+from flaskr.dao import db, redis_client as redis
+from flaskr.service.common import raise_error
+from flaskr.service.shifu.consts import ASK_MODE_DEFAULT, ASK_MODE_DISABLE
+from flaskr.service.shifu.models import (
+    DraftOutlineItem,
+    DraftShifu,
+    LogPublishedStruct,
+    PublishedOutlineItem,
+    PublishedShifu,
+)
+from flaskr.service.shifu.shifu_history_manager import HistoryItem
+from flaskr.service.shifu.struct_utils import StructIndex
+from flaskr.service.shifu.utils import get_shifu_res_url
+from flaskr.util.lru_cache import LRUCache
+
+
+class CourseBundleShifu(BaseModel):
+    """
+    Shifu metadata of a course bundle
+    """
+
+    id: int
+    bid: str
+    title: str
+    description: str
+    avatar: str
+    price: Decimal
+    keywords: str
+
+
+class CourseBundleOutlineItem(BaseModel):
+    """
+    Outline item metadata of a course bundle
+    """
+
+    id: int
+    bid: str
+    title: str
+    position: str
+    type: int
+    hidden: int
+
+
+class CourseBundleLLMSettings(BaseModel):
+    """
+    Resolved llm settings of an outline item
+    inherited from the parent outline items and the shifu,
+    model is None when the default llm should be used.
+    """
+
+    model: Optional[str] = None
+    temperature: Optional[float] = None
+    system_prompt: Optional[str] = None
+
+
+class OutlineAskSettings(BaseModel):
+    """
+    Resolved ask settings of an outline item
+    they come as a whole from the nearest outline item whose ask mode is not
+    the default one, then from the shifu.
+    they are not part of the bundle, the summary of a publish writes the ask
+    prompts and modes of the published version after its bundle is built.
+    """
+
+    ask_model: str = ""
+    ask_temperature: float = 0.0
+    ask_prompt: str = ""
+    ask_mode: int = ASK_MODE_DISABLE
+
+
+class CourseBundleNavigation(BaseModel):
+    """
+    Navigation after an outline item is completed
+    """
+
+    completed: list[str]
+    started: list[str]
+
+
+class CourseBundle(BaseModel):
+    """
+    Course bundle of a published shifu version
+    the bundle is shared by the cache, do not modify it
+    """
+
+    version: int
+    shifu: CourseBundleShifu
+    struct: HistoryItem
+    outline_items: dict[str, CourseBundleOutlineItem]
+    llm_settings: dict[str, CourseBundleLLMSettings]
+    navigation: dict[str, CourseBundleNavigation] = Field(default_factory=dict)
+
+    _struct_index: StructIndex = PrivateAttr(default=None)
+
+    @property
+    def struct_index(self) -> StructIndex:
+        if self._struct_index is None:
+            self._struct_index = StructIndex(self.struct)
+        return self._struct_index
+
+    def get_outline_item(self, outline_bid: str) -> Optional[CourseBundleOutlineItem]:
+        return self.outline_items.get(outline_bid, None)
+
+    def get_llm_settings(self, outline_bid: str) -> CourseBundleLLMSettings:
+        return self.llm_settings.get(outline_bid, None) or CourseBundleLLMSettings()
+
+    def is_hidden(self, outline_bid: str) -> bool:
+        outline_item = self.outline_items.get(outline_bid, None)
+        return not outline_item or outline_item.hidden == 1
+
+    def get_navigation(
+        self, outline_bid: str
+    ) -> tuple[list[HistoryItem], list[HistoryItem]]:
+        """
+        Get the navigation after an outline item is completed
+        Args:
+            outline_bid: Bid of the completed outline item
+        Returns:
+            tuple[list[HistoryItem], list[HistoryItem]]:
+                the completed items and the started items,
+                see StructIndex.get_next_visible_leaf
+        """
+        navigation = self.navigation.get(outline_bid, None)
+        if navigation is None:
+            return self.struct_index.get_next_visible_leaf(outline_bid, self.is_hidden)
+        return (
+            [self.struct_index.get_node(bid) for bid in navigation.completed],
+            [self.struct_index.get_node(bid) for bid in navigation.started],
+        )
+
+
+_course_bundle_cache = LRUCache(
+    maxsize=int(get_config("SHIFU_STRUCT_CACHE_SIZE") or 256)
+)
+_course_bundle_mdflow_cache = LRUCache(
+    maxsize=int(get_config("MDFLOW_CACHE_SIZE") or 512)
+)
+
+# seconds a version read by a learner request is cached, publish sets it for
+# SHIFU_STRUCT_CACHE_EXPIRE
+SHIFU_STRUCT_VERSION_FILL_EXPIRE = 60
+
+BUNDLE_META_FIELD = "meta"
+BUNDLE_MDFLOW_FIELD = "mdflow:"
+
+
+def _get_version_cache_key(shifu_bid: str) -> str:
+    return get_config("REDIS_KEY_PREFIX") + "shifu_struct_version:" + shifu_bid
+
+
+def _get_bundle_cache_key(shifu_bid: str, version: int) -> str:
+    return (
+        get_config("REDIS_KEY_PREFIX")
+        + "course_bundle:"
+        + shifu_bid
+        + ":"
+        + str(version)
+    )
+
+
+def _get_cache_expire() -> int:
+    return int(get_config("SHIFU_STRUCT_CACHE_EXPIRE"))
+
+
+def _compress(value: str) -> bytes:
+    return zlib.compress(value.encode("utf-8"))
+
+
+def _decompress(value: bytes) -> str:
+    return zlib.decompress(value).decode("utf-8")
+
+
+def _query_published_struct_version(app: Flask, shifu_bid: str) -> int:
+    with app.app_context():
+        version = (
+            db.session.query(LogPublishedStruct.id)
+            .filter(
+                LogPublishedStruct.shifu_bid == shifu_bid,
+                LogPublishedStruct.deleted == 0,
+            )
+            .order_by(
+                LogPublishedStruct.id.desc(),
+            )
+            .limit(1)
+            .scalar()
+        )
+    if not version:
+        raise_error("SHIFU.SHIFU_NOT_FOUND")
+    return version
+
+
+def get_published_struct_version(app: Flask, shifu_bid: str) -> int:
+    """
+    Get the version of the latest published shifu struct
+    the version is written by publish, a reader only fills a missing one
+    for a short time, it may have read the struct before a publish commits.
+    Args:
+        app: Flask application instance
+        shifu_bid: Shifu bid
+    Returns:
+        int: Id of the latest published struct log
+    """
+    if redis:
+        version = redis.get(_get_version_cache_key(shifu_bid))
+        if version:
+            return int(version)
+    version = _query_published_struct_version(app, shifu_bid)
+    if redis:
+        redis.set(
+            _get_version_cache_key(shifu_bid),
+            version,
+            ex=SHIFU_STRUCT_VERSION_FILL_EXPIRE,
+            nx=True,
+        )
+    return version
+
+
+def resolve_llm_settings(
+    struct_index: StructIndex,
+    shifu: Union[DraftShifu, PublishedShifu],
+    outline_items: dict[int, Union[DraftOutlineItem, PublishedOutlineItem]],
+) -> dict[str, CourseBundleLLMSettings]:
+    """
+    Resolve the llm settings of every outline item of a struct
+    Args:
+        struct_index: Shifu struct index
+        shifu: Shifu of the struct
+        outline_items: Outline items of the struct by id
+    Returns:
+        dict[str, CourseBundleLLMSettings]: Llm settings by outline bid
+    """
+    llm_settings = {}
+    for item in struct_index.get_outline_items():
+        settings = CourseBundleLLMSettings()
+        # the nearest outline item wins, then the shifu
+        for node in reversed(struct_index.get_path(item.bid)):
+            outline_item = outline_items.get(node.id, None)
+            if node.type != "outline" or not outline_item:
+                continue
+            if settings.model is None and outline_item.llm:
+                settings.model = outline_item.llm
+                settings.temperature = float(outline_item.llm_temperature)
+            if settings.system_prompt is None and outline_item.llm_system_prompt:
+                settings.system_prompt = outline_item.llm_system_prompt
+        if settings.model is None and shifu.llm:
+            settings.model = shifu.llm
+            settings.temperature = float(shifu.llm_temperature)
+        if settings.system_prompt is None and shifu.llm_system_prompt:
+            settings.system_prompt = shifu.llm_system_prompt
+        llm_settings[item.bid] = settings
+    return llm_settings
+
+
+def resolve_ask_settings(
+    struct_index: StructIndex,
+    shifu: Union[DraftShifu, PublishedShifu],
+    outline_items: dict[int, Union[DraftOutlineItem, PublishedOutlineItem]],
+    outline_bid: str,
+) -> OutlineAskSettings:
+    """
+    Resolve the ask settings of an outline item
+    Args:
+        struct_index: Shifu struct index
+        shifu: Shifu of the struct
+        outline_items: Outline items of the path of the outline item by id
+        outline_bid: Outline item bid
+    Returns:
+        OutlineAskSettings: Ask settings
+    """
+    ask_item = shifu
+    for node in reversed(struct_index.get_path(outline_bid)):
+        outline_item = outline_items.get(node.id, None)
+        if node.type != "outline" or not outline_item:
+            continue
+        if outline_item.ask_enabled_status != ASK_MODE_DEFAULT:
+            ask_item = outline_item
+            break
+    return OutlineAskSettings(
+        ask_model=ask_item.ask_llm or "",
+        ask_temperature=float(ask_item.ask_llm_temperature or 0),
+        ask_prompt=ask_item.ask_llm_system_prompt or "",
+        ask_mode=ask_item.ask_enabled_status,
+    )
+
+
+def _build_navigation(bundle: CourseBundle) -> dict[str, CourseBundleNavigation]:
+    navigation = {}
+    for item in bundle.struct_index.get_outline_items():
+        completed, started = bundle.struct_index.get_next_visible_leaf(
+            item.bid, bundle.is_hidden
+        )
+        navigation[item.bid] = CourseBundleNavigation(
+            completed=[i.bid for i in completed],
+            started=[i.bid for i in started],
+        )
+    return navigation
+
+
+def build_course_bundle(
+    app: Flask, shifu_bid: str, version: int
+) -> tuple[CourseBundle, dict[str, str]]:
+    """
+    Build the course bundle of a published version from the database
+    Args:
+        app: Flask application instance
+        shifu_bid: Shifu bid
+        version: Id of the published struct log
+    Returns:
+        tuple[CourseBundle, dict[str, str]]: Bundle and mdflow by outline bid
+    """
+    with app.app_context():
+        app.logger.info(f"build_course_bundle: {shifu_bid} {version}")
+        shifu_struct: LogPublishedStruct = LogPublishedStruct.query.filter(
+            LogPublishedStruct.id == version,
+        ).first()
+        if not shifu_struct:
+            raise_error("SHIFU.SHIFU_NOT_FOUND")
+        struct = HistoryItem.from_json(shifu_struct.struct)
+        struct_index = StructIndex(struct)
+        shifu: PublishedShifu = PublishedShifu.query.filter(
+            PublishedShifu.id == struct.id,
+        ).first()
+        if not shifu:
+            raise_error("SHIFU.SHIFU_NOT_FOUND")
+        outline_items: list[PublishedOutlineItem] = PublishedOutlineItem.query.filter(
+            PublishedOutlineItem.id.in_(
+                [item.id for item in struct_index.get_outline_items()]
+            ),
+        ).all()
+        outline_items_map = {i.id: i for i in outline_items}
+
+        bundle = CourseBundle(
+            version=version,
+            shifu=CourseBundleShifu(
+                id=shifu.id,
+                bid=shifu.shifu_bid,
+                title=shifu.title,
+                description=shifu.description,
+                avatar=get_shifu_res_url(shifu.avatar_res_bid),
+                price=shifu.price,
+                keywords=shifu.keywords or "",
+            ),
+            struct=struct,
+            outline_items={
+                i.outline_item_bid: CourseBundleOutlineItem(
+                    id=i.id,
+                    bid=i.outline_item_bid,
+                    title=i.title,
+                    position=i.position,
+                    type=i.type,
+                    hidden=i.hidden,
+                )
+                for i in outline_items
+            },
+            llm_settings=resolve_llm_settings(struct_index, shifu, outline_items_map),
+        )
+        bundle._struct_index = struct_index
+        bundle.navigation = _build_navigation(bundle)
+        mdflows = {i.outline_item_bid: i.content or "" for i in outline_items}
+        return bundle, mdflows
+
+
+def _save_course_bundle(bundle: CourseBundle, mdflows: dict[str, str]):
+    if not redis:
+        return
+    cache_key = _get_bundle_cache_key(bundle.shifu.bid, bundle.version)
+    mapping = {BUNDLE_META_FIELD: _compress(bundle.model_dump_json())}
+    for outline_bid, mdflow in mdflows.items():
+        mapping[BUNDLE_MDFLOW_FIELD + outline_bid] = _compress(mdflow)
+    pipeline = redis.pipeline()
+    pipeline.hset(cache_key, mapping=mapping)
+    pipeline.expire(cache_key, _get_cache_expire())
+    pipeline.execute()
+
+
+def _cache_course_bundle(bundle: CourseBundle, mdflows: dict[str, str]):
+    shifu_bid = bundle.shifu.bid
+    _course_bundle_cache.set((shifu_bid, bundle.version), bundle)
+    for outline_bid, mdflow in mdflows.items():
+        _course_bundle_mdflow_cache.set(
+            (shifu_bid, bundle.version, outline_bid), mdflow
+        )
+
+
+def publish_course_bundle(app: Flask, shifu_bid: str) -> CourseBundle:
+    """
+    Build and store the course bundle of the latest published version
+    called by publish, the bundle becomes the version read by the workers
+    Args:
+        app: Flask application instance
+        shifu_bid: Shifu bid
+    Returns:
+        CourseBundle: Course bundle
+    """
+    with app.app_context():
+        version = _query_published_struct_version(app, shifu_bid)
+        bundle, mdflows = build_course_bundle(app, shifu_bid, version)
+        _save_course_bundle(bundle, mdflows)
+        # the workers switch to the new version once the bundle is stored
+        if redis:
+            redis.set(
+                _get_version_cache_key(shifu_bid), version, ex=_get_cache_expire()
+            )
+        return bundle
+
+
+def invalidate_course_bundle(app: Flask, shifu_bid: str):
+    """
+    Invalidate the published version of a shifu and its cached bundles
+    Args:
+        app: Flask application instance
+        shifu_bid: Shifu bid
+    """
+    app.logger.info(f"invalidate_course_bundle: {shifu_bid}")
+    if redis:
+        redis.delete(_get_version_cache_key(shifu_bid))
+    _course_bundle_cache.delete_if(lambda key: key[0] == shifu_bid)
+    _course_bundle_mdflow_cache.delete_if(lambda key: key[0] == shifu_bid)
+
+
+def get_course_bundle(
+    app: Flask, shifu_bid: str, outline_bid: str = None
+) -> CourseBundle:
+    """
+    Get the course bundle of the latest published version
+    Args:
+        app: Flask application instance
+        shifu_bid: Shifu bid
+        outline_bid: Outline bid whose mdflow is fetched along with the bundle
+    Returns:
+        CourseBundle: Course bundle
+    """
+    version = get_published_struct_version(app, shifu_bid)
+    bundle = _course_bundle_cache.get((shifu_bid, version))
+    if bundle is not None:
+        return bundle
+    if redis:
+        cache_key = _get_bundle_cache_key(shifu_bid, version)
+        fields = [BUNDLE_META_FIELD]
+        if outline_bid:
+            fields.append(BUNDLE_MDFLOW_FIELD + outline_bid)
+        values = redis.hmget(cache_key, fields)
+        if values[0]:
+            bundle = CourseBundle.model_validate_json(_decompress(values[0]))
+            mdflows = {}
+            if outline_bid and values[1] is not None:
+                mdflows[outline_bid] = _decompress(values[1])
+            _cache_course_bundle(bundle, mdflows)
+            return bundle
+    bundle, mdflows = build_course_bundle(app, shifu_bid, version)
+    _save_course_bundle(bundle, mdflows)
+    _cache_course_bundle(bundle, mdflows)
+    return bundle
+
+
+def get_course_bundle_mdflow(app: Flask, bundle: CourseBundle, outline_bid: str) -> str:
+    """
+    Get the mdflow of an outline item of a course bundle
+    Args:
+        app: Flask application instance
+        bundle: Course bundle
+        outline_bid: Outline bid
+    Returns:
+        str: Mdflow content
+    """
+    cache_key = (bundle.shifu.bid, bundle.version, outline_bid)
+    mdflow = _course_bundle_mdflow_cache.get(cache_key)
+    if mdflow is not None:
+        return mdflow
+    outline_item = bundle.get_outline_item(outline_bid)
+    if not outline_item:
+        raise_error("SHIFU.OUTLINE_ITEM_NOT_FOUND")
+    if redis:
+        value = redis.hget(
+            _get_bundle_cache_key(bundle.shifu.bid, bundle.version),
+            BUNDLE_MDFLOW_FIELD + outline_bid,
+        )
+        if value is not None:
+            mdflow = _decompress(value)
+    if mdflow is None:
+        with app.app_context():
+            content = (
+                db.session.query(PublishedOutlineItem.content)
+                .filter(PublishedOutlineItem.id == outline_item.id)
+                .scalar()
+            )
+        mdflow = content or ""
+    _course_bundle_mdflow_cache.set(cache_key, mdflow)
+    return mdflow
+
+
+def get_course_bundle_stats() -> dict:
+    """
+    Get the course bundle cache statistics
+    Returns:
+        dict: Statistics of the bundle and the mdflow caches
+    """
+    return {
+        "bundle": _course_bundle_cache.stats(),
+        "mdflow": _course_bundle_mdflow_cache.stats(),
+    }
@@ -1,9 +1,9 @@
-from markdown_flow import MarkdownFlow
 from flask import Flask
 from flaskr.service.shifu.models import DraftOutlineItem
 from flaskr.service.common import raise_error
 from flaskr.dao import db
 from flaskr.service.shifu.dtos import MdflowDTOParseResult
+from flaskr.service.shifu.mdflow_cache import get_parsed_mdflow
 
 
 def get_shifu_mdflow(app: Flask, shifu_bid: str, outline_bid: str) -> str:
@@ -60,8 +60,8 @@ def parse_shifu_mdflow(
         )
         if not outline_item:
             raise_error("SHIFU.OUTLINE_ITEM_NOT_FOUND")
-        markdown_flow = MarkdownFlow(outline_item.content)
-        markdown_flow.parse()
-        varibales = markdown_flow.extract_variables()
-        blocks = markdown_flow.get_all_blocks()
-        return MdflowDTOParseResult(variables=varibales, blocks_count=len(blocks))
+        parsed_mdflow = get_parsed_mdflow(outline_item.id, outline_item.content)
+        return MdflowDTOParseResult(
+            variables=parsed_mdflow.variables,
+            blocks_count=len(parsed_mdflow.blocks),
+        )
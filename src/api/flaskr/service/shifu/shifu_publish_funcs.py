@@ -25,6 +25,7 @@ from flaskr.service.shifu.shifu_outline_funcs import (
 from flaskr.service.shifu.shifu_block_funcs import __get_block_list_internal
 from flaskr.service.shifu.shifu_history_manager import HistoryItem
 from flaskr.service.shifu.shifu_struct_manager import get_shifu_outline_tree
+from flaskr.service.shifu.shifu_bundle import publish_course_bundle
 from flaskr.common import get_config
 from flaskr.util import generate_id
 from datetime import datetime
@@ -180,6 +181,7 @@ def publish_shifu_draft(app, user_id: str, shifu_id: str):
         shifu_log_published_struct.created_at = now_time
         db.session.add(shifu_log_published_struct)
         db.session.commit()
+        publish_course_bundle(app, shifu_id)
         thread = threading.Thread(
             target=_run_summary_with_error_handling, args=(app, shifu_id)
         )
@@ -483,6 +485,7 @@ def _get_summary(app, prompt, model_name, user_id=None, temperature=0.8):
         prompt,
         temperature=temperature,
         generation_name="shifu_summary",
+        cache=True,
     )
     summary = ""
     for chunk in response:
@@ -13,7 +13,6 @@ Date: 2025-08-07
 
 from flask import Flask
 from flaskr.service.shifu.models import (
-    LogPublishedStruct,
     LogDraftStruct,
     DraftShifu,
     DraftOutlineItem,
@@ -22,7 +21,20 @@ from flaskr.service.shifu.models import (
 )
 
 from flaskr.service.shifu.shifu_history_manager import HistoryItem
+from flaskr.service.shifu.struct_utils import StructIndex
+from flaskr.service.shifu.shifu_bundle import (
+    CourseBundleLLMSettings,
+    OutlineAskSettings,
+    get_course_bundle,
+    get_published_struct_version,
+    invalidate_course_bundle,
+    resolve_ask_settings,
+    resolve_llm_settings,
+)
 from flaskr.service.common import raise_error
+from flaskr.dao import db
+from flaskr.util.lru_cache import LRUCache
+from flaskr.common.config import get_config
 import queue
 from typing import List, Union
 from pydantic import BaseModel
@@ -62,11 +74,101 @@ class ShifuInfoDto(BaseModel):
         return self.model_dump_json(exclude_none=True)
 
 
+# struct logs are append only, so the id of the latest log is the version
+# of the shifu, its outline items and blocks.
+# published versions are served from the course bundle (see shifu_bundle),
+# preview always reads the latest draft, its index is cached per version.
+_struct_index_cache = LRUCache(
+    maxsize=int(get_config("SHIFU_STRUCT_CACHE_SIZE") or 256)
+)
+_llm_settings_cache = LRUCache(
+    maxsize=int(get_config("SHIFU_STRUCT_CACHE_SIZE") or 256)
+)
+# outline items never move to another shifu
+_outline_item_shifu_cache = LRUCache(maxsize=10000)
+
+
+def get_shifu_struct_version(app: Flask, shifu_bid: str, is_preview: bool = False):
+    """
+    Get the version of the latest shifu struct
+    Args:
+        app: Flask application instance
+        shifu_bid: Shifu bid
+        is_preview: Is preview
+    Returns:
+        int: Id of the latest struct log
+    """
+    if not is_preview:
+        return get_published_struct_version(app, shifu_bid)
+    with app.app_context():
+        version = (
+            db.session.query(LogDraftStruct.id)
+            .filter(
+                LogDraftStruct.shifu_bid == shifu_bid,
+                LogDraftStruct.deleted == 0,
+            )
+            .order_by(
+                LogDraftStruct.id.desc(),
+            )
+            .limit(1)
+            .scalar()
+        )
+    if not version:
+        raise_error("SHIFU.SHIFU_NOT_FOUND")
+    return version
+
+
+def invalidate_shifu_struct_cache(app: Flask, shifu_bid: str):
+    """
+    Invalidate the cached published struct and dtos of a shifu
+    called after a new struct is published
+    Args:
+        app: Flask application instance
+        shifu_bid: Shifu bid
+    """
+    invalidate_course_bundle(app, shifu_bid)
+    for cache in (_struct_index_cache, _llm_settings_cache):
+        cache.delete_if(lambda key: key[1] == shifu_bid)
+
+
+def get_shifu_struct_index(
+    app: Flask, shifu_bid: str, is_preview: bool = False
+) -> StructIndex:
+    """
+    Get the index of the latest shifu struct
+    the index is built once per struct version and cached in the worker
+    Args:
+        app: Flask application instance
+        shifu_bid: Shifu bid
+        is_preview: Is preview
+    Returns:
+        StructIndex: Shifu struct index
+    """
+    with app.app_context():
+        app.logger.info(f"get_shifu_struct_index:{shifu_bid},{is_preview}")
+        if not is_preview:
+            return get_course_bundle(app, shifu_bid).struct_index
+        version = get_shifu_struct_version(app, shifu_bid, is_preview)
+
+        def load_struct_index() -> StructIndex:
+            shifu_struct = LogDraftStruct.query.filter(
+                LogDraftStruct.id == version
+            ).first()
+            if not shifu_struct:
+                raise_error("SHIFU.SHIFU_NOT_FOUND")
+            return StructIndex(HistoryItem.from_json(shifu_struct.struct))
+
+        return _struct_index_cache.get_or_set(
+            (LogDraftStruct.__tablename__, shifu_bid, version), load_struct_index
+        )
+
+
 def get_shifu_struct(
     app: Flask, shifu_bid: str, is_preview: bool = False
 ) -> HistoryItem:
     """
     Get shifu struct
+    the struct is shared by the cache, do not modify it
     Args:
         app: Flask application instance
         shifu_bid: Shifu bid
@@ -74,24 +176,81 @@ def get_shifu_struct(
     Returns:
         HistoryItem: Shifu struct
     """
+    return get_shifu_struct_index(app, shifu_bid, is_preview).root
+
+
+def get_outline_llm_settings(
+    app: Flask, shifu_bid: str, outline_bid: str, is_preview: bool = False
+) -> CourseBundleLLMSettings:
+    """
+    Get the resolved llm settings and system prompt of an outline item
+    the settings of all the outline items are resolved once per struct version
+    Args:
+        app: Flask application instance
+        shifu_bid: Shifu bid
+        outline_bid: Outline item bid
+        is_preview: Is preview
+    Returns:
+        CourseBundleLLMSettings: Llm settings, model is None for the default llm
+    """
+    if not is_preview:
+        return get_course_bundle(app, shifu_bid).get_llm_settings(outline_bid)
     with app.app_context():
-        app.logger.info(f"get_shifu_struct:{shifu_bid},{is_preview}")
-        if is_preview:
-            model = LogDraftStruct
-        else:
-            model = LogPublishedStruct
-        shifu_struct = (
-            model.query.filter(
-                model.shifu_bid == shifu_bid,
+        version = get_shifu_struct_version(app, shifu_bid, is_preview)
+
+        def load_llm_settings() -> dict[str, CourseBundleLLMSettings]:
+            struct_index = get_shifu_struct_index(app, shifu_bid, is_preview)
+            shifu = DraftShifu.query.filter(
+                DraftShifu.id == struct_index.root.id
+            ).first()
+            if not shifu:
+                raise_error("SHIFU.SHIFU_NOT_FOUND")
+            outline_items = DraftOutlineItem.query.filter(
+                DraftOutlineItem.id.in_(
+                    [item.id for item in struct_index.get_outline_items()]
+                ),
+            ).all()
+            return resolve_llm_settings(
+                struct_index, shifu, {i.id: i for i in outline_items}
             )
-            .order_by(
-                model.id.desc(),
-            )
-            .first()
+
+        llm_settings = _llm_settings_cache.get_or_set(
+            (LogDraftStruct.__tablename__, shifu_bid, version), load_llm_settings
         )
-        if not shifu_struct:
+        return llm_settings.get(outline_bid, None) or CourseBundleLLMSettings()
+
+
+def get_outline_ask_settings(
+    app: Flask, shifu_bid: str, outline_bid: str, is_preview: bool = False
+) -> OutlineAskSettings:
+    """
+    Get the resolved ask settings of an outline item
+    they are read from the outline items of its path and the shifu, the
+    summary of a publish updates them without a new struct version.
+    Args:
+        app: Flask application instance
+        shifu_bid: Shifu bid
+        outline_bid: Outline item bid
+        is_preview: Is preview
+    Returns:
+        OutlineAskSettings: Ask settings
+    """
+    if is_preview:
+        shifu_model, outline_item_model = DraftShifu, DraftOutlineItem
+    else:
+        shifu_model, outline_item_model = PublishedShifu, PublishedOutlineItem
+    with app.app_context():
+        struct_index = get_shifu_struct_index(app, shifu_bid, is_preview)
+        path = struct_index.get_path(outline_bid)
+        outline_items = outline_item_model.query.filter(
+            outline_item_model.id.in_([p.id for p in path if p.type == "outline"]),
+        ).all()
+        shifu = shifu_model.query.filter(shifu_model.id == struct_index.root.id).first()
+        if not shifu:
             raise_error("SHIFU.SHIFU_NOT_FOUND")
-        return HistoryItem.from_json(shifu_struct.struct)
+        return resolve_ask_settings(
+            struct_index, shifu, {i.id: i for i in outline_items}, outline_bid
+        )
 
 
 def get_shifu_outline_tree(
@@ -184,6 +343,20 @@ def get_shifu_dto(app: Flask, shifu_bid: str, is_preview: bool = False) -> Shifu
     Returns:
         ShifuInfoDto: Shifu dto
     """
+    if is_preview:
+        return _load_shifu_dto(app, shifu_bid, is_preview)
+    shifu = get_course_bundle(app, shifu_bid).shifu
+    return ShifuInfoDto(
+        bid=shifu.bid,
+        title=shifu.title,
+        description=shifu.description,
+        avatar=shifu.avatar,
+        price=shifu.price,
+        outline_items=[],
+    )
+
+
+def _load_shifu_dto(app: Flask, shifu_bid: str, is_preview: bool) -> ShifuInfoDto:
     if is_preview:
         shifu_model = DraftShifu
     else:
@@ -257,7 +430,27 @@ def get_outline_item_dto(
         ShifuOutlineItemDto: Outline item dto
     """
     app.logger.info(f"get_outline_item_dto: {outline_item_bid},{is_preview}")
+    shifu_bid = _outline_item_shifu_cache.get(outline_item_bid)
+    if is_preview or not shifu_bid:
+        outline_item_dto = _load_outline_item_dto(app, outline_item_bid, is_preview)
+        _outline_item_shifu_cache.set(outline_item_bid, outline_item_dto.shifu_bid)
+        return outline_item_dto
+    outline_item = get_course_bundle(app, shifu_bid).get_outline_item(outline_item_bid)
+    if not outline_item:
+        raise_error("SHIFU.OUTLINE_ITEM_NOT_FOUND")
+    return ShifuOutlineItemDto(
+        bid=outline_item.bid,
+        position=outline_item.position,
+        title=outline_item.title,
+        type=outline_item.type,
+        shifu_bid=shifu_bid,
+        children=[],
+    )
 
+
+def _load_outline_item_dto(
+    app: Flask, outline_item_bid: str, is_preview: bool
+) -> ShifuOutlineItemDto:
     if is_preview:
         outline_item_model = DraftOutlineItem
     else:
@@ -289,6 +482,7 @@ class OutlineItemDtoWithMdflow(BaseModel):
     Outline item dto with mdflow
     """
 
+    id: int
     mdflow: str
     outline_bid: str
     title: str
@@ -318,6 +512,7 @@ def get_outline_item_dto_with_mdflow(
         raise_error("SHIFU.OUTLINE_ITEM_NOT_FOUND")
 
     return OutlineItemDtoWithMdflow(
+        id=outline_item.id,
         mdflow=outline_item.content,
         outline_bid=outline_item.outline_item_bid,
         title=outline_item.title,
@@ -7,7 +7,7 @@ Author: yfge
 Date: 2025-08-07
 """
 
-from typing import Optional
+from typing import Callable, Optional
 from flaskr.service.shifu.shifu_history_manager import HistoryItem
 
 
@@ -35,3 +35,137 @@ def find_node_with_parents(
             return result
     current_path.pop()
     return None
+
+
+class StructIndex:
+    """
+    Index of a shifu struct
+    built once per struct version, so the lookups by bid are O(1)
+    instead of scanning the tree again.
+    the indexed nodes are shared, do not modify them.
+    """
+
+    root: HistoryItem
+
+    def __init__(self, root: HistoryItem):
+        self.root = root
+        self._nodes: dict[str, HistoryItem] = {}
+        self._parents: dict[str, HistoryItem] = {}
+        self._paths: dict[str, list[HistoryItem]] = {}
+        self._sibling_index: dict[str, int] = {}
+        # outline items in dfs pre-order, a subtree is a contiguous slice
+        self._outline_items: list[HistoryItem] = []
+        self._outline_index: dict[str, int] = {}
+        self._outline_end: dict[str, int] = {}
+        self._leaves: list[HistoryItem] = []
+        self._leaf_index: dict[str, int] = {}
+
+        stack: list[tuple[HistoryItem, list[HistoryItem], bool]] = [(root, [], False)]
+        while stack:
+            node, parent_path, visited = stack.pop()
+            if visited:
+                self._outline_end[node.bid] = len(self._outline_items)
+                continue
+            path = parent_path + [node]
+            self._nodes[node.bid] = node
+            self._paths[node.bid] = path
+            if parent_path:
+                self._parents[node.bid] = parent_path[-1]
+            if node.type == "outline":
+                self._outline_index[node.bid] = len(self._outline_items)
+                self._outline_items.append(node)
+                if self._is_leaf(node):
+                    self._leaf_index[node.bid] = len(self._leaves)
+                    self._leaves.append(node)
+            stack.append((node, parent_path, True))
+            for index in range(len(node.children) - 1, -1, -1):
+                child = node.children[index]
+                self._sibling_index[child.bid] = index
+                stack.append((child, path, False))
+
+    @staticmethod
+    def _is_leaf(node: HistoryItem) -> bool:
+        # outline is a leaf when it has blocks or no children
+        return not (node.children and node.children[0].type == "outline")
+
+    def get_node(self, bid: str) -> Optional[HistoryItem]:
+        return self._nodes.get(bid, None)
+
+    def get_parent(self, bid: str) -> Optional[HistoryItem]:
+        return self._parents.get(bid, None)
+
+    def get_path(self, bid: str) -> Optional[list[HistoryItem]]:
+        """
+        Get the path from the root to the node
+        Args:
+            bid: Node bid
+        Returns:
+            Optional[list[HistoryItem]]: Path to the node, the node included
+        """
+        return self._paths.get(bid, None)
+
+    def get_sibling_index(self, bid: str) -> int:
+        return self._sibling_index.get(bid, 0)
+
+    def is_leaf_outline(self, bid: str) -> bool:
+        node = self._nodes.get(bid, None)
+        return node is not None and node.type == "outline" and self._is_leaf(node)
+
+    def get_outline_items(self, bid: Optional[str] = None) -> list[HistoryItem]:
+        """
+        Get the outline items in dfs order
+        Args:
+            bid: Bid of the subtree root, the whole struct when None
+        Returns:
+            list[HistoryItem]: Outline items of the subtree
+        """
+        if bid is None or bid == self.root.bid:
+            return self._outline_items
+        start = self._outline_index.get(bid, None)
+        if start is None:
+            return []
+        return self._outline_items[start : self._outline_end[bid]]
+
+    def get_leaves(self) -> list[HistoryItem]:
+        return self._leaves
+
+    def get_next_leaf(self, bid: str) -> Optional[HistoryItem]:
+        index = self._leaf_index.get(bid, None)
+        if index is None or index + 1 >= len(self._leaves):
+            return None
+        return self._leaves[index + 1]
+
+    def get_next_visible_leaf(
+        self, bid: str, is_hidden: Callable[[str], bool]
+    ) -> tuple[list[HistoryItem], list[HistoryItem]]:
+        """
+        Get the navigation after an outline item is completed
+        the next visible sibling is searched first, when there is none
+        the parent is completed as well, then the first child chain of
+        the found sibling is started down to the leaf.
+        Args:
+            bid: Bid of the completed outline item
+            is_hidden: Whether an outline item is hidden
+        Returns:
+            tuple[list[HistoryItem], list[HistoryItem]]:
+                the completed items from the item up to its ancestors,
+                and the started items from the sibling down to the next leaf
+        """
+        completed: list[HistoryItem] = []
+        node = self._nodes.get(bid, None)
+        while node is not None:
+            completed.append(node)
+            parent = self._parents.get(node.bid, None)
+            if parent is None:
+                break
+            for sibling in parent.children[self._sibling_index[node.bid] + 1 :]:
+                if is_hidden(sibling.bid):
+                    continue
+                started = [sibling]
+                while not self._is_leaf(started[-1]):
+                    started.append(started[-1].children[0])
+                return completed, started
+            if parent.type != "outline":
+                break
+            node = parent
+        return completed, []
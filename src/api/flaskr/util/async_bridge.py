@@ -0,0 +1,297 @@
+"""
+Async bridge
+
+This module contains helpers to consume async code from sync code.
+
+The learner runtime is served by sync (gevent) workers while MarkdownFlow
+exposes an async interface. Instead of creating and tearing down an event
+loop for every call, each worker process owns one long lived event loop
+running in a background thread, and sync code submits coroutines to it.
+Under gevent the background thread is a greenlet, so waiting for a result
+only blocks the calling greenlet.
+"""
+
+import asyncio
+import concurrent.futures
+import contextvars
+import os
+import threading
+import time
+from typing import (
+    AsyncGenerator,
+    Awaitable,
+    Callable,
+    Generator,
+    Optional,
+    TypeVar,
+)
+
+T = TypeVar("T")
+
+
+class AsyncRuntime:
+    """
+    Persistent event loop of a worker process
+    the loop is started lazily on first use and recreated after a fork,
+    so it is safe to import this module before gunicorn forks the workers.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+
+    def _get_loop(self) -> asyncio.AbstractEventLoop:
+        loop = self._loop
+        if loop is not None and self._pid == os.getpid() and not loop.is_closed():
+            return loop
+        with self._lock:
+            if self._loop is None or self._pid != os.getpid() or self._loop.is_closed():
+                loop = asyncio.new_event_loop()
+                ready = threading.Event()
+                thread = threading.Thread(
+                    target=self._run_loop,
+                    args=(loop, ready),
+                    name="async-runtime",
+                    daemon=True,
+                )
+                thread.start()
+                ready.wait()
+                self._loop = loop
+                self._thread = thread
+                self._pid = os.getpid()
+            return self._loop
+
+    @staticmethod
+    def _run_loop(loop: asyncio.AbstractEventLoop, ready: threading.Event):
+        asyncio.set_event_loop(loop)
+        loop.call_soon(ready.set)
+        loop.run_forever()
+
+    def run(self, coro: Awaitable[T]) -> T:
+        """
+        Run a coroutine on the runtime loop and wait for the result
+        Args:
+            coro: Coroutine to run
+        Returns:
+            T: Result of the coroutine
+        """
+        # the task is created with a copy of the caller context vars,
+        # so the flask app context is still available in the coroutine
+        future = asyncio.run_coroutine_threadsafe(coro, self._get_loop())
+        return future.result()
+
+    def submit(self, fn: Callable[..., T], *args) -> concurrent.futures.Future:
+        """
+        Run a blocking function in the executor of the runtime loop
+        the caller is not blocked, it waits for the returned future when it
+        needs the result.
+        Args:
+            fn: Function to run
+            args: Arguments of the function
+        Returns:
+            concurrent.futures.Future: Future of the result
+        """
+        return asyncio.run_coroutine_threadsafe(
+            _run_in_executor(fn, args), self._get_loop()
+        )
+
+    def iterate(self, async_gen: AsyncGenerator[T, None]) -> Generator[T, None, None]:
+        """
+        Iterate an async generator on the runtime loop
+        every item is yielded as soon as the async generator produces it,
+        so the caller can stream it to the client without waiting for the end.
+        when the caller closes the generator (eg. client disconnect),
+        the async generator is closed as well.
+        Args:
+            async_gen: Async generator to iterate
+        Returns:
+            Generator[T, None, None]: Items of the async generator
+        """
+        try:
+            while True:
+                try:
+                    item = self.run(async_gen.__anext__())
+                except StopAsyncIteration:
+                    break
+                yield item
+        finally:
+            self.run(_aclose(async_gen))
+
+
+_END = object()
+
+
+class PrefetchedAsyncGenerator:
+    """
+    Async generator consumed ahead of its caller on the runtime loop
+    the items are buffered from the moment it is created, iterate returns
+    them in order and at the pace they were produced, close cancels the
+    consumption and closes the async generator.
+    """
+
+    def __init__(self, runtime: "AsyncRuntime", async_gen: AsyncGenerator[T, None]):
+        self._runtime = runtime
+        self._queue, self._task = runtime.run(self._start(async_gen))
+
+    async def _start(self, async_gen: AsyncGenerator[T, None]):
+        queue = asyncio.Queue()
+        return queue, asyncio.ensure_future(self._consume(async_gen, queue))
+
+    @staticmethod
+    async def _consume(async_gen: AsyncGenerator[T, None], queue: asyncio.Queue):
+        try:
+            async for item in async_gen:
+                queue.put_nowait((item, None, time.monotonic()))
+            queue.put_nowait((_END, None, time.monotonic()))
+        except Exception as e:
+            queue.put_nowait((_END, e, time.monotonic()))
+        finally:
+            await async_gen.aclose()
+
+    def iterate(self) -> Generator[T, None, None]:
+        """
+        Iterate the buffered and upcoming items
+        Returns:
+            Generator[T, None, None]: Items of the async generator
+        """
+        last_produced = None
+        last_yielded = None
+        try:
+            while True:
+                item, error, produced = self._runtime.run(self._queue.get())
+                if error is not None:
+                    raise error
+                if item is _END:
+                    break
+                if last_produced is not None:
+                    # buffered items keep the pace of the generation instead
+                    # of being flushed at once, live items are not delayed
+                    wait = (produced - last_produced) - (
+                        time.monotonic() - last_yielded
+                    )
+                    if wait > 0:
+                        time.sleep(wait)
+                last_produced = produced
+                last_yielded = time.monotonic()
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Stop the consumption and close the async generator
+        """
+        if not self._task.done():
+            self._runtime.run(self._cancel())
+
+    async def _cancel(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except (asyncio.CancelledError, Exception):
+            pass
+
+
+async def _run_in_executor(fn: Callable[..., T], args: tuple) -> T:
+    # the executor does not propagate context vars (eg. flask app context)
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(
+        None, context.run, fn, *args
+    )
+
+
+async def _aclose(async_gen: AsyncGenerator):
+    await async_gen.aclose()
+    # nested async generators dropped by the close are finalized by tasks
+    # scheduled on the loop, let them run before returning to the caller
+    await asyncio.sleep(0)
+
+
+_runtime = AsyncRuntime()
+
+
+def get_async_runtime() -> AsyncRuntime:
+    """
+    Get the async runtime of the current worker process
+    Returns:
+        AsyncRuntime: Async runtime
+    """
+    return _runtime
+
+
+def run_async(coro: Awaitable[T]) -> T:
+    """
+    Run a coroutine from sync code on the worker event loop
+    Args:
+        coro: Coroutine to run
+    Returns:
+        T: Result of the coroutine
+    """
+    return _runtime.run(coro)
+
+
+def run_in_background(fn: Callable[..., T], *args) -> concurrent.futures.Future:
+    """
+    Run a blocking function without waiting for it on the worker event loop
+    Args:
+        fn: Function to run
+        args: Arguments of the function
+    Returns:
+        concurrent.futures.Future: Future of the result
+    """
+    return _runtime.submit(fn, *args)
+
+
+def iter_async_generator(
+    async_gen: AsyncGenerator[T, None],
+) -> Generator[T, None, None]:
+    """
+    Iterate an async generator from sync code on the worker event loop
+    Args:
+        async_gen: Async generator to iterate
+    Returns:
+        Generator[T, None, None]: Items of the async generator
+    """
+    return _runtime.iterate(async_gen)
+
+
+async def aiter_sync_generator(
+    gen: Generator[T, None, None],
+) -> AsyncGenerator[T, None]:
+    """
+    Iterate a blocking sync generator from async code
+    every step runs in the default executor so the event loop is not blocked,
+    used for llm providers which only have a sync http client.
+    Args:
+        gen: Sync generator to iterate
+    Returns:
+        AsyncGenerator[T, None]: Items of the sync generator
+    """
+    loop = asyncio.get_running_loop()
+    sentinel = object()
+    try:
+        while True:
+            # the executor does not propagate context vars (eg. flask app context)
+            context = contextvars.copy_context()
+            item = await loop.run_in_executor(None, context.run, next, gen, sentinel)
+            if item is sentinel:
+                break
+            yield item
+    finally:
+        await loop.run_in_executor(None, gen.close)
+
+
+def prefetch_async_generator(
+    async_gen: AsyncGenerator[T, None],
+) -> PrefetchedAsyncGenerator:
+    """
+    Start consuming an async generator on the worker event loop
+    used to generate the next content block while the current one streams.
+    Args:
+        async_gen: Async generator to consume
+    Returns:
+        PrefetchedAsyncGenerator: Handle to iterate or close it
+    """
+    return PrefetchedAsyncGenerator(_runtime, async_gen)
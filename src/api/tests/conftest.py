@@ -1,3 +1,5 @@
+from contextlib import contextmanager
+
 import pytest
 from app import create_app
 from flask_migrate import upgrade
@@ -26,3 +28,128 @@ def test_client(app):
 @pytest.fixture
 def token():
     return ""
+
+
+@pytest.fixture
+def count_queries(app):
+    """
+    Count the statements sent to the database in a block
+    Usage: with count_queries() as statements: ...
+    """
+
+    @contextmanager
+    def count():
+        from sqlalchemy import event
+
+        from flaskr.dao import db
+
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+
+    return count
+
+
+def _delete_published_course(shifu_bid: str):
+    from flaskr.dao import db
+    from flaskr.service.shifu.models import (
+        LogPublishedStruct,
+        PublishedOutlineItem,
+        PublishedShifu,
+    )
+
+    for model in (LogPublishedStruct, PublishedOutlineItem, PublishedShifu):
+        model.query.filter(model.shifu_bid == shifu_bid).delete()
+    db.session.commit()
+
+
+@pytest.fixture
+def publish_course(app):
+    """
+    Publish a course, a chapter with its lessons, deleted after the test
+    Usage: publish_course(shifu_bid, [chapter_bid, lesson_bid, ...])
+    publishing a course again replaces it.
+    """
+    published = set()
+
+    def publish(shifu_bid: str, outline_bids: list[str]):
+        from flaskr.dao import db
+        from flaskr.service.shifu.models import (
+            LogPublishedStruct,
+            PublishedOutlineItem,
+            PublishedShifu,
+        )
+        from flaskr.service.shifu.shifu_history_manager import HistoryItem
+        from flaskr.util import generate_id
+
+        _delete_published_course(shifu_bid)
+        published.add(shifu_bid)
+        shifu = PublishedShifu(
+            shifu_bid=shifu_bid,
+            title="test course",
+            price=0,
+            llm="shifu-model",
+            llm_temperature=0.5,
+            llm_system_prompt="shifu prompt",
+            ask_enabled_status=5102,
+        )
+        db.session.add(shifu)
+        db.session.flush()
+        chapter = PublishedOutlineItem(
+            outline_item_bid=outline_bids[0],
+            shifu_bid=shifu_bid,
+            title="chapter",
+            position="01",
+            type=401,
+            llm="chapter-model",
+            llm_temperature=0.2,
+            ask_enabled_status=5103,
+            ask_llm="chapter-ask-model",
+            ask_llm_system_prompt="chapter ask prompt",
+        )
+        db.session.add(chapter)
+        db.session.flush()
+        struct = HistoryItem(
+            bid=shifu_bid,
+            id=shifu.id,
+            type="shifu",
+            children=[
+                HistoryItem(bid=chapter.outline_item_bid, id=chapter.id, type="outline")
+            ],
+        )
+        for index, outline_bid in enumerate(outline_bids[1:]):
+            lesson = PublishedOutlineItem(
+                outline_item_bid=outline_bid,
+                shifu_bid=shifu_bid,
+                title=f"lesson {index}",
+                position=f"01{index:02d}",
+                type=401,
+                llm_system_prompt="lesson prompt" if index == 0 else "",
+                ask_enabled_status=5101,
+                content=f"lesson {index} content",
+            )
+            db.session.add(lesson)
+            db.session.flush()
+            struct.children[0].children.append(
+                HistoryItem(bid=outline_bid, id=lesson.id, type="outline")
+            )
+        db.session.add(
+            LogPublishedStruct(
+                struct_bid=generate_id(app),
+                shifu_bid=shifu_bid,
+                struct=struct.to_json(),
+            )
+        )
+        db.session.commit()
+
+    yield publish
+    with app.app_context():
+        for shifu_bid in published:
+            _delete_published_course(shifu_bid)
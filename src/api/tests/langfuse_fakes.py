@@ -0,0 +1,31 @@
+class FakeGeneration:
+    """
+    Langfuse generation recording what the llm calls trace
+    """
+
+    def __init__(self, generations: list, metadata: dict):
+        self.metadata = metadata
+        self.output = None
+        self.usage = None
+        generations.append(self)
+
+    def end(self, output=None, usage=None, metadata=None, **kwargs):
+        self.output = output
+        self.usage = usage
+        self.metadata.update(metadata or {})
+
+
+class FakeSpan:
+    """
+    Langfuse span recording its generations and output
+    """
+
+    def __init__(self):
+        self.generations = []
+        self.output = None
+
+    def generation(self, metadata=None, **kwargs):
+        return FakeGeneration(self.generations, metadata or {})
+
+    def update(self, output=None, **kwargs):
+        self.output = output
@@ -0,0 +1,59 @@
+def test_estimate_tokens():
+    from flaskr.service.learn.ask_context import estimate_tokens
+
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("a" * 400, "gpt-4o-mini") == 100
+    assert estimate_tokens("学" * 100, "gpt-4o-mini") == 80
+    assert estimate_tokens("学" * 100, "deepseek-chat") == 60
+    assert estimate_tokens("学" * 100, "unknown") == 100
+
+
+def test_fit_history():
+    from flaskr.service.learn.ask_context import (
+        TRIMMED_SUFFIX,
+        estimate_messages_tokens,
+        fit_history,
+    )
+
+    history = [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": str(i) * 400}
+        for i in range(6)
+    ]
+    assert fit_history(history, 0) == history
+
+    kept = fit_history(history, 250)
+    assert kept[-1] == history[-1]
+    assert kept[-2] == history[-2]
+    assert kept[0]["content"].endswith(TRIMMED_SUFFIX)
+    assert len(kept) == 3
+    assert estimate_messages_tokens(kept) <= 250
+
+    assert fit_history(history, 110) == history[-1:]
+
+
+def test_ask_system_message_cache(app, monkeypatch):
+    from flaskr.service.learn import ask_context
+
+    calls = []
+
+    def get_fmt_prompt(app, user_id, shifu_bid, prompt):
+        calls.append(prompt)
+        return prompt
+
+    monkeypatch.setattr(ask_context, "get_fmt_prompt", get_fmt_prompt)
+    ask_prompt = "ask {shifu_system_message}"
+    template = "teach {sys_user_nickname}"
+
+    def get(profiles):
+        return ask_context.get_ask_system_message(
+            app, "user", "shifu", ask_prompt, template, profiles
+        )
+
+    before = ask_context.get_ask_system_message_cache_stats()
+    assert get({"sys_user_nickname": "Ada"}) == "ask teach Ada"
+    assert get({"sys_user_nickname": "Ada"}) == "ask teach Ada"
+    assert get({"sys_user_nickname": "Bob"}) == "ask teach Bob"
+    assert len(calls) == 2
+    after = ask_context.get_ask_system_message_cache_stats()
+    assert after["hits"] - before["hits"] == 1
+    assert after["misses"] - before["misses"] == 2
@@ -1,9 +1,9 @@
 def test_get_access_token(app):
     from flaskr.api.llm.ernie import get_access_token
 
-    access_token = get_access_token()
+    access_token = get_access_token(app)
     app.logger.info(access_token)
-    assert get_access_token() != ""
+    assert get_access_token(app) != ""
 
 
 def test_chat(app):
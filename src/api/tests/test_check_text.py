@@ -0,0 +1,108 @@
+import time
+from concurrent.futures import Future
+
+
+def _check_result(check_result: int):
+    from flaskr.api.check.dto import CheckResultDTO
+
+    return CheckResultDTO(
+        check_result=check_result,
+        risk_labels=["spam"] if check_result else [],
+        risk_label_ids=[],
+        provider="test",
+        raw_data={},
+    )
+
+
+def test_hold_until_checked():
+    from flaskr.api.check import CHECK_RESULT_PASS, CHECK_RESULT_REJECT
+    from flaskr.service.check_risk import hold_until_checked
+
+    closed = []
+
+    def stream(check: Future, result: int):
+        try:
+            for i in range(5):
+                if i == 2:
+                    check.set_result(_check_result(result))
+                yield i
+        finally:
+            closed.append(result)
+
+    check = Future()
+    assert list(hold_until_checked(check, stream(check, CHECK_RESULT_PASS))) == [
+        0,
+        1,
+        2,
+        3,
+        4,
+    ]
+
+    check = Future()
+    assert list(hold_until_checked(check, stream(check, CHECK_RESULT_REJECT))) == []
+    assert closed == [CHECK_RESULT_PASS, CHECK_RESULT_REJECT]
+
+    # the stream may end before the check
+    check = Future()
+    check.set_result(_check_result(CHECK_RESULT_PASS))
+    assert list(hold_until_checked(check, iter([]))) == []
+
+
+def test_check_text_cached(app, monkeypatch):
+    from flaskr.api.check import CHECK_RESULT_PASS, CHECK_RESULT_REJECT
+    from flaskr.service.check_risk import funcs
+    from flaskr.service.check_risk.models import RiskControlResult
+
+    calls = []
+
+    def check_text(app, data_id, text, user_id):
+        calls.append(text)
+        return _check_result(
+            CHECK_RESULT_REJECT if "spam" in text else CHECK_RESULT_PASS
+        )
+
+    monkeypatch.setattr(funcs, "check_text", check_text)
+    monkeypatch.setitem(app.config, "CHECK_TEXT_CACHE_EXPIRE", 60)
+    with app.app_context():
+        funcs.redis.delete(funcs._get_check_text_cache_key(app, "Buy spam now"))
+        first = funcs.check_text_cached(app, "check-1", "Buy spam now", "user")
+        second = funcs.check_text_cached(app, "check-2", "  buy   SPAM now ", "user")
+        assert first.check_result == second.check_result == CHECK_RESULT_REJECT
+        assert second.risk_labels == ["spam"]
+        assert calls == ["Buy spam now"]
+
+        check = funcs.start_check_text(app, "check-3", "Buy spam now", "user")
+        assert check.result().check_result == CHECK_RESULT_REJECT
+        assert calls == ["Buy spam now"]
+
+    # the risk control result is written in the background
+    for _ in range(50):
+        with app.app_context():
+            record = RiskControlResult.query.filter_by(chat_id="check-3").first()
+        if record is not None:
+            break
+        time.sleep(0.05)
+    assert record is not None and record.is_pass == 0
+
+
+def test_check_text_traced(app):
+    from flaskr.api.check import CHECK_RESULT_PASS
+    from flaskr.service.learn.check_text import check_text_with_llm_response
+
+    class FakeSpan:
+        def __init__(self):
+            self.events = []
+
+        def event(self, name, input, output):
+            self.events.append((name, input, output.check_result))
+
+    # the interaction input runs the check answer in both modes, a passed
+    # check is traced without an answer
+    span = FakeSpan()
+    check = Future()
+    check.set_result(_check_result(CHECK_RESULT_PASS))
+    res = check_text_with_llm_response(
+        app, None, None, "hello", span, "", "", 0, None, "", "", check
+    )
+    assert [i for i in res if i] == []
+    assert span.events == [("check_text", "hello", CHECK_RESULT_PASS)]
@@ -0,0 +1,203 @@
+def test_course_bundle(app, count_queries, publish_course):
+    from flaskr.service.learn.utils import get_follow_up_info
+    from flaskr.service.shifu.shifu_bundle import (
+        get_course_bundle,
+        get_course_bundle_mdflow,
+        invalidate_course_bundle,
+        publish_course_bundle,
+    )
+    from flaskr.util import generate_id
+
+    shifu_bid = generate_id(app)
+    chapter_bid, lesson_bid, other_lesson_bid = [generate_id(app) for _ in range(3)]
+    with app.app_context():
+        try:
+            publish_course(shifu_bid, [chapter_bid, lesson_bid, other_lesson_bid])
+            bundle = publish_course_bundle(app, shifu_bid)
+            assert bundle.shifu.title == "test course"
+            assert [i.bid for i in bundle.struct_index.get_leaves()] == [
+                lesson_bid,
+                other_lesson_bid,
+            ]
+            assert bundle.get_outline_item(lesson_bid).title == "lesson 0"
+
+            # the nearest outline item wins, then the shifu
+            lesson_settings = bundle.get_llm_settings(lesson_bid)
+            assert lesson_settings.model == "chapter-model"
+            assert lesson_settings.temperature == 0.2
+            assert lesson_settings.system_prompt == "lesson prompt"
+            assert bundle.get_llm_settings(other_lesson_bid).system_prompt == (
+                "shifu prompt"
+            )
+            assert bundle.get_llm_settings(chapter_bid).model == "chapter-model"
+            follow_up_info = get_follow_up_info(
+                app, shifu_bid, None, "", outline_bid=other_lesson_bid
+            )
+            assert follow_up_info.ask_model == "chapter-ask-model"
+            assert follow_up_info.ask_mode == 5103
+
+            # the navigation is precomputed for every outline item
+            assert set(bundle.navigation) == {chapter_bid, lesson_bid, other_lesson_bid}
+            completed, started = bundle.get_navigation(lesson_bid)
+            assert [i.bid for i in completed] == [lesson_bid]
+            assert [i.bid for i in started] == [other_lesson_bid]
+            completed, started = bundle.get_navigation(other_lesson_bid)
+            assert [i.bid for i in completed] == [other_lesson_bid, chapter_bid]
+            assert started == []
+
+            # a warm bundle costs the version check only
+            bundle = get_course_bundle(app, shifu_bid, lesson_bid)
+            with count_queries() as statements:
+                assert get_course_bundle(app, shifu_bid, lesson_bid) is bundle
+                assert (
+                    get_course_bundle_mdflow(app, bundle, lesson_bid)
+                    == "lesson 0 content"
+                )
+                assert (
+                    get_course_bundle_mdflow(app, bundle, lesson_bid)
+                    == "lesson 0 content"
+                )
+            assert len(statements) <= 2
+        finally:
+            invalidate_course_bundle(app, shifu_bid)
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+
+    def hset(self, key, mapping):
+        self.redis.data.setdefault(key, {}).update(mapping)
+
+    def expire(self, key, expire):
+        self.redis.expires[key] = expire
+
+    def execute(self):
+        pass
+
+
+class FakeRedis:
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None, nx=False):
+        if nx and key in self.data:
+            return False
+        self.data[key] = str(value).encode()
+        self.expires[key] = ex
+        return True
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def hmget(self, key, fields):
+        return [self.data.get(key, {}).get(field) for field in fields]
+
+    def hget(self, key, field):
+        return self.data.get(key, {}).get(field)
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+
+def test_course_bundle_version_race(app, monkeypatch, publish_course):
+    from flaskr.dao import db
+    from flaskr.service.shifu import shifu_bundle
+    from flaskr.service.shifu.models import LogPublishedStruct
+    from flaskr.util import generate_id
+
+    redis = FakeRedis()
+    monkeypatch.setattr(shifu_bundle, "redis", redis)
+    shifu_bid = generate_id(app)
+    key = shifu_bundle._get_version_cache_key(shifu_bid)
+    with app.app_context():
+        try:
+            publish_course(shifu_bid, [generate_id(app), generate_id(app)])
+            old_version = shifu_bundle.publish_course_bundle(app, shifu_bid).version
+            redis.delete(key)
+            query = shifu_bundle._query_published_struct_version
+
+            def query_before_publish(app, shifu_bid):
+                # the reader reads the struct, then a publish commits
+                version = query(app, shifu_bid)
+                monkeypatch.setattr(
+                    shifu_bundle, "_query_published_struct_version", query
+                )
+                struct = LogPublishedStruct.query.filter(
+                    LogPublishedStruct.id == version
+                ).first()
+                db.session.add(
+                    LogPublishedStruct(
+                        struct_bid=generate_id(app),
+                        shifu_bid=shifu_bid,
+                        struct=struct.struct,
+                    )
+                )
+                db.session.commit()
+                shifu_bundle.publish_course_bundle(app, shifu_bid)
+                return version
+
+            monkeypatch.setattr(
+                shifu_bundle, "_query_published_struct_version", query_before_publish
+            )
+            assert (
+                shifu_bundle.get_published_struct_version(app, shifu_bid) == old_version
+            )
+            # the late reader does not override the published version
+            new_version = shifu_bundle.get_published_struct_version(app, shifu_bid)
+            assert new_version > old_version
+            assert redis.expires[key] == shifu_bundle._get_cache_expire()
+
+            # a missing version is only filled for a short time
+            redis.delete(key)
+            assert (
+                shifu_bundle.get_published_struct_version(app, shifu_bid) == new_version
+            )
+            assert redis.expires[key] == shifu_bundle.SHIFU_STRUCT_VERSION_FILL_EXPIRE
+        finally:
+            shifu_bundle.invalidate_course_bundle(app, shifu_bid)
+
+
+def test_course_bundle_ask_settings_after_summary(app, monkeypatch, publish_course):
+    from flaskr.service.learn.utils import get_follow_up_info
+    from flaskr.service.shifu import shifu_publish_funcs
+    from flaskr.service.shifu.consts import ASK_MODE_ENABLE
+    from flaskr.service.shifu.shifu_bundle import (
+        invalidate_course_bundle,
+        publish_course_bundle,
+    )
+    from flaskr.util import generate_id
+
+    monkeypatch.setattr(
+        shifu_publish_funcs, "_get_summary", lambda app, **kwargs: "summary"
+    )
+    monkeypatch.setattr(
+        shifu_publish_funcs,
+        "_make_ask_prompt",
+        lambda app, template, learned, unlearned: "generated ask prompt",
+    )
+    shifu_bid = generate_id(app)
+    chapter_bid, lesson_bid = generate_id(app), generate_id(app)
+    with app.app_context():
+        try:
+            publish_course(shifu_bid, [chapter_bid, lesson_bid])
+            publish_course_bundle(app, shifu_bid)
+            follow_up_info = get_follow_up_info(
+                app, shifu_bid, None, "", outline_bid=lesson_bid
+            )
+            assert follow_up_info.ask_prompt == "chapter ask prompt"
+
+            # the summary writes the ask settings after the bundle is built
+            shifu_publish_funcs.get_shifu_summary(app, shifu_bid)
+            follow_up_info = get_follow_up_info(
+                app, shifu_bid, None, "", outline_bid=lesson_bid
+            )
+            assert follow_up_info.ask_mode == ASK_MODE_ENABLE
+            assert follow_up_info.ask_prompt == "generated ask prompt"
+        finally:
+            invalidate_course_bundle(app, shifu_bid)
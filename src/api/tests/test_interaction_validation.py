@@ -0,0 +1,39 @@
+def test_validate_interaction_input(app):
+    from markdown_flow import InteractionParser
+
+    from flaskr.service.learn.interaction_validation import (
+        VALIDATION_LLM,
+        VALIDATION_LOCAL,
+        get_interaction_validation_stats,
+        record_interaction_validation,
+        validate_interaction_input,
+    )
+
+    def validate(content: str, user_input: str):
+        parsed = InteractionParser().parse(content)
+        variables = validate_interaction_input(parsed, user_input)
+        record_interaction_validation(
+            parsed, VALIDATION_LLM if variables is None else VALIDATION_LOCAL
+        )
+        return variables
+
+    buttons = "?[%{{level}} Beginner//1|Expert//2]"
+    assert validate(buttons, "Beginner") == {"level": "1"}
+    assert validate(buttons, " 2 ") == {"level": "2"}
+    assert validate(buttons, "Master") is None
+
+    with_text = "?[%{{level}} Beginner|Expert|...your level]"
+    assert validate(with_text, "Expert") == {"level": "Expert"}
+    assert validate(with_text, "somewhere between") is None
+
+    assert validate("?[%{{name}}...your name]", "Ada") is None
+    assert validate("?[Continue]", "Continue") == {}
+    # labels depending on a variable are only known after rendering
+    assert validate("?[%{{level}} {{name}}|Other]", "{{name}}") is None
+
+    stats = get_interaction_validation_stats()
+    assert stats["buttons_only"][VALIDATION_LOCAL] >= 2
+    assert stats["buttons_only"][VALIDATION_LLM] >= 2
+    assert stats["buttons_with_text"][VALIDATION_LOCAL] >= 1
+    assert stats["text_only"][VALIDATION_LLM] >= 1
+    assert 0 < stats["buttons_only"]["avoided_rate"] < 1
@@ -0,0 +1,402 @@
+import json
+
+BLOCK_COUNT = 5
+MDFLOW = "\n\n---\n\n".join(
+    f"Explain topic {index} briefly." for index in range(BLOCK_COUNT)
+)
+
+
+def setup_lesson(
+    app, shifu_bid: str, lesson_bid: str, user_bid: str, content: str = MDFLOW
+):
+    from flaskr.dao import db
+    from flaskr.service.shifu.models import (
+        LogPublishedStruct,
+        PublishedOutlineItem,
+        PublishedShifu,
+    )
+    from flaskr.service.shifu.shifu_history_manager import HistoryItem
+    from flaskr.util import generate_id
+
+    shifu = PublishedShifu(shifu_bid=shifu_bid, title="run test", price=0)
+    db.session.add(shifu)
+    db.session.flush()
+    lesson = PublishedOutlineItem(
+        outline_item_bid=lesson_bid,
+        shifu_bid=shifu_bid,
+        title="lesson",
+        position="01",
+        type=401,
+        content=content,
+    )
+    db.session.add(lesson)
+    db.session.flush()
+    struct = HistoryItem(
+        bid=shifu_bid,
+        id=shifu.id,
+        type="shifu",
+        children=[
+            HistoryItem(
+                bid=lesson_bid,
+                id=lesson.id,
+                type="outline",
+                children=[
+                    HistoryItem(bid=f"{lesson_bid}{index}", id=index, type="block")
+                    for index in range(BLOCK_COUNT)
+                ],
+            )
+        ],
+    )
+    db.session.add(
+        LogPublishedStruct(
+            struct_bid=generate_id(app),
+            shifu_bid=shifu_bid,
+            struct=struct.to_json(),
+        )
+    )
+    db.session.commit()
+    setup_user(user_bid)
+
+
+def setup_user(user_bid: str):
+    import datetime
+
+    from flaskr.dao import db
+    from flaskr.service.user.models import User
+
+    user = User(user_id=user_bid, username="run test", mobile="13800000000")
+    user.user_birth = datetime.date(2000, 1, 1)
+    db.session.add(user)
+    db.session.commit()
+
+
+def delete_lesson(shifu_bid: str, user_bid: str):
+    from flaskr.dao import db
+    from flaskr.service.learn.models import LearnGeneratedBlock, LearnProgressRecord
+    from flaskr.service.shifu.models import (
+        LogPublishedStruct,
+        PublishedOutlineItem,
+        PublishedShifu,
+    )
+    from flaskr.service.user.models import User
+
+    for model in (LogPublishedStruct, PublishedOutlineItem, PublishedShifu):
+        model.query.filter(model.shifu_bid == shifu_bid).delete()
+    for model in (LearnGeneratedBlock, LearnProgressRecord):
+        model.query.filter(model.user_bid == user_bid).delete()
+    User.query.filter(User.user_id == user_bid).delete()
+    db.session.commit()
+
+
+def patch_llm_stream(
+    monkeypatch, chunks: int = 20, delay: float = 0, chunk_delay: float = 0
+) -> list:
+    import asyncio
+
+    from flaskr.service.learn import context_v2
+
+    calls = []
+
+    async def stream(self, messages):
+        calls.append(messages)
+        if delay:
+            # time to first token
+            await asyncio.sleep(delay)
+        for index in range(chunks):
+            if chunk_delay:
+                await asyncio.sleep(chunk_delay)
+            yield f"chunk{index} "
+
+    monkeypatch.setattr(context_v2.RUNLLMProvider, "stream", stream)
+    return calls
+
+
+def get_generated_blocks(user_bid: str):
+    from flaskr.service.learn.models import LearnGeneratedBlock
+
+    return (
+        LearnGeneratedBlock.query.filter(LearnGeneratedBlock.user_bid == user_bid)
+        .order_by(LearnGeneratedBlock.id.asc())
+        .all()
+    )
+
+
+def test_run_script_write_behind(app, monkeypatch, count_queries):
+    from flaskr.service.learn.runscript_v2 import run_script_inner
+    from flaskr.util import generate_id
+
+    patch_llm_stream(monkeypatch)
+    shifu_bid, lesson_bid, user_bid = [generate_id(app) for _ in range(3)]
+    with app.app_context():
+        setup_lesson(app, shifu_bid, lesson_bid, user_bid)
+    try:
+        with app.app_context():
+            with count_queries() as statements:
+                list(run_script_inner(app, user_bid, shifu_bid, lesson_bid))
+        writes = [i for i in statements if i.split()[0].upper() in ("INSERT", "UPDATE")]
+        print(
+            f"\nstatements: {len(statements)} writes: {len(writes)} "
+            f"blocks: {BLOCK_COUNT}"
+        )
+        # the blocks of a run are written in one batch with the progress
+        assert len(writes) <= 4
+        with app.app_context():
+            blocks = get_generated_blocks(user_bid)
+            assert len(blocks) == BLOCK_COUNT
+            assert [i.position for i in blocks] == list(range(BLOCK_COUNT))
+            assert blocks[0].generated_content.startswith("chunk0 chunk1")
+    finally:
+        with app.app_context():
+            delete_lesson(shifu_bid, user_bid)
+
+
+def test_run_script_interrupted(app, monkeypatch):
+    from flaskr.service.learn.learn_dtos import GeneratedType
+    from flaskr.service.learn.runscript_v2 import run_script_inner
+    from flaskr.util import generate_id
+
+    patch_llm_stream(monkeypatch)
+    shifu_bid, lesson_bid, user_bid = [generate_id(app) for _ in range(3)]
+    with app.app_context():
+        setup_lesson(app, shifu_bid, lesson_bid, user_bid)
+    try:
+        # the client goes away while the third block is streamed
+        breaks = 0
+        stream = run_script_inner(app, user_bid, shifu_bid, lesson_bid)
+        for item in stream:
+            if item.type == GeneratedType.BREAK:
+                breaks += 1
+            if breaks == 2 and item.type == GeneratedType.CONTENT:
+                break
+        stream.close()
+        with app.app_context():
+            blocks = get_generated_blocks(user_bid)
+            assert [i.position for i in blocks] == [0, 1, 2]
+            assert [i.status for i in blocks] == [1, 1, 1]
+            # the block being streamed is finished for a resume
+            assert blocks[2].generated_content == blocks[0].generated_content
+    finally:
+        with app.app_context():
+            delete_lesson(shifu_bid, user_bid)
+
+
+def test_run_script_cancelled_by_new_run(app, monkeypatch):
+    import time
+
+    from flaskr.dao import redis_client
+    from flaskr.service.learn.runscript_v2 import (
+        RUN_SCRIPT_CANCEL_CHECK_INTERVAL,
+        run_script,
+    )
+    from flaskr.util import generate_id
+
+    patch_llm_stream(monkeypatch)
+    shifu_bid, lesson_bid, user_bid = [generate_id(app) for _ in range(3)]
+    with app.app_context():
+        setup_lesson(app, shifu_bid, lesson_bid, user_bid)
+    prefix = app.config.get("REDIS_KEY_PREFIX")
+    try:
+        monkeypatch.setitem(app.config, "RUN_SCRIPT_STREAM_COALESCE_MS", 0)
+        stream = run_script(app, shifu_bid, lesson_bid, user_bid)
+        for frame in stream:
+            if '"type": "content"' in frame:
+                break
+        assert redis_client.get(prefix + ":run_script:" + user_bid)
+
+        # a new run of the same user takes over, the running one stops at its
+        # next chunk and hands over the lock
+        redis_client.set(prefix + ":run_script_run:" + user_bid, "new run")
+        time.sleep(RUN_SCRIPT_CANCEL_CHECK_INTERVAL + 0.05)
+        assert list(stream) == []
+        assert redis_client.get(prefix + ":run_script:" + user_bid) is None
+        with app.app_context():
+            blocks = get_generated_blocks(user_bid)
+            assert [i.status for i in blocks] == [0]
+            assert blocks[0].generated_content == "chunk0 "
+    finally:
+        redis_client.delete(prefix + ":run_script_run:" + user_bid)
+        with app.app_context():
+            delete_lesson(shifu_bid, user_bid)
+
+
+def test_resume_run_script(app, monkeypatch):
+    from flaskr.service.learn.learn_dtos import GeneratedType
+    from flaskr.service.learn.runscript_v2 import resume_run_script, run_script_inner
+    from flaskr.util import generate_id
+
+    patch_llm_stream(monkeypatch)
+    shifu_bid, lesson_bid, user_bid = [generate_id(app) for _ in range(3)]
+    with app.app_context():
+        setup_lesson(app, shifu_bid, lesson_bid, user_bid)
+    try:
+        # the client goes away after the first chunks of the first block
+        received = ""
+        stream = run_script_inner(app, user_bid, shifu_bid, lesson_bid)
+        for item in stream:
+            if item.type == GeneratedType.CONTENT:
+                received += item.content
+                generated_block_bid = item.generated_block_bid
+                if len(received) > 10:
+                    break
+        stream.close()
+
+        frames = [
+            json.loads(i[len("data: ") :])
+            for i in resume_run_script(
+                app, user_bid, lesson_bid, generated_block_bid, len(received)
+            )
+        ]
+        assert frames[-1]["type"] == "break"
+        resumed = "".join(i["content"] for i in frames[:-1])
+        assert received + resumed == "".join(f"chunk{i} " for i in range(20))
+
+        # another user can not read the stream
+        frames = list(
+            resume_run_script(app, generate_id(app), lesson_bid, generated_block_bid)
+        )
+        assert len(frames) == 1
+    finally:
+        with app.app_context():
+            delete_lesson(shifu_bid, user_bid)
+
+
+def test_generation_cache_key(app):
+    from flaskr.service.learn.generation_cache import (
+        get_generation_cache_policy,
+        make_generation_cache_key,
+        replay_generation,
+    )
+
+    with app.app_context():
+        key = make_generation_cache_key("block", {"a": "1"}, "prompt", "m", 0.3)
+        assert key == make_generation_cache_key("block", {"a": "1"}, "prompt", "m", 0.3)
+        assert key != make_generation_cache_key("block", {"a": "2"}, "prompt", "m", 0.3)
+        assert key != make_generation_cache_key("block", {"a": "1"}, "other", "m", 0.3)
+        assert key != make_generation_cache_key("block", {"a": "1"}, "prompt", "m", 0.5)
+        assert not get_generation_cache_policy("unknown shifu").enabled
+    assert list(replay_generation([["a", 0], ["b", 0.01]])) == ["a", "b"]
+
+
+def test_generation_cache(app, monkeypatch):
+    from flaskr.dao import redis_client
+    from flaskr.service.learn.generation_cache import get_generation_cache_policy
+    from flaskr.service.learn.runscript_v2 import run_script_inner
+    from flaskr.util import generate_id
+
+    calls = patch_llm_stream(monkeypatch)
+    shifu_bid, lesson_bid, user_bid = [generate_id(app) for _ in range(3)]
+    other_user_bid = generate_id(app)
+    monkeypatch.setitem(
+        app.config, "GENERATION_CACHE_SHIFU_POLICIES", f"{shifu_bid}=reuse"
+    )
+    with app.app_context():
+        assert get_generation_cache_policy(shifu_bid).enabled
+        setup_lesson(app, shifu_bid, lesson_bid, user_bid)
+        setup_user(other_user_bid)
+    try:
+        list(run_script_inner(app, user_bid, shifu_bid, lesson_bid))
+        assert len(calls) == BLOCK_COUNT
+
+        # the blocks reference no learner variable, another learner gets the
+        # cached generations without a llm call
+        list(run_script_inner(app, other_user_bid, shifu_bid, lesson_bid))
+        assert len(calls) == BLOCK_COUNT
+        with app.app_context():
+            assert [i.generated_content for i in get_generated_blocks(user_bid)] == [
+                i.generated_content for i in get_generated_blocks(other_user_bid)
+            ]
+    finally:
+        for key in redis_client.keys("*generation_cache:*"):
+            redis_client.delete(key)
+        with app.app_context():
+            delete_lesson(shifu_bid, user_bid)
+            delete_lesson(shifu_bid, other_user_bid)
+
+
+def test_run_script_prefetch(app, monkeypatch):
+    import time
+
+    from flaskr.service.learn.learn_dtos import GeneratedType
+    from flaskr.service.learn.runscript_v2 import run_script_inner
+    from flaskr.util import generate_id
+
+    first_token = 0.2
+    calls = patch_llm_stream(monkeypatch, delay=first_token, chunk_delay=0.01)
+    shifu_bid, lesson_bid, user_bid = [generate_id(app) for _ in range(3)]
+    with app.app_context():
+        setup_lesson(app, shifu_bid, lesson_bid, user_bid)
+    try:
+
+        def get_gaps(depth: int) -> list[float]:
+            # time between the end of a block and the first chunk of the next
+            monkeypatch.setitem(app.config, "RUN_SCRIPT_PREFETCH_DEPTH", depth)
+            gaps = []
+            block_end = None
+            for item in run_script_inner(app, user_bid, shifu_bid, lesson_bid):
+                if item.type == GeneratedType.BREAK:
+                    block_end = time.monotonic()
+                elif item.type == GeneratedType.CONTENT and block_end:
+                    gaps.append(time.monotonic() - block_end)
+                    block_end = None
+            return gaps
+
+        gaps = get_gaps(0)
+        assert len(gaps) == BLOCK_COUNT - 1
+        assert min(gaps) >= first_token
+
+        # the next block is generated while the previous one is read
+        with app.app_context():
+            delete_lesson(shifu_bid, user_bid)
+            setup_lesson(app, shifu_bid, lesson_bid, user_bid)
+        prefetched_gaps = get_gaps(1)
+        print(f"\ngaps: {max(gaps):.3f}s -> {max(prefetched_gaps):.3f}s")
+        assert len(prefetched_gaps) == BLOCK_COUNT - 1
+        assert max(prefetched_gaps) < first_token / 2
+        assert len(calls) == BLOCK_COUNT * 2
+        with app.app_context():
+            blocks = get_generated_blocks(user_bid)
+            assert [i.position for i in blocks] == list(range(BLOCK_COUNT))
+    finally:
+        with app.app_context():
+            delete_lesson(shifu_bid, user_bid)
+
+
+def test_run_script_button_input(app, monkeypatch):
+    from flaskr.service.learn import context_v2
+    from flaskr.service.learn.learn_dtos import GeneratedType
+    from flaskr.service.learn.runscript_v2 import run_script_inner
+    from flaskr.util import generate_id
+
+    patch_llm_stream(monkeypatch)
+    completions = []
+
+    async def complete(self, messages):
+        completions.append(messages)
+        return '{"result": "ok", "parse_vars": {"level": "2"}}'
+
+    def check_text(*args, **kwargs):
+        raise AssertionError("a clicked button is not moderated")
+
+    monkeypatch.setattr(context_v2.RUNLLMProvider, "complete", complete)
+    monkeypatch.setattr(context_v2, "check_text_with_llm_response", check_text)
+    content = "Intro.\n\n---\n\n?[%{{level}} Beginner//1|Expert//2]\n\n---\n\nDone."
+    shifu_bid, lesson_bid, user_bid = [generate_id(app) for _ in range(3)]
+    with app.app_context():
+        setup_lesson(app, shifu_bid, lesson_bid, user_bid, content)
+    try:
+        items = list(run_script_inner(app, user_bid, shifu_bid, lesson_bid))
+        assert items[-1].type == GeneratedType.INTERACTION
+
+        items = list(
+            run_script_inner(app, user_bid, shifu_bid, lesson_bid, "Expert", "select")
+        )
+        updates = [i for i in items if i.type == GeneratedType.VARIABLE_UPDATE]
+        assert [
+            (i.content.variable_name, i.content.variable_value) for i in updates
+        ] == [("level", "2")]
+        # the button is accepted without the llm and the lesson goes on
+        assert completions == []
+        assert any(i.type == GeneratedType.CONTENT for i in items)
+    finally:
+        with app.app_context():
+            delete_lesson(shifu_bid, user_bid)
@@ -0,0 +1,112 @@
+import time
+from typing import AsyncGenerator
+
+from markdown_flow import LLMProvider, MarkdownFlow
+
+
+TOKEN_DELAY = 0.2
+TOKENS = ["Hello", ", ", "this ", "is ", "a ", "stream"]
+
+
+class DelayedLLMProvider(LLMProvider):
+    """
+    Stub llm provider which blocks between tokens like a real llm stream
+    """
+
+    def __init__(self, tokens: list[str], delay: float):
+        self.tokens = tokens
+        self.delay = delay
+        self.emitted = 0
+        self.closed = False
+
+    async def complete(self, messages: list[dict[str, str]]) -> str:
+        return "".join(self.tokens)
+
+    async def stream(self, messages: list[dict[str, str]]) -> AsyncGenerator[str, None]:
+        try:
+            for token in self.tokens:
+                # the real provider reads from a blocking http stream
+                time.sleep(self.delay)
+                self.emitted += 1
+                yield token
+        finally:
+            self.closed = True
+
+
+def test_stream_mdflow_block_ttft():
+    from flaskr.service.learn.context_v2 import stream_mdflow_block
+    from flaskr.util.async_bridge import iter_async_generator
+
+    provider = DelayedLLMProvider(TOKENS, TOKEN_DELAY)
+    mdflow = MarkdownFlow("say hello to the learner", llm_provider=provider)
+
+    start = time.monotonic()
+    ttft = None
+    chunks = []
+    for chunk in iter_async_generator(stream_mdflow_block(mdflow, 0)):
+        if ttft is None:
+            ttft = time.monotonic() - start
+        chunks.append(chunk)
+    total = time.monotonic() - start
+
+    print(f"\nttft: {ttft:.3f}s total: {total:.3f}s")
+    assert chunks == TOKENS
+    # the first chunk must be delivered after the first token,
+    # not after the whole generation
+    assert ttft < TOKEN_DELAY * 2
+    assert total >= TOKEN_DELAY * len(TOKENS)
+
+
+def test_stream_mdflow_block_cancel():
+    from flaskr.service.learn.context_v2 import stream_mdflow_block
+    from flaskr.util.async_bridge import iter_async_generator
+
+    provider = DelayedLLMProvider(TOKENS, 0.01)
+    mdflow = MarkdownFlow("say hello to the learner", llm_provider=provider)
+
+    res = iter_async_generator(stream_mdflow_block(mdflow, 0))
+    assert next(res) == TOKENS[0]
+    # simulate the client disconnect
+    res.close()
+
+    assert provider.closed
+    assert provider.emitted == 1
+
+
+def test_async_runtime_reuses_loop():
+    import asyncio
+    from flaskr.util.async_bridge import run_async
+
+    async def current_loop():
+        return asyncio.get_running_loop()
+
+    loop = run_async(current_loop())
+    assert run_async(current_loop()) is loop
+    assert not loop.is_closed()
+
+    provider = DelayedLLMProvider(TOKENS, 0)
+    mdflow = MarkdownFlow("say hello to the learner", llm_provider=provider)
+    assert run_async(provider.complete([])) == "".join(TOKENS)
+    assert run_async(current_loop()) is loop
+    assert mdflow.block_count == 1
+
+
+def test_aiter_sync_generator_close():
+    from flaskr.util.async_bridge import aiter_sync_generator, iter_async_generator
+
+    state = {"emitted": 0, "closed": False}
+
+    def blocking_gen():
+        try:
+            for token in TOKENS:
+                state["emitted"] += 1
+                yield token
+        finally:
+            state["closed"] = True
+
+    res = iter_async_generator(aiter_sync_generator(blocking_gen()))
+    assert next(res) == TOKENS[0]
+    res.close()
+
+    assert state["closed"]
+    assert state["emitted"] == 1
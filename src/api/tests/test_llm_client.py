@@ -0,0 +1,94 @@
+import asyncio
+import threading
+import time
+
+
+def test_concurrency_limit():
+    from flaskr.api.llm.client import ConcurrencyLimit
+
+    limit = ConcurrencyLimit(2)
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def work():
+        limit.acquire()
+        try:
+            with lock:
+                running.append(1)
+                peak.append(len(running))
+            time.sleep(0.02)
+            with lock:
+                running.pop()
+        finally:
+            limit.release()
+
+    threads = [threading.Thread(target=work) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # requests over the limit wait instead of failing
+    assert len(peak) == 6
+    assert max(peak) == 2
+    assert limit.active == 0 and limit.waiting == 0
+
+
+def test_concurrency_limit_async():
+    from flaskr.api.llm.client import ConcurrencyLimit
+
+    limit = ConcurrencyLimit(1)
+
+    async def run():
+        await limit.aacquire()
+        waiter = asyncio.ensure_future(limit.aacquire())
+        cancelled = asyncio.ensure_future(limit.aacquire())
+        await asyncio.sleep(0)
+        assert limit.waiting == 2
+        cancelled.cancel()
+        await asyncio.sleep(0)
+        assert limit.waiting == 1
+        # the slot is handed over to the first waiter
+        limit.release()
+        await asyncio.wait_for(waiter, 1)
+        assert limit.active == 1
+        limit.release()
+
+    asyncio.run(run())
+    assert limit.active == 0 and limit.waiting == 0
+
+
+def test_provider_client_stream(monkeypatch):
+    from flaskr.api.llm import client
+
+    monkeypatch.setattr(client, "_model_limits", {})
+    monkeypatch.setattr(
+        client,
+        "get_config",
+        lambda key: {
+            "LLM_PROVIDER_CONCURRENCY": "test=3",
+            "LLM_MODEL_CONCURRENCY": "test-model=1, other=x",
+        }.get(key),
+    )
+    provider = client.ProviderClient("test")
+    closed = []
+
+    class Stream:
+        def __iter__(self):
+            stats = client.get_provider_stats()
+            assert stats["model:test-model"]["active"] == 1
+            yield from ["a", "b"]
+
+        def close(self):
+            closed.append(True)
+
+    monkeypatch.setitem(client._providers, "test", provider)
+    assert list(provider.stream("test-model", Stream)) == ["a", "b"]
+    stream = provider.stream("test-model", Stream)
+    assert next(stream) == "a"
+    stream.close()
+    assert closed == [True, True]
+    stats = client.get_provider_stats()
+    assert stats["test"] == {"limit": 3, "active": 0, "waiting": 0}
+    assert stats["model:test-model"]["active"] == 0
+    assert "model:other" not in stats
@@ -0,0 +1,107 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def test_model_discovery(app, monkeypatch):
+    from flaskr.api.llm import discovery
+
+    for name in ("_discoveries", "_snapshots", "_refreshing", "_scheduled_at"):
+        monkeypatch.setattr(discovery, name, {})
+    monkeypatch.setattr(discovery, "MODEL_DISCOVERY_RETRY_INTERVAL", 0)
+    calls = []
+
+    def discover():
+        calls.append(True)
+        time.sleep(0.05)
+        return {"test/model-" + str(len(calls)): "model-" + str(len(calls))}
+
+    with app.app_context():
+        discovery.redis.delete(discovery._get_key("test"))
+        discovery.redis.delete(discovery._get_key("test") + ":lock")
+        discovery.register_model_discovery("test", discover)
+        # the boot does not wait for the provider
+        started = time.perf_counter()
+        discovery.start_model_discovery(app)
+        assert time.perf_counter() - started < 0.05
+        assert discovery.get_discovered_models("missing") == {}
+
+        assert discovery.get_discovered_models("test", wait=True) == {
+            "test/model-1": "model-1"
+        }
+        assert discovery.get_discovered_models("test") == {"test/model-1": "model-1"}
+        assert len(calls) == 1
+
+        # another worker loads the persisted models without listing them
+        monkeypatch.setattr(discovery, "_snapshots", {})
+        monkeypatch.setattr(discovery, "_refreshing", {})
+        assert discovery.get_discovered_models("test", wait=True) == {
+            "test/model-1": "model-1"
+        }
+        assert len(calls) == 1
+
+        # a stale result is served while it is refreshed in the background
+        discovery._snapshots["test"]["updated"] -= app.config.get(
+            "LLM_MODEL_DISCOVERY_EXPIRE"
+        )
+        discovery.redis.delete(discovery._get_key("test"))
+        discovery.redis.delete(discovery._get_key("test") + ":lock")
+        assert discovery.get_discovered_models("test") == {"test/model-1": "model-1"}
+        discovery._refreshing["test"].result(timeout=5)
+        assert discovery.get_discovered_models("test") == {"test/model-2": "model-2"}
+        assert len(calls) == 2
+
+
+class FakeRedis:
+    def __init__(self):
+        self.data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None, nx=False):
+        with self._lock:
+            if nx and key in self.data:
+                return False
+            self.data[key] = str(value).encode()
+            return True
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+
+def test_model_discovery_concurrent(app, monkeypatch):
+    from flaskr.api.llm import discovery
+
+    for name in ("_discoveries", "_snapshots", "_scheduled_at"):
+        monkeypatch.setattr(discovery, name, {})
+    monkeypatch.setattr(discovery, "redis", FakeRedis())
+    calls = []
+
+    def discover():
+        calls.append(True)
+        time.sleep(0.2)
+        return {"test/model": "model"}
+
+    discovery.register_model_discovery("test", discover)
+    # two workers start the discovery at the same time, the one losing the
+    # lock loads the models listed by the other
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        snapshots = list(
+            executor.map(lambda _: discovery._refresh(app, "test"), range(2))
+        )
+    assert [snapshot["models"] for snapshot in snapshots] == [
+        {"test/model": "model"}
+    ] * 2
+    assert len(calls) == 1
+
+    # a failed discovery does not delay the next attempt
+    discovery._snapshots.clear()
+    discovery.redis.data.clear()
+    discovery.register_model_discovery("failed", lambda: 1 / 0)
+    discovery._scheduled_at["failed"] = time.time()
+    assert discovery._refresh(app, "failed") is None
+    assert "failed" not in discovery._scheduled_at
+    assert discovery._get_key("failed") + ":lock" not in discovery.redis.data
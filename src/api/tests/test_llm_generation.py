@@ -0,0 +1,90 @@
+from types import SimpleNamespace
+
+from tests.langfuse_fakes import FakeSpan
+
+
+def chunk(text, usage=None, finish=None):
+    return SimpleNamespace(
+        id="c",
+        usage=usage,
+        choices=[
+            SimpleNamespace(delta=SimpleNamespace(content=text), finish_reason=finish)
+        ]
+        if text is not None
+        else [],
+    )
+
+
+def test_llm_generation(app, monkeypatch):
+    import flaskr.api.llm as llm
+    from flaskr.api.llm.registry import API_OPENAI, ModelRoute
+    from flaskr.util.async_bridge import run_async
+
+    seen = {}
+
+    class Completions:
+        def create(self, **kw):
+            seen.update(kw)
+            return [
+                chunk("a"),
+                chunk("b", finish="stop"),
+                chunk(
+                    None,
+                    SimpleNamespace(
+                        prompt_tokens=1, completion_tokens=2, total_tokens=3
+                    ),
+                ),
+            ]
+
+    client = SimpleNamespace(chat=SimpleNamespace(completions=Completions()))
+
+    class Provider:
+        def stream(self, model, create):
+            yield from create()
+
+        async def astream(self, model, create):
+            for c in create():
+                yield c
+
+    monkeypatch.setattr(llm, "get_openai_provider", lambda c: Provider())
+    monkeypatch.setattr(llm, "get_async_openai_client", lambda c: c)
+    monkeypatch.setattr(
+        llm,
+        "get_model_route",
+        lambda m: ModelRoute("openai", API_OPENAI, client, "up-" + m, True, True, ""),
+    )
+    with app.app_context():
+        span = FakeSpan()
+        assert [
+            c.result
+            for c in llm.invoke_llm(app, "u", span, "m", "hi", system="s", json=True)
+        ] == ["a", "b"]
+        assert (
+            seen["model"] == "up-m"
+            and seen["response_format"]
+            and seen["temperature"] == 0.8
+        )
+        assert span.output == "ab" and span.generations[0].output == "ab"
+
+        async def arun(span):
+            return [
+                c.result
+                async for c in llm.ainvoke_llm(
+                    app, "u", span, "m", "hi", temperature=0.1
+                )
+            ]
+
+        # the async transport builds the same request and traces the same way
+        span = FakeSpan()
+        assert run_async(arun(span)) == ["a", "b"]
+        assert span.output == "ab"
+        assert span.generations[0].usage["total"] == 3
+        assert seen["temperature"] == 0.1 and seen["stream_options"]
+        span = FakeSpan()
+        assert [
+            c.result
+            for c in llm.chat_llm(
+                app, "u", span, "m", [{"role": "user", "content": "x"}]
+            )
+        ] == ["a", "b"]
+        assert span.output is None and span.generations[0].output == "ab"
@@ -0,0 +1,61 @@
+import pytest
+
+
+def test_model_registry(app, monkeypatch):
+    from flaskr.api.llm import registry
+    from flaskr.service.common.models import AppException
+
+    monkeypatch.setattr(registry, "_registry", registry.ModelRegistry())
+    discovered = {"models": {}}
+    waits = []
+
+    def get_discovered(wait: bool):
+        waits.append(wait)
+        return discovered["models"]
+
+    static = {"shared": "shared", "plain": "plain-v1"}
+    off = {"off-model": "off-model"}
+    registry.register_model_provider(
+        "first",
+        registry.API_OPENAI,
+        get_discovered,
+        prefix="first/",
+        match=lambda model: model if model.startswith("first-") else None,
+    )
+    registry.register_model_provider(
+        "second", registry.API_GLM, lambda wait: static, supports_json=False
+    )
+    registry.register_model_provider(
+        "off",
+        registry.API_ERNIE,
+        lambda wait: off,
+        enabled=False,
+        config_var="OFF_API_KEY",
+    )
+
+    with app.app_context():
+        route = registry.get_model_route("plain")
+        assert (route.provider, route.model, route.supports_json) == (
+            "second",
+            "plain-v1",
+            False,
+        )
+        assert registry.get_model_route("first-any").provider == "first"
+        assert registry.get_registered_models() == ["shared", "plain", "off-model"]
+
+        # the routes are rebuilt when the models of a provider change
+        discovered["models"] = {"first/a": "a", "shared": "shared"}
+        assert registry.get_model_route("shared").provider == "first"
+        assert registry.get_model_route("first/a").model == "a"
+        routes = registry._registry._routes
+        registry.get_model_route("first/a")
+        assert registry._registry._routes is routes
+
+        # an unknown prefixed model waits for the discovery of its provider
+        waits.clear()
+        with pytest.raises(AppException):
+            registry.get_model_route("first/unknown")
+        assert waits == [False, True]
+        with pytest.raises(AppException) as error:
+            registry.get_model_route("off-model")
+        assert "OFF_API_KEY" in error.value.message
@@ -0,0 +1,72 @@
+from tests.langfuse_fakes import FakeSpan
+
+
+class FakeDifyChunk:
+    def __init__(self, answer: str):
+        self.task_id = "task"
+        self.event = "message"
+        self.answer = answer
+
+
+def test_llm_response_cache(app, monkeypatch):
+    import flaskr.api.llm as llm
+    from flaskr.api.llm import response_cache
+    from flaskr.api.llm.registry import API_DIFY, ModelRoute
+    from flaskr.util.lru_cache import LRUCache
+
+    calls = []
+
+    def dify_chat_message(app, message, user_id):
+        calls.append(message)
+        yield FakeDifyChunk("cached ")
+        yield FakeDifyChunk(message)
+
+    monkeypatch.setattr(llm, "dify_chat_message", dify_chat_message)
+    monkeypatch.setattr(
+        llm,
+        "get_model_route",
+        lambda model: ModelRoute("dify", API_DIFY, None, model, False, True, ""),
+    )
+    monkeypatch.setattr(response_cache, "_local", LRUCache(maxsize=2))
+
+    def invoke(message: str, span: FakeSpan, **kwargs) -> list[str]:
+        response = llm.invoke_llm(
+            app, "user", span, "dify", message, temperature=0.3, **kwargs
+        )
+        return [chunk.result for chunk in response]
+
+    with app.app_context():
+        key = llm._get_cache_key(
+            "dify", llm._get_messages("hello"), False, {"temperature": 0.3}
+        )
+        response_cache.redis.delete(key)
+
+        assert invoke("hello", FakeSpan(), cache=True) == ["cached ", "hello"]
+        # replayed as the same chunks and traced as a cache hit
+        span = FakeSpan()
+        assert invoke(" hello\r\n", span, cache=True) == ["cached ", "hello"]
+        assert len(calls) == 1
+        assert span.generations[0].metadata["cache_hit"]
+        assert span.generations[0].output == "cached hello"
+        assert span.output == "cached hello"
+
+        assert response_cache.get_response_cache_stats()["hits"] == 1
+
+        # another worker loads the response from redis
+        response_cache._local.clear()
+        assert invoke("hello", FakeSpan(), cache=True) == ["cached ", "hello"]
+        assert len(calls) == 1
+
+        # the calls not opting in and other temperatures are not cached
+        invoke("hello", FakeSpan())
+        list(
+            llm.invoke_llm(
+                app, "user", FakeSpan(), "dify", "hello", temperature=0.5, cache=True
+            )
+        )
+        assert len(calls) == 3
+
+        # the least recently used responses are evicted
+        invoke("other", FakeSpan(), cache=True)
+        assert response_cache._local.get(key) is None
+        assert response_cache.get_response_cache_stats()["size"] == 2
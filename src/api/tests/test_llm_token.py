@@ -0,0 +1,45 @@
+import time
+
+
+def test_provider_token(app, monkeypatch):
+    from flaskr.api.llm import token_manager
+
+    calls = []
+
+    def fetch():
+        calls.append(True)
+        time.sleep(0.05)
+        return "token-" + str(len(calls)), 100
+
+    first = token_manager.ProviderToken("test", fetch)
+    second = token_manager.ProviderToken("test", fetch)
+    with app.app_context():
+        token_manager.redis.delete(first._get_key())
+        token_manager.redis.delete(first._get_key() + ":lock")
+
+        assert first.get(app) == "token-1"
+        assert first.get(app) == "token-1"
+        # another worker loads the shared token without fetching it
+        assert second.get(app) == "token-1"
+        assert len(calls) == 1
+
+        # a token close to its expiry is served while it is refreshed
+        token_manager.redis.delete(first._get_key())
+        first._expires_at = time.time() + 5
+        started = time.perf_counter()
+        assert first.get(app) == "token-1"
+        assert time.perf_counter() - started < 0.05
+        first._refreshing.result(timeout=5)
+        assert first.get(app) == "token-2"
+        assert len(calls) == 2
+
+        # an expired token is fetched again before it is returned
+        token_manager.redis.delete(first._get_key())
+        first._expires_at = time.time() - 1
+        assert first.get(app) == "token-3"
+
+        # a local token never touches redis
+        local = token_manager.ProviderToken("local", fetch, shared=False)
+        monkeypatch.setattr(token_manager, "redis", None)
+        assert local.get(app) == "token-4"
+        assert local.get(app) == "token-4"
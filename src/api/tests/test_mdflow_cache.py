@@ -0,0 +1,50 @@
+MDFLOW = """say hello to the learner
+---
+?[%{{level}} beginner | advanced]
+---
+tell a story for a {{level}} learner"""
+
+
+def test_get_parsed_mdflow_hit_miss():
+    from flaskr.service.shifu.mdflow_cache import (
+        clear_mdflow_cache,
+        get_mdflow_cache_stats,
+        get_parsed_mdflow,
+    )
+
+    clear_mdflow_cache()
+    parsed = get_parsed_mdflow(1, MDFLOW)
+    assert len(parsed.blocks) == 3
+    assert parsed.variables == ["level"]
+    assert get_parsed_mdflow(1, MDFLOW) is parsed
+
+    # a new content version of the same outline is parsed again
+    changed = get_parsed_mdflow(1, MDFLOW + "\n---\nbye")
+    assert changed is not parsed
+    assert len(changed.blocks) == 4
+
+    stats = get_mdflow_cache_stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 2
+    assert stats["size"] == 2
+
+
+def test_build_markdown_flow_shares_blocks():
+    from markdown_flow import ProcessMode
+    from flaskr.service.shifu.mdflow_cache import build_markdown_flow, get_parsed_mdflow
+    from flaskr.util.async_bridge import run_async
+
+    parsed = get_parsed_mdflow(2, MDFLOW)
+    mdflow = build_markdown_flow(parsed)
+    assert mdflow.get_all_blocks() is parsed.blocks
+
+    result = run_async(
+        mdflow.process(2, ProcessMode.PROMPT_ONLY, variables={"level": "beginner"})
+    )
+    assert "beginner" in result.prompt
+    # rendering must not leak the variables into the shared blocks
+    assert "{{level}}" in parsed.blocks[2].content
+
+    interaction = parsed.get_interaction(1)
+    assert interaction["variable"] == "level"
+    assert parsed.get_interaction(1) is interaction
@@ -118,3 +118,189 @@ def test_delete_profile_item(test_client, app, token):
     app.logger.info(response.data)
     profile_item_definition_list = json.loads(response.data).get("data")
     assert len(profile_item_definition_list) == original_length - 1
+
+
+def test_user_profile_snapshot(app):
+    from sqlalchemy import event
+
+    from flaskr.dao import db
+    from flaskr.service.profile.dtos import ProfileToSave
+    from flaskr.service.profile.funcs import (
+        get_user_profile_snapshot,
+        get_user_profiles,
+        save_user_profiles,
+    )
+    from flaskr.service.profile.models import UserProfile
+    from flaskr.service.profile.profile_manage import add_profile_item_quick
+    from flaskr.util import generate_id
+
+    course_id, user_id = generate_id(app), generate_id(app)
+    add_profile_item_quick(app, course_id, "snapshot_level", user_id)
+    add_profile_item_quick(app, course_id, "snapshot_style", user_id)
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    try:
+        with app.app_context():
+            db.session.add(
+                UserProfile(
+                    user_id=user_id,
+                    profile_key="snapshot_level",
+                    profile_value="beginner",
+                )
+            )
+            db.session.commit()
+
+        with app.app_context():
+            profiles = get_user_profiles(app, user_id, course_id)
+            assert profiles["snapshot_level"] == "beginner"
+            assert "snapshot_style" not in profiles
+            # the snapshot is loaded once per run
+            event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+            try:
+                for _ in range(5):
+                    profiles = get_user_profiles(app, user_id, course_id)
+                    profiles["sys_user_input"] = "not kept"
+            finally:
+                event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+            assert statements == []
+            assert "sys_user_input" not in get_user_profiles(app, user_id, course_id)
+
+            save_user_profiles(
+                app,
+                user_id,
+                course_id,
+                [
+                    ProfileToSave("snapshot_level", "expert", ""),
+                    ProfileToSave("snapshot_style", "short", ""),
+                ],
+            )
+            profiles = get_user_profiles(app, user_id, course_id)
+            assert profiles["snapshot_level"] == "expert"
+            assert profiles["snapshot_style"] == "short"
+            db.session.commit()
+
+        # a new run reads the saved profiles
+        with app.app_context():
+            snapshot = get_user_profile_snapshot(app, user_id)
+            profiles = snapshot.get_profiles(app, course_id)
+            assert profiles["snapshot_level"] == "expert"
+            assert profiles["snapshot_style"] == "short"
+    finally:
+        with app.app_context():
+            UserProfile.query.filter(UserProfile.user_id == user_id).delete()
+            db.session.commit()
+
+
+def test_profile_definition_cache(app):
+    from sqlalchemy import event
+
+    from flaskr.dao import db
+    from flaskr.i18n import get_current_language, set_language
+    from flaskr.service.profile.models import ProfileItem
+    from flaskr.service.profile.profile_manage import (
+        add_profile_item_quick,
+        delete_profile_item,
+        get_profile_definition_cache_stats,
+        get_profile_item_definition_list,
+    )
+    from flaskr.util import generate_id
+
+    course_id, user_id = generate_id(app), generate_id(app)
+    add_profile_item_quick(app, course_id, "cached_level", user_id)
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    def get_keys(type: str = "all") -> list[str]:
+        return [
+            i.profile_key
+            for i in get_profile_item_definition_list(app, course_id, type)
+            if i.profile_scope == "user"
+        ]
+
+    language = get_current_language()
+    try:
+        assert get_keys() == ["cached_level"]
+        hits = get_profile_definition_cache_stats()["hits"]
+        with app.app_context():
+            event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+            try:
+                assert get_keys() == ["cached_level"]
+                assert get_keys("option") == []
+                set_language("zh-CN")
+                assert get_keys() == ["cached_level"]
+            finally:
+                event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+        assert statements == []
+        assert get_profile_definition_cache_stats()["hits"] >= hits + 3
+
+        # writes clear the cached definitions of the course
+        profile = add_profile_item_quick(app, course_id, "cached_style", user_id)
+        assert get_keys() == ["cached_level", "cached_style"]
+        delete_profile_item(app, user_id, profile.profile_id)
+        assert get_keys() == ["cached_level"]
+    finally:
+        set_language(language)
+        with app.app_context():
+            ProfileItem.query.filter(ProfileItem.parent_id == course_id).delete()
+            db.session.commit()
+
+
+def test_save_user_profiles_bulk(app):
+    from sqlalchemy import event
+
+    from flaskr.dao import db
+    from flaskr.service.profile.dtos import ProfileToSave
+    from flaskr.service.profile.funcs import get_user_profiles, save_user_profiles
+    from flaskr.service.profile.models import UserProfile
+    from flaskr.service.profile.profile_manage import add_profile_item_quick
+    from flaskr.util import generate_id
+
+    course_id, user_id = generate_id(app), generate_id(app)
+    keys = [f"bulk_{index}" for index in range(6)]
+    for key in keys:
+        add_profile_item_quick(app, course_id, key, user_id)
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    try:
+        with app.app_context():
+            # half of the profiles exist, one of them without its profile id
+            db.session.add_all(
+                UserProfile(user_id=user_id, profile_key=key, profile_value="old")
+                for key in keys[:3]
+            )
+            db.session.commit()
+            get_user_profiles(app, user_id, course_id)
+
+            event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+            try:
+                save_user_profiles(
+                    app,
+                    user_id,
+                    course_id,
+                    [ProfileToSave(key, f"new {key}", "") for key in keys],
+                )
+            finally:
+                event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+            db.session.commit()
+            selects = [i for i in statements if i.lstrip().upper().startswith("SELECT")]
+            writes = [i for i in statements if i not in selects]
+            print(f"\nstatements: {len(statements)} for {len(keys)} profiles")
+            assert len(selects) == 1
+            assert len(writes) <= 2
+
+        with app.app_context():
+            profiles = get_user_profiles(app, user_id, course_id)
+            assert [profiles[key] for key in keys] == [f"new {key}" for key in keys]
+            assert UserProfile.query.filter(UserProfile.user_id == user_id).count() == 6
+    finally:
+        with app.app_context():
+            UserProfile.query.filter(UserProfile.user_id == user_id).delete()
+            db.session.commit()
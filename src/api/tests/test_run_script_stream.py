@@ -0,0 +1,125 @@
+import json
+import time
+
+CHUNKS = 5000
+
+
+def make_stream(chunks: int, delay: float = 0):
+    from flaskr.service.learn.learn_dtos import GeneratedType, RunMarkdownFlowDTO
+
+    for index in range(chunks):
+        if delay:
+            time.sleep(delay)
+        yield RunMarkdownFlowDTO(
+            outline_bid="outline",
+            generated_block_bid="block",
+            type=GeneratedType.CONTENT,
+            content=f"词{index} ",
+        )
+    yield RunMarkdownFlowDTO(
+        outline_bid="outline",
+        generated_block_bid="block",
+        type=GeneratedType.BREAK,
+        content="",
+    )
+
+
+def test_make_run_script_frame(app):
+    from flaskr.service.learn.learn_dtos import (
+        GeneratedType,
+        LearnStatus,
+        OutlineItemUpdateDTO,
+        RunMarkdownFlowDTO,
+    )
+    from flaskr.service.learn.runscript_v2 import fmt, make_run_script_frame
+
+    items = [
+        RunMarkdownFlowDTO("o", "b", GeneratedType.CONTENT, 'a "quoted"\n中文'),
+        RunMarkdownFlowDTO("o", "", GeneratedType.BREAK, ""),
+        RunMarkdownFlowDTO(
+            "o",
+            "",
+            GeneratedType.OUTLINE_ITEM_UPDATE,
+            OutlineItemUpdateDTO(
+                outline_bid="o",
+                title="t",
+                status=LearnStatus.IN_PROGRESS,
+                has_children=False,
+            ),
+        ),
+    ]
+    for item in items:
+        assert make_run_script_frame(item) == (
+            "data: " + json.dumps(item, default=fmt, ensure_ascii=False) + "\n\n"
+        )
+
+
+def test_coalesce_run_script_stream(app):
+    from flaskr.service.learn.learn_dtos import GeneratedType
+    from flaskr.service.learn.runscript_v2 import (
+        coalesce_run_script_stream,
+        fmt,
+        make_run_script_frame,
+    )
+
+    expected = "".join(f"词{index} " for index in range(CHUNKS))
+
+    start = time.process_time()
+    baseline = [
+        "data: "
+        + json.dumps(item, default=fmt, ensure_ascii=False)
+        + "\n\n".encode("utf-8").decode("utf-8")
+        for item in make_stream(CHUNKS)
+    ]
+    baseline_cpu = time.process_time() - start
+
+    start = time.process_time()
+    items = list(coalesce_run_script_stream(make_stream(CHUNKS), 30, 200))
+    frames = [make_run_script_frame(item) for item in items]
+    cpu = time.process_time() - start
+    print(
+        f"\nframes: {len(baseline)} -> {len(frames)}, "
+        f"cpu: {baseline_cpu * 1000:.1f}ms -> {cpu * 1000:.1f}ms"
+    )
+
+    assert len(frames) < len(baseline) / 10
+    assert "".join(i.content for i in items[:-1]) == expected
+    assert all(len(i.content) < 200 + 10 for i in items[:-1])
+    # the break is never held back and ends the stream
+    assert items[-1].type == GeneratedType.BREAK
+
+    # a slow stream is sent chunk by chunk
+    items = list(coalesce_run_script_stream(make_stream(5, 0.02), 10, 200))
+    assert len(items) == 6
+
+    # a zero window keeps every chunk
+    assert len(list(coalesce_run_script_stream(make_stream(10), 0, 200))) == 11
+
+
+def test_coalesce_run_script_stream_stalled(app):
+    from flaskr.service.learn.learn_dtos import GeneratedType, RunMarkdownFlowDTO
+    from flaskr.service.learn.runscript_v2 import coalesce_run_script_stream
+
+    closed = []
+
+    def stalled_stream():
+        try:
+            for content in ["a", "b"]:
+                yield RunMarkdownFlowDTO("o", "b", GeneratedType.CONTENT, content)
+            # the llm stalls with a chunk held back
+            time.sleep(0.5)
+            yield RunMarkdownFlowDTO("o", "b", GeneratedType.CONTENT, "c")
+            time.sleep(0.5)
+            yield RunMarkdownFlowDTO("o", "b", GeneratedType.CONTENT, "d")
+        finally:
+            closed.append(True)
+
+    stream = coalesce_run_script_stream(stalled_stream(), 50, 200)
+    start = time.monotonic()
+    assert next(stream).content == "ab"
+    # sent when the window passes, not when the next chunk comes
+    assert time.monotonic() - start < 0.3
+    assert next(stream).content == "c"
+    # closing the stream closes the source
+    stream.close()
+    assert closed == [True]
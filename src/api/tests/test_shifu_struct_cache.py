@@ -0,0 +1,36 @@
+def test_shifu_struct_cache(app, count_queries, publish_course):
+    from flaskr.service.shifu.shifu_struct_manager import (
+        get_outline_item_dto,
+        get_shifu_dto,
+        get_shifu_struct,
+        invalidate_shifu_struct_cache,
+    )
+    from flaskr.util import generate_id
+
+    shifu_bid = generate_id(app)
+    outline_bids = [generate_id(app) for _ in range(3)]
+    with app.app_context():
+        try:
+            publish_course(shifu_bid, outline_bids)
+            struct = get_shifu_struct(app, shifu_bid)
+            assert [i.bid for i in struct.children[0].children] == outline_bids[1:]
+            assert get_shifu_dto(app, shifu_bid).title == "test course"
+            for outline_bid in outline_bids:
+                get_outline_item_dto(app, outline_bid)
+                get_outline_item_dto(app, outline_bid)
+
+            # only the latest version is checked once the cache is warm
+            with count_queries() as statements:
+                assert get_shifu_struct(app, shifu_bid) is struct
+                assert get_shifu_dto(app, shifu_bid).title == "test course"
+                assert get_outline_item_dto(app, outline_bids[2]).title == "lesson 1"
+            assert len(statements) <= 3
+
+            # a new publish is visible after the invalidation
+            publish_course(shifu_bid, outline_bids[:2])
+            invalidate_shifu_struct_cache(app, shifu_bid)
+            new_struct = get_shifu_struct(app, shifu_bid)
+            assert new_struct is not struct
+            assert [i.bid for i in new_struct.children[0].children] == outline_bids[1:2]
+        finally:
+            invalidate_shifu_struct_cache(app, shifu_bid)
@@ -0,0 +1,170 @@
+import queue
+import random
+import time
+
+
+def build_struct(chapters: int, lessons: int, blocks: int = 3):
+    from flaskr.service.shifu.shifu_history_manager import HistoryItem
+
+    next_id = [0]
+
+    def item(bid: str, type: str, children: list) -> HistoryItem:
+        next_id[0] += 1
+        return HistoryItem(bid=bid, id=next_id[0], type=type, children=children)
+
+    return item(
+        "shifu",
+        "shifu",
+        [
+            item(
+                f"c{c}",
+                "outline",
+                [
+                    item(
+                        f"c{c}l{lesson}",
+                        "outline",
+                        [
+                            item(f"c{c}l{lesson}b{b}", "block", [])
+                            for b in range(blocks)
+                        ],
+                    )
+                    for lesson in range(lessons)
+                ],
+            )
+            for c in range(chapters)
+        ],
+    )
+
+
+def bfs_find(struct, bid):
+    q = queue.Queue()
+    q.put(struct)
+    while not q.empty():
+        item = q.get()
+        if item.bid == bid:
+            return item
+        for child in item.children:
+            q.put(child)
+    return None
+
+
+def scan_next_visible_leaf(struct, node, is_hidden):
+    # the navigation of RunScriptContextV2 before StructIndex
+    completed, started = [], []
+
+    def mark(node):
+        completed.append(node.bid)
+        q = queue.Queue()
+        q.put(struct)
+        while not q.empty():
+            item = q.get()
+            if item.children and node.bid in [child.bid for child in item.children]:
+                index = [child.bid for child in item.children].index(node.bid)
+                while index < len(item.children) - 1:
+                    current_node = item.children[index + 1]
+                    if is_hidden(current_node.bid):
+                        index += 1
+                        continue
+                    while (
+                        current_node.children
+                        and current_node.children[0].type == "outline"
+                    ):
+                        started.append(current_node.bid)
+                        current_node = current_node.children[0]
+                    started.append(current_node.bid)
+                    return True
+                if index == len(item.children) - 1 and item.type == "outline":
+                    if mark(item):
+                        return True
+            if item.children and item.children[0].type == "outline":
+                for child in item.children:
+                    q.put(child)
+        return False
+
+    mark(node)
+    return completed, started
+
+
+def test_struct_index_lookup():
+    from flaskr.service.shifu.struct_utils import StructIndex, find_node_with_parents
+
+    struct = build_struct(3, 4)
+    index = StructIndex(struct)
+
+    assert index.get_node("c1l2") is bfs_find(struct, "c1l2")
+    assert index.get_parent("c1l2").bid == "c1"
+    assert index.get_sibling_index("c1l2") == 2
+    assert [i.bid for i in index.get_path("c1l2b0")] == [
+        i.bid for i in find_node_with_parents(struct, "c1l2b0")
+    ]
+    assert index.is_leaf_outline("c1l2")
+    assert not index.is_leaf_outline("c1")
+    assert [i.bid for i in index.get_outline_items("c2")] == [
+        "c2",
+        "c2l0",
+        "c2l1",
+        "c2l2",
+        "c2l3",
+    ]
+    assert len(index.get_outline_items()) == 3 + 3 * 4
+    assert len(index.get_leaves()) == 3 * 4
+    assert index.get_next_leaf("c0l3").bid == "c1l0"
+    assert index.get_next_leaf("c2l3") is None
+
+
+def test_struct_index_next_visible_leaf():
+    from flaskr.service.shifu.struct_utils import StructIndex
+
+    struct = build_struct(4, 5)
+    index = StructIndex(struct)
+    rnd = random.Random(7)
+    for _ in range(20):
+        hidden = {i.bid for i in index.get_outline_items() if rnd.random() < 0.3}
+
+        def is_hidden(bid):
+            return bid in hidden
+
+        for leaf in index.get_leaves():
+            completed, started = index.get_next_visible_leaf(leaf.bid, is_hidden)
+            assert (
+                [i.bid for i in completed],
+                [i.bid for i in started],
+            ) == scan_next_visible_leaf(struct, leaf, is_hidden)
+
+
+def test_struct_index_benchmark():
+    from flaskr.service.shifu.struct_utils import StructIndex, find_node_with_parents
+
+    # 500 lessons, 10 blocks per lesson
+    struct = build_struct(25, 20, 10)
+    leaves = [i for i in StructIndex(struct).get_leaves()]
+
+    def is_hidden(bid):
+        return False
+
+    # the work done per block by the runtime: locate the current lesson,
+    # its path for the llm settings and system prompt, and the navigation
+    start = time.perf_counter()
+    for leaf in leaves[::10]:
+        bfs_find(struct, leaf.bid)
+        find_node_with_parents(struct, leaf.bid)
+        find_node_with_parents(struct, leaf.bid)
+        scan_next_visible_leaf(struct, leaf, is_hidden)
+    scan_time = (time.perf_counter() - start) / len(leaves[::10])
+
+    start = time.perf_counter()
+    index = StructIndex(struct)
+    build_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for leaf in leaves[::10]:
+        index.get_node(leaf.bid)
+        index.get_path(leaf.bid)
+        index.get_path(leaf.bid)
+        index.get_next_visible_leaf(leaf.bid, is_hidden)
+    index_time = (time.perf_counter() - start) / len(leaves[::10])
+
+    print(
+        f"\nper block scan: {scan_time * 1000:.3f}ms "
+        f"index: {index_time * 1000:.3f}ms build once: {build_time * 1000:.3f}ms"
+    )
+    assert index_time * 10 < scan_time